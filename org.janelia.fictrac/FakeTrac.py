@@ -5,22 +5,33 @@
 # the approach of the real FicTrac code as of late 2020.
 
 import argparse
+import array
+import asyncio
 import math
 import datetime
-import functools
+import json
+import mmap
+import os
 import random
 import socket
+import struct
 import sys
 import time
 
-integratedHeading = 0
-integratedX = 0
-integratedY = 0
+# The serving, pacing and sending of messages, and the parsing for the reference receiver, are
+# shared with other scripts that simulate devices, in the org.janelia.io package.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "org.janelia.io"))
+import devicesim
+from ioutilities import nthSplit, parseDouble, parseLong
+from transport import Scheduler, TcpCoalescingSender, UdpBatchSender
 
-def message(i, args):
-    global integratedHeading
-    global integratedX, integratedY
+# The integrated heading and position, which each simulated animal has its own copy of.
+def initialState():
+    return {"heading": 0.0, "x": 0.0, "y": 0.0}
 
+defaultState = initialState()
+
+def message(i, args, state=defaultState):
     # FicTrac format:
     # https://github.com/rjdmoore/fictrac/blob/master/doc/data_header.txt
     # COL     PARAMETER                       DESCRIPTION
@@ -73,11 +84,11 @@ def message(i, args):
     msgNumeric[8] = rotationRad
 
     # Empirically, it seems that the heading change SHOULD be negated here, to match the real FicTrac.
-    integratedHeading -= rotationRad
-    msgNumeric[17] = integratedHeading
+    state["heading"] -= rotationRad
+    msgNumeric[17] = state["heading"]
 
-    changeX = math.cos(-integratedHeading) * forward
-    changeY = math.sin(-integratedHeading) * forward
+    changeX = math.cos(-state["heading"]) * forward
+    changeY = math.sin(-state["heading"]) * forward
 
     # In the FicTrac `data_header.txt`, for the "integrated x/y position (in radians) in lab coordinates",
     # the receiver is to "scale by sphere radius for true position", so do the inverse of scaling by
@@ -85,10 +96,10 @@ def message(i, args):
     changeX /= args.radius
     changeY /= args.radius
 
-    integratedX += changeX
-    integratedY += changeY
-    msgNumeric[15] = integratedX
-    msgNumeric[16] = integratedY
+    state["x"] += changeX
+    state["y"] += changeY
+    msgNumeric[15] = state["x"]
+    msgNumeric[16] = state["y"]
  
     # Time (in milliseconds) since the Unix epoch.
     timestampMs = int(time.time() * 1000)
@@ -97,31 +108,498 @@ def message(i, args):
     msgNumeric[23] = frame
     msgNumeric[24] = args.delayMs
 
-    msg = functools.reduce(lambda a, b: a + ", " + str(b), msgNumeric[1:], "FT")
-    msg += " "
+    msg = "FT, " + ", ".join(map(str, msgNumeric[1:])) + " "
     return msg
 
-if __name__ == "__main__":
-    print("[{}] Server starting".format(datetime.datetime.now()))
+# Computes the trajectory for messages `i0` up to `i1` with NumPy, in the same way as `message()`
+# but for all the messages at once, continuing from the integrated heading and position in `state`.
+def trajectory(i0, i1, args, rng, state):
+    import numpy as np
 
-    argv = sys.argv
-    if "--" not in argv:
-        argv = []
-    else:
-        argv = argv[argv.index("--") + 1:]
+    i = np.arange(i0, i1)
+    n = i1 - i0
+    forward = args.translationRate * (1 + rng.uniform(-args.noisePercentage, args.noisePercentage, n))
+    rotationRad = args.rotationRate / (2 * math.pi) * (1 + rng.uniform(-args.noisePercentage, args.noisePercentage, n))
+
+    if args.oscillating:
+        p = 200
+        d = (i + p/2) // p
+        rotationRad[d % 2 == 1] *= -1
+
+    stepping = np.zeros(n, dtype=bool)
+    if args.stepped:
+        stepping = (i // 6) % 2 == 1
+        if args.free:
+            stepping &= (i // 60) % 2 == 0
+        forward[stepping] = 0
+        rotationRad[stepping] = 0
+
+    # Starting each cumulative sum with the previous value adds in the same order as `message()`.
+    def integrate(start, changes):
+        return np.cumsum(np.concatenate(([start], changes)))[1:]
+
+    heading = integrate(state["heading"], -rotationRad)
+    x = integrate(state["x"], np.cos(-heading) * forward / args.radius)
+    y = integrate(state["y"], np.sin(-heading) * forward / args.radius)
+    if n > 0:
+        state["heading"], state["x"], state["y"] = heading[-1], x[-1], y[-1]
+    return forward, rotationRad, heading, x, y, stepping
+
+# Serves the messages from a trajectory computed with `trajectory()` and encoded ahead of time
+# into one buffer, so sending a message just patches its timestamp (a field of fixed width) and
+# slices the buffer.  The first `blockSize` messages are prepared before sending starts, and any
+# more are prepared in blocks of that size when needed, to limit memory use.
+class PrecomputedMessages:
+    # Milliseconds since the Unix epoch have 13 digits until the year 2286.
+    TIMESTAMP_WIDTH = 13
+    TIMESTAMP_PLACEHOLDER = "0" * TIMESTAMP_WIDTH
+
+    def __init__(self, args, blockSize=1000000):
+        import numpy as np
+
+        self.args = args
+        self.blockSize = blockSize
+        self.rng = np.random.default_rng(args.seed)
+        self.state = initialState()
+        self._encodeBlock(0, min(args.count, blockSize))
+
+    def _encodeBlock(self, i0, i1):
+        forward, rotationRad, heading, x, y, stepping = trajectory(i0, i1, self.args, self.rng, self.state)
+        parts = []
+        starts = [0]
+        timestampOffsets = []
+        length = 0
+        delay = str(self.args.delayMs)
+        for k in range(i1 - i0):
+            frame = str(i0 + k + 1)
+            # A stepping pause has motion written as integer 0, as in `message()`.
+            motion = "0, 0" if stepping[k] else "{}, {}".format(forward[k].item(), rotationRad[k].item())
+            # The same fields as `message()`, up to the timestamp, and then the rest.
+            head = "FT, {}, 0, 0, 0, 0, 0, {}, 0, 0, 0, 0, 0, 0, {}, {}, {}, 0, 0, 0, 0, ".format(
+                frame, motion, x[k].item(), y[k].item(), heading[k].item())
+            tail = ", {}, {}, 0, 0 ".format(frame, delay)
+            msg = (head + self.TIMESTAMP_PLACEHOLDER + tail).encode("utf-8")
+            timestampOffsets.append(length + len(head))
+            parts.append(msg)
+            length += len(msg)
+            starts.append(length)
+        self.buffer = bytearray(b"".join(parts))
+        self.view = memoryview(self.buffer)
+        self.starts = starts
+        self.timestampOffsets = timestampOffsets
+        self.blockStart = i0
+        self.blockEnd = i1
+
+    # Returns message `i` as a `memoryview` of the buffer, with the current time as its timestamp.
+    # The indices `i` must not decrease from one call to the next.
+    def message(self, i):
+        if i >= self.blockEnd:
+            i0 = max(i, self.blockEnd)
+            self._encodeBlock(i0, max(i0 + self.blockSize, i + 1))
+        k = i - self.blockStart
+        timestampMs = int(time.time() * 1000)
+        o = self.timestampOffsets[k]
+        self.buffer[o:o + self.TIMESTAMP_WIDTH] = b"%013d" % timestampMs
+        return self.view[self.starts[k]:self.starts[k + 1]]
+
+# A capture of a FicTrac stream is a header followed by one record for each datagram (UDP) or
+# chunk of the stream (TCP) that was received.  The header has the magic bytes, the wall-clock
+# time when the capture started, the number of records and the time from the first record to
+# the last (which are zero if the capture was not closed properly).  Each record has the time
+# since the first record and the length of the data, followed by the data.  All values are
+# little-endian, with times in nanoseconds.
+CAPTURE_MAGIC = b"FTCAP001"
+CAPTURE_HEADER = struct.Struct("<8sqqq")
+CAPTURE_RECORD = struct.Struct("<qI")
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time_ns(), 0, 0))
+        self.firstNs = None
+        self.lastNs = None
+        self.count = 0
+
+    # Adds `data`, received at `nowNs`, a time from `time.perf_counter_ns()`.
+    def write(self, data, nowNs):
+        if self.firstNs is None:
+            self.firstNs = nowNs
+        self.lastNs = nowNs
+        self.file.write(CAPTURE_RECORD.pack(nowNs - self.firstNs, len(data)))
+        self.file.write(data)
+        self.count += 1
+
+    def close(self):
+        durationNs = self.lastNs - self.firstNs if self.count else 0
+        self.file.seek(len(CAPTURE_MAGIC) + 8)
+        self.file.write(struct.pack("<qq", self.count, durationNs))
+        self.file.close()
+
+# Reads a capture through a memory map, so a long capture is not loaded into memory.  Iterating
+# yields (offsetNs, data) for each record.
+class CaptureReader:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.startTimeNs, self.count, self.durationNs = CAPTURE_HEADER.unpack_from(self.map)
+        if magic != CAPTURE_MAGIC:
+            raise ValueError("'{}' is not a FakeTrac capture".format(path))
+        if self.count == 0:
+            # The capture was not closed, so find what it contains.
+            for offsetNs, _ in self:
+                self.count += 1
+                self.durationNs = offsetNs
+
+    def __iter__(self):
+        pos = CAPTURE_HEADER.size
+        end = len(self.map)
+        while pos + CAPTURE_RECORD.size <= end:
+            offsetNs, length = CAPTURE_RECORD.unpack_from(self.map, pos)
+            pos += CAPTURE_RECORD.size
+            if pos + length > end:
+                # A partial record at the end of a capture that was not closed.
+                break
+            yield offsetNs, self.map[pos:pos + length]
+            pos += length
+
+    # The average rate of the records, for scheduling statistics.
+    def rateHz(self):
+        return (self.count - 1) * 1e9 / self.durationNs if self.count > 1 and self.durationNs > 0 else 1.0
+
+    def close(self):
+        self.map.close()
+
+# Receives a FicTrac stream and writes it to a capture.  With UDP, it receives datagrams sent to
+# the host and port, and with TCP it connects to a FicTrac server at the host and port.  It stops
+# when the stream has been idle for `args.timeout` seconds, when a TCP server closes the
+# connection, or on a keyboard interrupt.
+def record(args):
+    writer = CaptureWriter(args.recordPath)
+    socketType = socket.SOCK_DGRAM if args.useUDP else socket.SOCK_STREAM
+    try:
+        with socket.socket(socket.AF_INET, socketType) as sock:
+            if args.useUDP:
+                sock.bind((args.host, args.port))
+            else:
+                sock.connect((args.host, args.port))
+            sock.settimeout(args.timeout)
+            print("[{}] Recording from {} to '{}'".format(datetime.datetime.now(), (args.host, args.port), args.recordPath))
+            while True:
+                data = sock.recv(65536)
+                nowNs = time.perf_counter_ns()
+                if not data:
+                    break
+                writer.write(data, nowNs)
+    except socket.timeout:
+        pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+    durationSecs = (writer.lastNs - writer.firstNs) / 1e9 if writer.count else 0
+    print("[{}] Recorded {} {} over {:.3f} sec".format(datetime.datetime.now(), writer.count,
+        "datagrams" if args.useUDP else "chunks", durationSecs))
+
+# One simulated animal, with its own port, trajectory parameters and state, as a stream for
+# `devicesim`.  With UDP it sends to its port on the host, and with TCP it serves any number of
+# clients on its port.
+class Subject(devicesim.Stream):
+    def __init__(self, args):
+        super().__init__(devicesim.output(args))
+        self.args = args
+        self.state = initialState()
+        self.precomputed = PrecomputedMessages(args) if args.precompute else None
+        # With a latency probe, the time each message was sent, from `time.perf_counter_ns()`.
+        self.sendNs = None
+
+    def messages(self, indices):
+        for i in indices:
+            if self.precomputed:
+                msg = self.precomputed.message(i)
+            else:
+                msg = message(i, self.args, self.state).encode("utf-8")
+            if self.sendNs is not None:
+                self.sendNs[i] = time.perf_counter_ns()
+            yield msg
+
+# Returns a copy of `args` for a subject, with changes from `spec`, which has the form
+# "PORT" or "PORT:KEY=VALUE,FLAG,...", where the keys and flags are the long names of the
+# trajectory and socket arguments (e.g., "2001:rot=0.1,oscillate,tcp").
+def subjectArgs(args, spec):
+    keys = {"trans": ("translationRate", float), "rot": ("rotationRate", float), "noise": ("noisePercentage", float),
+            "rad": ("radius", float), "seed": ("seed", int)}
+    flags = {"free": ("free", True), "stepped": ("stepped", True), "oscillate": ("oscillating", True),
+             "tcp": ("useUDP", False), "udp": ("useUDP", True)}
+    result = argparse.Namespace(**vars(args))
+    port, _, rest = spec.partition(":")
+    result.port = int(port)
+    for item in filter(None, rest.split(",")):
+        key, _, value = item.partition("=")
+        if key in keys:
+            setattr(result, keys[key][0], keys[key][1](value))
+        elif key in flags:
+            setattr(result, flags[key][0], flags[key][1])
+        else:
+            raise ValueError("Unknown subject setting '{}' in '{}'".format(key, spec))
+    return result
+
+# Simulates one or more animals, each with its own port, all sending messages with the same
+# timing, as one device for `devicesim`.  A TCP subject waits for its first client before sending
+# starts.  With a latency `probe`, the latencies are reported at the end.
+class Subjects(devicesim.Device):
+    def __init__(self, args, subjects, probe=None):
+        super().__init__("FicTrac", args.rateHz, args.count, args.latePolicy, args.spinUs * 1000, args.maxBatch, subjects)
+        self.args = args
+        self.probe = probe
+
+    async def start(self, timeout=None):
+        if self.probe:
+            await self.probe.start(self.streams, self.count)
+        await super().start(timeout)
+
+    async def close(self):
+        await super().close()
+        for subject in self.streams:
+            print("[{}] Port {} done with {} messages, {} TCP clients at the end".format(datetime.datetime.now(),
+                subject.args.port, subject.sent, len(getattr(subject.output, "clients", ()))))
+        if self.probe:
+            # Allow time for the last echoes to arrive.
+            await asyncio.sleep(self.probe.GRACE_SECS)
+            self.probe.close()
+
+    def report(self):
+        self.scheduler.report()
+        if self.probe:
+            self.probe.report(self.args.probePath, self.args, self.scheduler)
+
+# A histogram of latencies in the style of HdrHistogram, with buckets whose widths grow with the
+# values so every value is recorded with a relative precision better than 1%, using little memory
+# for any range of values.  Values are in nanoseconds, and are reported in microseconds.
+class LatencyHistogram:
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.totalNs = 0
+        self.minNs = None
+        self.maxNs = None
+
+    def record(self, valueNs):
+        valueNs = max(valueNs, 0)
+        shift = max(valueNs.bit_length() - self.SUB_BUCKET_BITS, 0)
+        key = (shift, valueNs >> shift)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.totalNs += valueNs
+        self.minNs = valueNs if self.minNs is None else min(self.minNs, valueNs)
+        self.maxNs = valueNs if self.maxNs is None else max(self.maxNs, valueNs)
+
+    # The smallest bucket value at or above which fraction `q` of the values lie (as in HdrHistogram,
+    # a value equivalent to the exact quantile within the precision of the buckets).
+    def _quantileNs(self, buckets, q):
+        target = max(math.ceil(q * self.count), 1)
+        total = 0
+        for valueNs, count in buckets:
+            total += count
+            if total >= target:
+                return min(valueNs, self.maxNs)
+        return self.maxNs
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        # The highest value in each bucket, in increasing order.
+        buckets = sorted((((top + 1) << shift) - 1, count) for (shift, top), count in self.counts.items())
+        result = {"count": self.count, "min": self.minNs / 1000, "mean": self.totalNs / self.count / 1000}
+        for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p99.9", 0.999)):
+            result[name] = self._quantileNs(buckets, q) / 1000
+        result["max"] = self.maxNs / 1000
+        result["buckets"] = [[valueNs / 1000, count] for valueNs, count in buckets]
+        return result
+
+# Each echo from the reference receiver reports one FicTrac message: the port it was received on,
+# its `seqCounter`, the time it was received (from `time.perf_counter_ns()`, which uses a clock
+# shared by the processes on a machine), and flags with bit 0 set if it arrived out of order.
+ECHO_RECORD = struct.Struct("<HqqB")
+ECHO_REORDERED = 1
+
+# Receives echoes from the reference receiver (run as `FakeTrac.py --echo`), and measures the
+# one-way latency (from sending a message to the receiver receiving it) and the round-trip latency
+# (from sending to receiving the echo) for the messages of each subject.
+class LatencyProbe(asyncio.DatagramProtocol):
+    GRACE_SECS = 0.5
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.transport = None
+        self.subjects = {}
+        self.results = {}
+
+    async def start(self, subjects, count):
+        for subject in subjects:
+            subject.sendNs = array.array("q", bytes(8 * count))
+            self.subjects[subject.args.port] = subject
+            self.results[subject.args.port] = {"echoed": 0, "reordered": 0, "duplicates": 0, "seen": bytearray(count),
+                                               "oneWay": LatencyHistogram(), "roundTrip": LatencyHistogram()}
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+        print("[{}] Probe listening for echoes, port {}".format(datetime.datetime.now(), self.port))
+
+    def datagram_received(self, data, addr):
+        nowNs = time.perf_counter_ns()
+        for port, seq, receivedNs, flags in ECHO_RECORD.iter_unpack(data[:len(data) - len(data) % ECHO_RECORD.size]):
+            subject = self.subjects.get(port)
+            i = seq - 1
+            if subject is None or not 0 <= i < len(subject.sendNs) or subject.sendNs[i] == 0:
+                continue
+            result = self.results[port]
+            if result["seen"][i]:
+                result["duplicates"] += 1
+                continue
+            result["seen"][i] = 1
+            result["echoed"] += 1
+            if flags & ECHO_REORDERED:
+                result["reordered"] += 1
+            result["oneWay"].record(receivedNs - subject.sendNs[i])
+            result["roundTrip"].record(nowNs - subject.sendNs[i])
 
-    parser = argparse.ArgumentParser(argv)
-    parser.set_defaults(host="127.0.0.1")
-    parser.add_argument("--addr", "-a", dest="host", help="socket host")
-    parser.set_defaults(port=2000)
-    parser.add_argument("--port", "-p", type=int, dest="port", help="socket port")
-    parser.set_defaults(useUDP=True)
-    parser.add_argument("--tcp", "-tcp", dest="useUDP", action="store_false", help="use TCP instead of UDP for the socket protocol")
-    # A 240 Hz frame rate is 1 / 240 s between frames, or 0.004167 s or about 4 ms between frames.
-    parser.set_defaults(delayMs=4)
-    parser.add_argument("--delay", "-d", type=int, dest="delayMs", help="delay between messages (msec)")
-    parser.set_defaults(timeout=30)
-    parser.add_argument("--timeout", "-t", type=int, dest="timeout", help="server listening timeout (sec)")
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    def report(self, path, args, scheduler):
+        subjects = []
+        for port, result in self.results.items():
+            sent = self.subjects[port].sent
+            subjects.append({"port": port, "protocol": "udp" if self.subjects[port].args.useUDP else "tcp",
+                "sent": sent, "echoed": result["echoed"], "lost": sent - result["echoed"],
+                "reordered": result["reordered"], "duplicates": result["duplicates"],
+                "oneWayUs": result["oneWay"].summary(), "roundTripUs": result["roundTrip"].summary()})
+            print("[{}] Port {}: {} of {} echoed, {} reordered, one-way p50 {} p99 {} p99.9 {} usec".format(
+                datetime.datetime.now(), port, result["echoed"], sent, result["reordered"],
+                *(subjects[-1]["oneWayUs"].get(p) for p in ("p50", "p99", "p99.9"))))
+        settings = {"rateHz": args.rateHz, "count": args.count, "precompute": args.precompute,
+                    "latePolicy": args.latePolicy, "spinUs": args.spinUs}
+        with open(path, "w") as f:
+            json.dump({"settings": settings, "scheduler": scheduler.stats(), "subjects": subjects}, f, indent=2)
+        print("[{}] Wrote latency report to '{}'".format(datetime.datetime.now(), path))
+
+# The columns `FicTracReader.GetNextMessage` parses as integers; it parses the others as floating point.
+FICTRAC_LONG_COLUMNS = {1, 22, 23, 24, 25}
+
+# Returns the 25 values of the FicTrac message starting at index `i0` of `b`, or None if a value is
+# invalid, as `FicTracReader.GetNextMessage`.
+def parseFicTrac(b, i0):
+    values = []
+    for n in range(1, 26):
+        split = nthSplit(b, b",", i0, n)
+        if split is None:
+            return None
+        value, valid = (parseLong if n in FICTRAC_LONG_COLUMNS else parseDouble)(b, *split)
+        if not valid:
+            return None
+        values.append(value)
+    return values
+
+# The reference receiver, which reads FicTrac messages and parses them as `FicTracReader` does, and
+# echoes each message's `seqCounter` to a latency probe.  Like `SocketReader`, it reads at most
+# `args.readBufferSizeBytes` at a time, and like `SocketMessageReader` it separates the messages
+# in what it read by the 'F' header character.  It stops when nothing has been received for
+# `args.timeout` seconds, when a TCP server closes the connection, or on a keyboard interrupt.
+def echo(args):
+    echoAddress = (args.host, args.echoPort)
+    socketType = socket.SOCK_DGRAM if args.useUDP else socket.SOCK_STREAM
+    received = 0
+    invalid = 0
+    reordered = 0
+    duplicates = 0
+    seen = set()
+    maxSeq = 0
+    with socket.socket(socket.AF_INET, socketType) as sock, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as echoSock:
+        if args.useUDP:
+            sock.bind((args.host, args.port))
+        else:
+            sock.connect((args.host, args.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(args.timeout)
+        print("[{}] Echoing from {} to {}".format(datetime.datetime.now(), (args.host, args.port), echoAddress))
+        buffer = bytearray(args.readBufferSizeBytes)
+        try:
+            while True:
+                n = sock.recv_into(buffer)
+                receivedNs = time.perf_counter_ns()
+                if n == 0:
+                    break
+                data = bytes(buffer[:n])
+                echoes = bytearray()
+                i0 = data.find(b"F")
+                while i0 != -1:
+                    values = parseFicTrac(data, i0)
+                    if values is None:
+                        invalid += 1
+                    else:
+                        received += 1
+                        seq = values[22]
+                        flags = 0
+                        if seq in seen:
+                            duplicates += 1
+                        elif seq < maxSeq:
+                            flags |= ECHO_REORDERED
+                            reordered += 1
+                        seen.add(seq)
+                        maxSeq = max(maxSeq, seq)
+                        echoes += ECHO_RECORD.pack(args.port, seq, receivedNs, flags)
+                    i0 = data.find(b"F", i0 + 1)
+                if echoes:
+                    echoSock.sendto(echoes, echoAddress)
+        except (socket.timeout, KeyboardInterrupt):
+            pass
+    lost = maxSeq - min(seen) + 1 - len(seen) if seen else 0
+    print("[{}] Received {} messages, {} invalid, {} lost, {} reordered, {} duplicates".format(
+        datetime.datetime.now(), received, invalid, lost, reordered, duplicates))
+
+# Sends the stream recorded in a capture, at the recorded timing scaled by `args.speed`, or as
+# fast as possible if the speed is 0.
+def replay(args):
+    capture = CaptureReader(args.replayPath)
+    print("[{}] Replaying {} records, {:.3f} sec at the recorded speed".format(datetime.datetime.now(),
+        capture.count, capture.durationNs / 1e9))
+    scheduler = Scheduler(capture.rateHz() * (args.speed if args.speed > 0 else 1), spinNs=args.spinUs * 1000)
+    socketType = socket.SOCK_DGRAM if args.useUDP else socket.SOCK_STREAM
+
+    with socket.socket(socket.AF_INET, socketType) as sock:
+        if args.useUDP:
+            print("[{}] Server will send to {}".format(datetime.datetime.now(), (args.host, args.port)))
+
+            sender = UdpBatchSender(sock, (args.host, args.port), args.maxBatch)
+            for data in scheduler.replay(capture, args.speed):
+                sender.add(data)
+                sender.flush()
+
+        else:
+            sock.bind((args.host, args.port))
+            sock.settimeout(args.timeout)
+            print("[{}] Server listening".format(datetime.datetime.now()))
+            sock.listen()
+            conn, addr = sock.accept()
+            with conn:
+                print("[{}] Server connected, address {}".format(datetime.datetime.now(), addr))
+
+                sender = TcpCoalescingSender(conn, args.flushUs * 1000)
+                for data in scheduler.replay(capture, args.speed):
+                    sender.add(data)
+                    sender.flushIfDue()
+                sender.flush()
+
+    print("[{}] Server done with {} messages".format(datetime.datetime.now(), capture.count))
+    scheduler.report()
+
+# Returns the parser for the command-line arguments, which `devicesim` also uses for a rig.
+def argumentParser(prog=None):
+    parser = argparse.ArgumentParser(prog)
+    devicesim.addArguments(parser)
     parser.set_defaults(count=2000)
     parser.add_argument("--count", "-c", type=int, dest="count", help="total message count")
     parser.set_defaults(translationRate=0.001)
@@ -138,33 +616,60 @@ if __name__ == "__main__":
     parser.add_argument("--oscillate", "-os", dest="oscillating", action="store_true", help="produce oscilating rotation")
     parser.set_defaults(radius=1.0)
     parser.add_argument("--rad", "-r", type=float, dest="radius", help="trackball radius (for integrated x, y only)")
-    args = parser.parse_args()
+    parser.set_defaults(precompute=False)
+    parser.add_argument("--precompute", "-pre", dest="precompute", action="store_true", help="compute and encode the trajectory ahead of time with NumPy")
+    parser.add_argument("--seed", type=int, dest="seed", help="seed for the random noise")
+    parser.add_argument("--record", dest="recordPath", help="instead of sending, record a FicTrac stream to this file")
+    parser.add_argument("--replay", dest="replayPath", help="instead of a generated trajectory, send the stream recorded in this file")
+    parser.set_defaults(speed=1.0)
+    parser.add_argument("--speed", type=float, dest="speed", help="replay at this multiple of the recorded speed, or as fast as possible if 0")
+    parser.add_argument("--probe", dest="probePath", help="measure latency with echoes from a reference receiver, and write a report to this JSON file")
+    parser.add_argument("--echo", dest="echo", action="store_true", help="instead of sending, be the reference receiver that echoes to a --probe")
+    parser.set_defaults(echoPort=2100)
+    parser.add_argument("--echo-port", type=int, dest="echoPort", help="port for echoes from the reference receiver to the probe")
+    parser.set_defaults(readBufferSizeBytes=1024)
+    parser.add_argument("--read-buffer", type=int, dest="readBufferSizeBytes", help="reference receiver's read size, as the readBufferSizeBytes of FicTracReader")
+    parser.set_defaults(subjectCount=0)
+    parser.add_argument("--subjects", "-n", type=int, dest="subjectCount", help="simulate this many animals, on consecutive ports starting at --port")
+    parser.set_defaults(subjectSpecs=[])
+    parser.add_argument("--subject", "-su", dest="subjectSpecs", action="append", help="simulate an animal on a port with its own settings, as PORT or PORT:KEY=VALUE,FLAG,... (repeatable)")
+    return parser
 
-    socketType = socket.SOCK_DGRAM if args.useUDP else socket.SOCK_STREAM
+# Returns the device for the arguments, for `devicesim`: the animals from `--subjects` and
+# `--subject`, or just one on `--port`.
+def makeDevice(args):
+    if args.recordPath or args.replayPath or args.echo:
+        raise ValueError("--record, --replay and --echo do not simulate a device")
+    args.rateHz = devicesim.rateHz(args)
+    # FicTrac's column 24 is an integer, so a fractional value would not parse.
+    args.delayMs = round(1000 / args.rateHz)
+    random.seed(args.seed)
+    specs = [str(args.port + k) for k in range(args.subjectCount)] + args.subjectSpecs
+    subjects = [Subject(subjectArgs(args, spec)) for spec in specs or [str(args.port)]]
+    probe = LatencyProbe(args.host, args.echoPort) if args.probePath else None
+    return Subjects(args, subjects, probe)
 
-    with socket.socket(socket.AF_INET, socketType) as sock:
-        if args.useUDP:
-            print("[{}] Server will send to {}".format(datetime.datetime.now(), (args.host, args.port)))
+if __name__ == "__main__":
+    print("[{}] Server starting".format(datetime.datetime.now()))
 
-            for i in range(args.count):
-                msg = message(i, args)
-                sock.sendto(msg.encode('utf-8'), (args.host, args.port))
-                time.sleep(args.delayMs / 1000)
+    argv = sys.argv
+    if "--" not in argv:
+        argv = []
+    else:
+        argv = argv[argv.index("--") + 1:]
 
-            print("[{}] Server done with {} messages".format(datetime.datetime.now(), args.count))
+    parser = argumentParser(argv)
+    args = parser.parse_args()
 
-        else:
-            sock.bind((args.host, args.port))
-            sock.settimeout(args.timeout)
-            print("[{}] Server listening".format(datetime.datetime.now()))
-            sock.listen()
-            conn, addr = sock.accept()
-            with conn:
-                print("[{}] Server connected, address {}".format(datetime.datetime.now(), addr))
+    if args.recordPath:
+        record(args)
+        sys.exit(0)
+    if args.echo:
+        echo(args)
+        sys.exit(0)
 
-                for i in range(args.count):
-                    msg = message(i, args)
-                    conn.sendall(msg.encode('utf-8'))
-                    time.sleep(args.delayMs / 1000)
+    if args.replayPath:
+        replay(args)
+        sys.exit(0)
 
-                print("[{}] Server done with {} messages".format(datetime.datetime.now(), args.count))
+    devicesim.run([makeDevice(args)], args.timeout)
@@ -1,20 +1,31 @@
 # Generates simple messages that can be read by ExampleReadingSocket.cs.
 # Messages can be in either JSON format (with a newline terminator)
 # or an ad hoc format (with a 'J' character header).
+# There is also a binary format, of fixed-layout records (see `packBinaryMessage`).
 # Messages can be sent using either UDP or TCP.
 
 import argparse
 import math
 import datetime
 import functools
-import random
-import socket
+import struct
 import sys
 import time
 
-def message(i, args):
-    global scale
+import devicesim
+
+# The binary format: each message is a little-endian record, starting with its total size in bytes
+# (including the size itself) and its type, followed by the time in milliseconds since the Unix
+# epoch.  A pose message then has the position and rotation (euler angles, in degrees) as 32-bit
+# floats, and a scale message has the scale.  Since each record has its size, several messages can
+# be sent in one datagram, and the reader does not need a delimiter.
+BINARY_POSE = struct.Struct("<HBq6f")
+BINARY_SCALE = struct.Struct("<HBqf")
+BINARY_TYPE_POSE = 1
+BINARY_TYPE_SCALE = 2
 
+# Returns the position (x and z) and the rotation (about y) for message `i` of a cycle.
+def pose(i, args):
     # Position in world space.
     posX = (4 * (1 - abs(0.5 - i / (args.count - 1))) - 3) * args.scale
     theta = i / args.count * 4 * math.pi
@@ -26,8 +37,35 @@ def message(i, args):
     rotY = 90 + (2 * (1 - abs(0.5 - j / (half - 1))) - 1) * 180
     rotY = rotY if (i < half) else 180 - rotY
 
+    return posX, posZ, rotY
+
+# Like `pose`, but returns arrays of the values for all the messages of a cycle, computed with NumPy.
+def poses(args):
+    import numpy as np
+
+    i = np.arange(args.count)
+    posX = (4 * (1 - np.abs(0.5 - i / (args.count - 1))) - 3) * args.scale
+    theta = i / args.count * 4 * math.pi
+    posZ = np.sin(theta) * args.scale
+
+    half = args.count / 2
+    j = i % half
+    rotY = 90 + (2 * (1 - np.abs(0.5 - j / (half - 1))) - 1) * 180
+    rotY = np.where(i < half, rotY, 180 - rotY)
+
+    return posX, posZ, rotY
+
+# Returns message `i` as a string.  The time and pose are computed unless they are given (by
+# `PrecomputedCycle`).
+def message(i, args, timestampMs=None, posXZY=None):
+    global scale
+
+    posX, posZ, rotY = posXZY if posXZY else pose(i, args)
+    half = args.count / 2
+
     # Time in milliseconds since the Unix epoch.
-    timestampMs = int(time.time() * 1000)
+    if timestampMs is None:
+        timestampMs = int(time.time() * 1000)
 
     if args.useJson:
         # Test how the reader handles two types of messages, distinguished by a `type` field.
@@ -43,70 +81,164 @@ def message(i, args):
 
     return msg
 
-if __name__ == "__main__":
-    print("[{}] Server starting".format(datetime.datetime.now()))
-
-    argv = sys.argv
-    if "--" not in argv:
-        argv = []
-    else:
-        argv = argv[argv.index("--") + 1:]
+# Packs message `i` in the binary format into `buffer` at `offset`, with the same types of messages
+# as the JSON format, and returns the offset after it.  Packing into a preallocated buffer avoids
+# creating any objects for the message other than the numbers.  As with `message`, the time and
+# pose may be given.
+def packBinaryMessage(buffer, offset, i, args, timestampMs=None, posXZY=None):
+    global scale
 
-    parser = argparse.ArgumentParser(argv)
-    parser.set_defaults(host="127.0.0.1")
-    parser.add_argument("--addr", "-a", dest="host", help="socket host")
-    parser.set_defaults(port=2000)
-    parser.add_argument("--port", "-p", type=int, dest="port", help="socket port")
-    parser.set_defaults(useUDP=True)
-    parser.add_argument("--tcp", "-tcp", dest="useUDP", action="store_false", help="use TCP instead of UDP for the socket protocol")
+    if timestampMs is None:
+        timestampMs = int(time.time() * 1000)
+    half = int(args.count / 2)
+    if i % half == 0:
+        scale = i // half + 1
+        BINARY_SCALE.pack_into(buffer, offset, BINARY_SCALE.size, BINARY_TYPE_SCALE, timestampMs, scale)
+        return offset + BINARY_SCALE.size
+    posX, posZ, rotY = posXZY if posXZY else pose(i, args)
+    BINARY_POSE.pack_into(buffer, offset, BINARY_POSE.size, BINARY_TYPE_POSE, timestampMs, posX, 0.0, posZ, 0.0, rotY, 0.0)
+    return offset + BINARY_POSE.size
+
+# Returns message `i` in the binary format, as `bytes`.
+def binaryMessage(i, args):
+    buffer = bytearray(BINARY_POSE.size)
+    return bytes(buffer[:packBinaryMessage(buffer, 0, i, args)])
+
+# Serves the messages of a cycle, computed with `poses()` and encoded ahead of time into one buffer,
+# since every cycle has the same messages except for their timestamps.  Sending messages just
+# patches their timestamps (fields of fixed width) in place and slices the buffer, so no objects
+# are created for the messages except the timestamp, once per millisecond.
+class PrecomputedCycle:
+    # Milliseconds since the Unix epoch have 13 digits until the year 2286.
+    TIMESTAMP_WIDTH = 13
+    TIMESTAMP_PLACEHOLDER = "0" * TIMESTAMP_WIDTH
+    BINARY_TIMESTAMP = struct.Struct("<q")
+
+    def __init__(self, args):
+        self.binary = args.useBinary
+        posX, posZ, rotY = (a.tolist() for a in poses(args))
+        parts = []
+        starts = [0]
+        timestampOffsets = []
+        length = 0
+        scratch = bytearray(BINARY_POSE.size)
+        for i in range(args.count):
+            posXZY = (posX[i], posZ[i], rotY[i])
+            if self.binary:
+                msg = bytes(scratch[:packBinaryMessage(scratch, 0, i, args, 0, posXZY)])
+                # The timestamp follows the size and type.
+                timestampOffsets.append(length + 3)
+            else:
+                msg = message(i, args, self.TIMESTAMP_PLACEHOLDER, posXZY).encode('utf-8')
+                # The timestamp comes before any other number in the message.
+                timestampOffsets.append(length + msg.index(self.TIMESTAMP_PLACEHOLDER.encode('utf-8')))
+            parts.append(msg)
+            length += len(msg)
+            starts.append(length)
+        self.buffer = bytearray(b"".join(parts))
+        self.view = memoryview(self.buffer)
+        self.starts = starts
+        self.timestampOffsets = timestampOffsets
+        # Each message, as a `memoryview` of the buffer.
+        self.messages = [self.view[starts[i]:starts[i + 1]] for i in range(args.count)]
+        self.timestampMs = None
+        self.timestampDigits = None
+
+    # Sets the timestamps of the messages with the indices `indices` (a `range`) to the current time.
+    def stamp(self, indices):
+        timestampMs = int(time.time() * 1000)
+        if self.binary:
+            for i in indices:
+                self.BINARY_TIMESTAMP.pack_into(self.buffer, self.timestampOffsets[i], timestampMs)
+            return
+        if timestampMs != self.timestampMs:
+            self.timestampMs = timestampMs
+            self.timestampDigits = b"%013d" % timestampMs
+        w = self.TIMESTAMP_WIDTH
+        for i in indices:
+            o = self.timestampOffsets[i]
+            self.buffer[o:o + w] = self.timestampDigits
+
+    # Returns the messages with the indices `indices` (a `range`), which are contiguous in the
+    # buffer, as one `memoryview`.
+    def batch(self, indices):
+        return self.view[self.starts[indices.start]:self.starts[indices.stop]]
+
+# The messages of the cycles, as a stream for `devicesim`.
+class PoseStream(devicesim.Stream):
+    def __init__(self, args):
+        super().__init__(devicesim.output(args))
+        self.args = args
+        self.precomputed = PrecomputedCycle(args) if args.precompute else None
+        # For the binary format, the messages due together are packed into this buffer, to be sent
+        # together.
+        self.binaryBuffer = bytearray(args.maxBatch * BINARY_POSE.size)
+        self.binaryView = memoryview(self.binaryBuffer)
+
+    # Yields the indices within a cycle for `indices`, as one or two ranges, split at the end of a
+    # cycle.
+    def cycleRanges(self, indices):
+        i = indices.start
+        while i < indices.stop:
+            cycle, j = divmod(i, self.args.count)
+            if j == 0:
+                print("[{}] Cycle {} of {} ({:.2f}%)".format(datetime.datetime.now(), cycle, self.args.cycles, (cycle / self.args.cycles) * 100))
+            j1 = min(self.args.count, j + indices.stop - i)
+            yield range(j, j1)
+            i += j1 - j
+
+    def messages(self, indices):
+        offset = 0
+        for r in self.cycleRanges(indices):
+            if self.precomputed:
+                self.precomputed.stamp(r)
+                if self.args.useBinary:
+                    yield self.precomputed.batch(r)
+                else:
+                    for j in r:
+                        yield self.precomputed.messages[j]
+            elif self.args.useBinary:
+                start = offset
+                for j in r:
+                    offset = packBinaryMessage(self.binaryBuffer, offset, j, self.args)
+                yield self.binaryView[start:offset]
+            else:
+                for j in r:
+                    yield message(j, self.args).encode('utf-8')
+
+# Returns the parser for the command-line arguments, which `devicesim` also uses for a rig.
+def argumentParser(prog=None):
+    parser = argparse.ArgumentParser(prog)
+    devicesim.addArguments(parser)
     parser.set_defaults(count=2000)
     parser.add_argument("--count", "-c", type=int, dest="count", help="total message count for the cycle")
     parser.set_defaults(cycles=2)
     parser.add_argument("--cycles", "-cy", type=int, dest="cycles", help="numer of cycle")
-    # A 240 Hz frame rate is 1 / 240 s between frames, or 0.004167 s or about 4 ms between frames.
-    parser.set_defaults(delayMs=4)
-    parser.add_argument("--delay", "-d", type=int, dest="delayMs", help="delay between messages (msec)")
     parser.set_defaults(scale=5)
     parser.add_argument("--scale", "-s", type=float, dest="scale", help="scale for the default [-1, 1] size")
-    parser.set_defaults(timeout=30)
-    parser.add_argument("--timeout", "-t", type=int, dest="timeout", help="server listening timeout (sec)")
     parser.set_defaults(noisePercentage=0.1)
     parser.add_argument("--noise", "-no", type=float, dest="noisePercentage", help="noise percentage of actual value")
     parser.set_defaults(useJson=False)
     parser.add_argument("--json", "-j", dest="useJson", action="store_true", help="use messages in JSON")
-    args = parser.parse_args()
-
-    socketType = socket.SOCK_DGRAM if args.useUDP else socket.SOCK_STREAM
-
-    with socket.socket(socket.AF_INET, socketType) as sock:
-        if args.useUDP:
-            print("[{}] Server will send to {}".format(datetime.datetime.now(), (args.host, args.port)))
+    parser.set_defaults(useBinary=False)
+    parser.add_argument("--binary", "-bin", dest="useBinary", action="store_true", help="use messages in the binary format, with all the messages of a batch in one datagram")
+    parser.set_defaults(precompute=False)
+    parser.add_argument("--precompute", "-pre", dest="precompute", action="store_true", help="compute and encode a cycle's messages ahead of time with NumPy")
+    return parser
 
-            for i in range(args.cycles):
-                print("[{}] Cycle {} of {} ({:.2f}%)".format(datetime.datetime.now(), i, args.cycles, (i / args.cycles) * 100))
+# Returns the device for the arguments, for `devicesim`.
+def makeDevice(args):
+    return devicesim.Device("Pose stream", devicesim.rateHz(args), args.count * args.cycles, args.latePolicy,
+        args.spinUs * 1000, args.maxBatch, [PoseStream(args)])
 
-                for j in range(args.count):
-                    msg = message(j, args)
-                    sock.sendto(msg.encode('utf-8'), (args.host, args.port))
-                    time.sleep(args.delayMs / 1000)
+if __name__ == "__main__":
+    print("[{}] Server starting".format(datetime.datetime.now()))
 
-                print("[{}] Server done with {} messages".format(datetime.datetime.now(), args.count))
+    argv = sys.argv
+    if "--" not in argv:
+        argv = []
+    else:
+        argv = argv[argv.index("--") + 1:]
 
-        else:
-            sock.bind((args.host, args.port))
-            sock.settimeout(args.timeout)
-            print("[{}] Server listening".format(datetime.datetime.now()))
-            sock.listen()
-            conn, addr = sock.accept()
-            with conn:
-                print("[{}] Server connected, address {}".format(datetime.datetime.now(), addr))
-
-                for i in range(args.cycles):
-                    print("[{}] Cycle {} of {} ({:.2f}%)".format(datetime.datetime.now(), i, args.cycles, (i / args.cycles) * 100))
-
-                    for j in range(args.count):
-                        msg = message(j, args)
-                        conn.sendall(msg.encode('utf-8'))
-                        time.sleep(args.delayMs / 1000)
-
-                    print("[{}] Server done with {} messages".format(datetime.datetime.now(), args.count))
+    args = argumentParser(argv).parse_args()
+    devicesim.run([makeDevice(args)], args.timeout)
@@ -0,0 +1,352 @@
+# Benchmarks for the Python scripts that send messages over sockets, like ExampleWritingSocket.py
+# and FakeTrac.py (in the org.janelia.fictrac package).
+
+# The "transport" benchmark sends messages as fast as possible over the loopback interface, and
+# compares the original way of sending, with one `sendto` (UDP) or `sendall` (TCP) per message,
+# to `transport.UdpBatchSender` and `transport.TcpCoalescingSender` sending batches of messages.
+# For UDP, batches are sent both with `sendmmsg` (where available) and with one `sendto` per
+# message from the preallocated buffer.  The results are in messages per second, and CPU time
+# (user plus system, for this process) per message.  The UDP receiving socket is never read, so
+# the kernel discards datagrams once its buffer is full, which does not slow the sender.
+# python benchmark.py transport --messages 200000 --size 200 --batch 1 8 64
+
+# The "formats" benchmark compares the message formats of ExampleWritingSocket.py (ad hoc text,
+# JSON and binary) over UDP and TCP, at each message rate (in Hz, with 0 meaning as fast as
+# possible) and payload size (the number of messages sent together, in one datagram or one TCP
+# write).  A receiver in a separate process reads the messages with a reference reader: like
+# `SocketReader` it reads at most `--read-buffer` bytes at a time, like `SocketMessageReader` it
+# separates the messages in each read independently, and it parses the ad hoc format with the
+# rules of `IoUtilities` (see ioutilities.py).  The binary reader keeps an incomplete record for the
+# next read, since a binary record split across reads cannot be found by a delimiter.  Messages
+# that are not received, or are received but are invalid (e.g., split by a TCP read, or with a
+# number in scientific notation, which `IoUtilities.ParseDouble` rejects), count as lost.  The
+# results are in messages and bytes per second sent, encoding and decoding CPU time per message
+# (measured separately, without sockets), CPU time per message for the receiver process as a
+# whole, and the fraction lost.
+# python benchmark.py --report formats.json formats --format adhoc json binary --rate 240 1000 0 --batch 1 16
+
+import argparse
+import json
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+
+import ExampleWritingSocket
+import ioutilities
+import transport
+
+# Returns `n` distinct messages of about `size` bytes, as strings like those the scripts build.
+def synthetic_messages(n, size):
+    messages = []
+    for i in range(min(n, 1000)):
+        msg = "FT, {}, ".format(i + 1)
+        msg += ", ".join("{:.6f}".format((i * k) % 997 / 997) for k in range(1, 1 + max(size - len(msg), 0) // 10))
+        messages.append(msg + " ")
+    return [messages[i % len(messages)] for i in range(n)]
+
+# Returns the wall-clock and CPU time taken by `func()`.
+def timed(func):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    func()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+def result(name, protocol, batch, n, elapsed, syscalls=None):
+    wall, cpu = elapsed
+    return {"method": name, "protocol": protocol, "batch": batch, "messages": n, "messagesPerSec": n / wall,
+            "cpuUsPerMessage": cpu / n * 1e6, "syscalls": syscalls if syscalls is not None else n}
+
+def benchmark_udp(messages, batches):
+    results = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver:
+        receiver.bind(("127.0.0.1", 0))
+        address = receiver.getsockname()
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            def original():
+                for msg in messages:
+                    sock.sendto(msg.encode('utf-8'), address)
+            results.append(result("sendto", "udp", 1, len(messages), timed(original)))
+
+        for useSendmmsg in (False, True):
+            if useSendmmsg and transport._sendmmsg is None:
+                print("sendmmsg is not available")
+                continue
+            for batch in batches:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sender = transport.UdpBatchSender(sock, address, batch, useSendmmsg=useSendmmsg)
+                    def batched():
+                        for i0 in range(0, len(messages), batch):
+                            for msg in messages[i0:i0 + batch]:
+                                sender.add(msg.encode('utf-8'))
+                            sender.flush()
+                    elapsed = timed(batched)
+                name = "UdpBatchSender, " + ("sendmmsg" if useSendmmsg else "sendto")
+                results.append(result(name, "udp", batch, len(messages), elapsed, sender.syscalls))
+    return results
+
+# Runs `send(conn)` with `conn` connected to a thread that reads and discards everything.
+def with_tcp_connection(send):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        def drain():
+            with socket.create_connection(listener.getsockname()) as reader:
+                buffer = bytearray(1 << 20)
+                while reader.recv_into(buffer):
+                    pass
+        thread = threading.Thread(target=drain)
+        thread.start()
+        conn, _ = listener.accept()
+        with conn:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            elapsed = send(conn)
+            conn.shutdown(socket.SHUT_WR)
+        thread.join()
+    return elapsed
+
+def benchmark_tcp(messages, batches):
+    results = []
+    def original(conn):
+        def send():
+            for msg in messages:
+                conn.sendall(msg.encode('utf-8'))
+        return timed(send)
+    results.append(result("sendall", "tcp", 1, len(messages), with_tcp_connection(original)))
+
+    for batch in batches:
+        senders = []
+        def coalesced(conn):
+            sender = transport.TcpCoalescingSender(conn)
+            senders.append(sender)
+            def send():
+                for i0 in range(0, len(messages), batch):
+                    for msg in messages[i0:i0 + batch]:
+                        sender.add(msg.encode('utf-8'))
+                    sender.flushIfDue()
+                sender.flush()
+            return timed(send)
+        elapsed = with_tcp_connection(coalesced)
+        results.append(result("TcpCoalescingSender", "tcp", batch, len(messages), elapsed, senders[0].syscalls))
+    return results
+
+def benchmark_transport(args):
+    messages = synthetic_messages(args.messages, args.size)
+    report = benchmark_udp(messages, args.batch) + benchmark_tcp(messages, args.batch)
+    for r in report:
+        print(f"{r['protocol']} {r['method']:<28} batch {r['batch']:>4}: {r['messagesPerSec']:>10,.0f} messages/s, "
+              f"{r['cpuUsPerMessage']:6.2f} CPU usec/message, {r['syscalls']:>8} sends")
+    return report, False
+
+# Returns the number of valid and invalid messages in `b`, in the ad hoc format, as
+# `ExampleReadingSocket` would parse them.
+def decode_adhoc(b):
+    valid = 0
+    messages = ioutilities.separateMessages(b, header=b"J")
+    for i0, _ in messages:
+        for n in range(1, 8):
+            split = ioutilities.nthSplit(b, b" ", i0, n)
+            if split is None:
+                break
+            _, ok = (ioutilities.parseLong if n == 1 else ioutilities.parseDouble)(b, *split)
+            if not ok:
+                break
+        else:
+            valid += 1
+    return valid, len(messages) - valid
+
+# Returns the number of valid and invalid messages in `b`, in the JSON format, checking the `type`
+# as `ExampleReadingSocket` does.
+def decode_json(b, decoder=json.JSONDecoder()):
+    valid = 0
+    messages = ioutilities.separateMessages(b, terminator=b"\n")
+    for i0, length in messages:
+        try:
+            msg, _ = decoder.raw_decode(b[i0:i0 + length].decode("ascii"))
+        except (ValueError, UnicodeDecodeError):
+            continue
+        if isinstance(msg, dict) and msg.get("type") in ("pose", "scale"):
+            valid += 1
+    return valid, len(messages) - valid
+
+# Returns the number of valid and invalid messages in `b`, in the binary format, and the bytes of
+# an incomplete record at the end, to be prepended to the next read.
+def decode_binary(b):
+    valid = 0
+    invalid = 0
+    i = 0
+    sizes = {ExampleWritingSocket.BINARY_TYPE_POSE: ExampleWritingSocket.BINARY_POSE.size,
+             ExampleWritingSocket.BINARY_TYPE_SCALE: ExampleWritingSocket.BINARY_SCALE.size}
+    while len(b) - i >= 3:
+        size = int.from_bytes(b[i:i + 2], "little")
+        if sizes.get(b[i + 2]) != size:
+            # Not the start of a record, so nothing more in `b` can be trusted.
+            return valid, invalid + 1, b""
+        if len(b) - i < size:
+            break
+        valid += 1
+        i += size
+    return valid, invalid, b[i:]
+
+# Returns `n` encoded messages of `format`, and the CPU time taken to encode them.
+def encoded_messages(format, n):
+    args = argparse.Namespace(count=2000, scale=5, useJson=(format == "json"))
+    encode = {"adhoc": lambda i: ExampleWritingSocket.message(i, args).encode('utf-8'),
+              "json": lambda i: ExampleWritingSocket.message(i, args).encode('utf-8'),
+              "binary": lambda i: ExampleWritingSocket.binaryMessage(i, args)}[format]
+    cpu = time.process_time()
+    messages = [encode(i % args.count) for i in range(n)]
+    return messages, time.process_time() - cpu
+
+# Returns the CPU time taken to decode `payloads`, and the numbers of valid and invalid messages.
+def decoded_payloads(format, payloads):
+    valid = 0
+    invalid = 0
+    cpu = time.process_time()
+    for payload in payloads:
+        if format == "binary":
+            v, i, _ = decode_binary(payload)
+        else:
+            v, i = (decode_adhoc if format == "adhoc" else decode_json)(payload)
+        valid += v
+        invalid += i
+    return time.process_time() - cpu, valid, invalid
+
+# The receiver process: reads messages with the reference reader until the sender closes the
+# connection (TCP), or until the sender signals that it is done and nothing more arrives (UDP),
+# and then sends back the numbers of valid and invalid messages, and its CPU time.
+def receive(format, protocol, readBufferBytes, conn):
+    socketType = socket.SOCK_DGRAM if protocol == "udp" else socket.SOCK_STREAM
+    valid = 0
+    invalid = 0
+    with socket.socket(socket.AF_INET, socketType) as sock:
+        sock.bind(("127.0.0.1", 0))
+        if protocol == "tcp":
+            sock.listen()
+        conn.send(sock.getsockname()[1])
+        if protocol == "tcp":
+            sock, _ = sock.accept()
+        sock.settimeout(0.25)
+        cpu = time.process_time()
+        buffer = bytearray(readBufferBytes)
+        remainder = b""
+        while True:
+            try:
+                n = sock.recv_into(buffer)
+            except socket.timeout:
+                if conn.poll():
+                    break
+                continue
+            if n == 0:
+                break
+            data = bytes(buffer[:n])
+            if format == "binary":
+                v, i, remainder = decode_binary(remainder + data if protocol == "tcp" else data)
+            else:
+                v, i = (decode_adhoc if format == "adhoc" else decode_json)(data)
+            valid += v
+            invalid += i
+        cpu = time.process_time() - cpu
+        if protocol == "tcp":
+            sock.close()
+    conn.send((valid, invalid, cpu))
+
+def benchmark_format(args, format, protocol, rateHz, batch, messages, encodeSecs, decodeSecs):
+    n = len(messages) if rateHz == 0 else min(len(messages), max(round(rateHz * args.seconds), batch))
+    payloads = [b"".join(messages[i:min(i + batch, n)]) for i in range(0, n, batch)]
+
+    conn, childConn = multiprocessing.Pipe()
+    receiver = multiprocessing.Process(target=receive, args=(format, protocol, args.read_buffer, childConn))
+    receiver.start()
+    port = conn.recv()
+    socketType = socket.SOCK_DGRAM if protocol == "udp" else socket.SOCK_STREAM
+    with socket.socket(socket.AF_INET, socketType) as sock:
+        if protocol == "udp":
+            address = ("127.0.0.1", port)
+            send = lambda payload: sock.sendto(payload, address)
+        else:
+            sock.connect(("127.0.0.1", port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            send = sock.sendall
+        start = time.perf_counter()
+        if rateHz == 0:
+            for payload in payloads:
+                send(payload)
+        else:
+            for i in transport.Scheduler(rateHz / batch).ticks(len(payloads)):
+                send(payloads[i])
+        wall = time.perf_counter() - start
+    conn.send("done")
+    valid, invalid, receiverCpu = conn.recv()
+    receiver.join()
+
+    return {"format": format, "transport": protocol, "rateHz": rateHz, "batch": batch, "messages": n,
+            "messagesPerSec": n / wall, "bytesPerSec": sum(len(p) for p in payloads) / wall,
+            "bytesPerMessage": sum(len(m) for m in messages) / len(messages),
+            "encodeUsPerMessage": encodeSecs / len(messages) * 1e6, "decodeUsPerMessage": decodeSecs / len(messages) * 1e6,
+            "receiverUsPerMessage": receiverCpu / max(valid + invalid, 1) * 1e6,
+            "valid": valid, "invalid": invalid, "lossFraction": 1 - valid / n}
+
+def benchmark_formats(args):
+    report = []
+    failed = False
+    for format in args.format:
+        messages, encodeSecs = encoded_messages(format, args.messages)
+        for batch in args.batch:
+            payloads = [b"".join(messages[i:i + batch]) for i in range(0, len(messages), batch)]
+            decodeSecs, valid, invalid = decoded_payloads(format, payloads)
+            if valid + invalid != len(messages):
+                print(f"The reference reader found {valid + invalid} {format} messages instead of {len(messages)}")
+                failed = True
+            for protocol in args.transport:
+                for rateHz in args.rate:
+                    r = benchmark_format(args, format, protocol, rateHz, batch, messages, encodeSecs, decodeSecs)
+                    print(f"{r['format']:<6} {r['transport']} {r['rateHz']:>6g} Hz batch {r['batch']:>3}: "
+                          f"{r['messagesPerSec']:>10,.0f} messages/s, {r['bytesPerSec']:>12,.0f} bytes/s, "
+                          f"encode {r['encodeUsPerMessage']:5.2f}, decode {r['decodeUsPerMessage']:5.2f}, "
+                          f"receiver {r['receiverUsPerMessage']:5.2f} CPU usec/message, {r['lossFraction']:6.1%} lost")
+                    report.append(r)
+    return report, failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--report", help="path for a JSON report of the results")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    transport_parser = subparsers.add_parser("transport", help="batched sending versus one send per message")
+    transport_parser.set_defaults(messages=200000)
+    transport_parser.add_argument("--messages", "-n", type=int, help="number of messages to send")
+    transport_parser.set_defaults(size=200)
+    transport_parser.add_argument("--size", "-s", type=int, help="approximate message size (bytes)")
+    transport_parser.set_defaults(batch=[1, 8, 64])
+    transport_parser.add_argument("--batch", "-b", type=int, nargs="+", help="batch sizes to try")
+
+    formats_parser = subparsers.add_parser("formats", help="message formats, transports, rates and payload sizes")
+    formats_parser.set_defaults(format=["adhoc", "json", "binary"])
+    formats_parser.add_argument("--format", "-f", nargs="+", choices=["adhoc", "json", "binary"], help="message formats to try")
+    formats_parser.set_defaults(transport=["udp", "tcp"])
+    formats_parser.add_argument("--transport", "-t", nargs="+", choices=["udp", "tcp"], help="transports to try")
+    formats_parser.set_defaults(rate=[240, 1000, 0])
+    formats_parser.add_argument("--rate", "-r", type=float, nargs="+", help="message rates to try (Hz, with 0 for as fast as possible)")
+    formats_parser.set_defaults(batch=[1, 16])
+    formats_parser.add_argument("--batch", "-b", type=int, nargs="+", help="numbers of messages per payload to try")
+    formats_parser.set_defaults(messages=100000)
+    formats_parser.add_argument("--messages", "-n", type=int, help="number of messages to send as fast as possible, and to encode and decode")
+    formats_parser.set_defaults(seconds=1)
+    formats_parser.add_argument("--seconds", "-s", type=float, help="duration of each run at a fixed rate (sec)")
+    formats_parser.set_defaults(read_buffer=1024)
+    formats_parser.add_argument("--read-buffer", type=int, help="receiver read size, like the `SocketReader` buffer (bytes)")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "transport":
+        report, failed = benchmark_transport(args)
+    elif args.benchmark == "formats":
+        report, failed = benchmark_formats(args)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"benchmark": args.benchmark, "results": report}, f, indent=2)
+    sys.exit(1 if failed else 0)
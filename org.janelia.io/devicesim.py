@@ -0,0 +1,293 @@
+# A framework for Python scripts that simulate devices sending data over sockets: FakeTrac.py (in
+# the org.janelia.fictrac package), ExampleWritingSocket.py (in this package) and
+# fake-rtde-controller.py (in the org.janelia.ur package).  Each script defines its device as a
+# `Device`, with its own encoding of messages, and uses `run()` to send the messages with the
+# shared parts here: the command-line arguments for sockets and pacing, the outputs (UDP, or TCP
+# with any number of clients), and one asyncio event loop paced by `transport.py`.  Only the
+# standard library is needed.  Scripts in other packages import this module by adding this
+# directory to `sys.path`.
+#
+# Run as a script, it simulates a "rig" of several devices at once, from one process with
+# consistent timing, each given by the name of its script and that script's arguments:
+# python devicesim.py --device "fictrac --port 2000 --rate-hz 240" --device "rtde --port 30004 --trajectory moves" --device "pose --port 2010 --json"
+
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import os
+import shlex
+import socket
+import sys
+import time
+
+from transport import Scheduler, UdpBatchSender, asyncMergedBatches
+
+# Adds the command-line arguments shared by the scripts: the socket address and port, and the
+# timeout, and for a script that streams messages at a fixed rate (rather than serving a protocol),
+# the choice of UDP or TCP and the pacing.  The `delay` is the default time between messages.
+def addArguments(parser, port=2000, streams=True, delayMs=4):
+    parser.set_defaults(host="127.0.0.1")
+    parser.add_argument("--addr", "-a", dest="host", help="socket host")
+    parser.set_defaults(port=port)
+    parser.add_argument("--port", "-p", type=int, dest="port", help="socket port")
+    parser.set_defaults(timeout=30)
+    parser.add_argument("--timeout", "-t", type=int, dest="timeout",
+        help="server listening timeout (sec)" if streams else "stop after having no clients for this long (sec)")
+    parser.set_defaults(spinUs=1000)
+    parser.add_argument("--spin", "-sp", type=int, dest="spinUs", help="spin instead of sleeping for this long before each message (usec)")
+    if not streams:
+        return
+    parser.set_defaults(useUDP=True)
+    parser.add_argument("--tcp", "-tcp", dest="useUDP", action="store_false", help="use TCP instead of UDP for the socket protocol")
+    # A 240 Hz frame rate is 1 / 240 s between frames, or 0.004167 s or about 4 ms between frames.
+    parser.set_defaults(delayMs=delayMs)
+    parser.add_argument("--delay", "-d", type=float, dest="delayMs", help="delay between messages (msec, may be fractional)")
+    parser.add_argument("--rate-hz", "-hz", type=float, dest="rateHz", help="message rate (Hz, may be fractional), overriding --delay")
+    parser.set_defaults(latePolicy="catchup")
+    parser.add_argument("--late", "-l", dest="latePolicy", choices=["catchup", "drop"], help="when behind schedule, send late messages immediately or drop them")
+    parser.set_defaults(maxBatch=64)
+    parser.add_argument("--batch", "-b", type=int, dest="maxBatch", help="with UDP, when behind schedule, send up to this many late messages with one system call")
+    parser.set_defaults(flushUs=0)
+    parser.add_argument("--flush-us", type=int, dest="flushUs", help="with TCP, combine the messages sent within this long into one write (usec)")
+
+# Returns the message rate from the arguments added by `addArguments`.
+def rateHz(args):
+    return args.rateHz if args.rateHz is not None else 1000 / args.delayMs
+
+# Sends UDP datagrams to a host and port, with the datagrams added between flushes sent together
+# (with one `sendmmsg` system call, where available).
+class UdpOutput:
+    def __init__(self, host, port, maxBatch=64):
+        self.host = host
+        self.port = port
+        self.maxBatch = maxBatch
+        self.sock = None
+        self.sender = None
+        self.connected = None
+
+    async def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender = UdpBatchSender(self.sock, (self.host, self.port), self.maxBatch)
+        print("[{}] Server will send to {}".format(datetime.datetime.now(), (self.host, self.port)))
+
+    def add(self, msg):
+        self.sender.add(msg)
+
+    def flushIfDue(self):
+        self.sender.flush()
+
+    def flush(self):
+        self.sender.flush()
+
+    async def close(self):
+        if self.sock:
+            self.sock.close()
+
+# Serves a TCP stream to any number of clients on a port, which may connect and disconnect at any
+# time.  The messages added between flushes (or within `flushIntervalNs` of the first of them) are
+# copied together and written to each client with one call, and a client that is not keeping up
+# is disconnected rather than slowing down the others.
+class TcpServerOutput:
+    # Maximum data waiting to be sent to a TCP client that is not keeping up, before dropping it.
+    MAX_CLIENT_BACKLOG = 1 << 20
+
+    def __init__(self, host, port, flushIntervalNs=0):
+        self.host = host
+        self.port = port
+        self.flushIntervalNs = flushIntervalNs
+        self.pending = bytearray()
+        self.firstPendingNs = None
+        self.clients = set()
+        self.connected = asyncio.Event()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._onClient, self.host, self.port)
+        print("[{}] Server listening, port {}".format(datetime.datetime.now(), self.port))
+
+    async def _onClient(self, reader, writer):
+        print("[{}] Server connected, port {}, address {}".format(datetime.datetime.now(), self.port,
+            writer.get_extra_info("peername")))
+        self.clients.add(writer)
+        self.connected.set()
+
+    def add(self, msg):
+        if not self.pending:
+            self.firstPendingNs = time.perf_counter_ns()
+        self.pending += msg
+
+    def flushIfDue(self):
+        if self.pending and time.perf_counter_ns() - self.firstPendingNs >= self.flushIntervalNs:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = bytes(self.pending)
+        self.pending.clear()
+        for writer in list(self.clients):
+            if writer.is_closing() or writer.transport.get_write_buffer_size() > self.MAX_CLIENT_BACKLOG:
+                self.clients.discard(writer)
+                writer.close()
+            else:
+                writer.write(data)
+
+    # Closes the connections once the data written to them has been sent (or the clients have stopped
+    # reading), so the last messages are not lost.
+    async def close(self):
+        if self.server:
+            self.server.close()
+        for writer in self.clients:
+            writer.close()
+        for writer in self.clients:
+            try:
+                await asyncio.wait_for(writer.wait_closed(), 1)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+
+# Returns the output for the arguments added by `addArguments`, with the port `port` if given.
+def output(args, port=None):
+    port = args.port if port is None else port
+    if args.useUDP:
+        return UdpOutput(args.host, port, args.maxBatch)
+    return TcpServerOutput(args.host, port, args.flushUs * 1000)
+
+# One stream of messages sent to an output, like the messages for one simulated animal.  A subclass
+# defines `messages`, which returns the messages (as bytes-like objects) for the indices `indices`
+# (a `range`).  The messages may be in a buffer that the stream reuses, since the output copies or
+# sends them before `messages` is called again.
+class Stream:
+    def __init__(self, output):
+        self.output = output
+        self.sent = 0
+
+    def messages(self, indices):
+        raise NotImplementedError
+
+    def send(self, indices):
+        for msg in self.messages(indices):
+            self.output.add(msg)
+        self.sent += len(indices)
+
+# A simulated device, which sends messages at a fixed rate, `count` of them at most (or without a
+# limit, by default).  By default, a device sends each message of each of its streams, which start
+# with the device, and a TCP stream waits for its first client before the device starts sending,
+# as a script would by accepting a connection.  A device that serves a protocol instead (like an
+# RTDE controller) overrides `start`, `send`, `finished` and `close`.
+class Device:
+    def __init__(self, name, rateHz, count=sys.maxsize, latePolicy="catchup", spinNs=1000000, maxBatch=64, streams=()):
+        self.name = name
+        self.scheduler = Scheduler(rateHz, latePolicy, spinNs)
+        self.count = count
+        self.maxBatch = maxBatch
+        self.streams = list(streams)
+
+    async def start(self, timeout=None):
+        for stream in self.streams:
+            await stream.output.start()
+        for stream in self.streams:
+            if stream.output.connected:
+                await asyncio.wait_for(stream.output.connected.wait(), timeout)
+
+    # Sends the messages with the indices `indices` (a `range`), which are due.
+    def send(self, indices):
+        for stream in self.streams:
+            stream.send(indices)
+
+    # Called after each call to `send`, and with `final` at the end, to send anything held back.
+    def flush(self, final=False):
+        for stream in self.streams:
+            if final:
+                stream.output.flush()
+            else:
+                stream.output.flushIfDue()
+
+    # Whether the device is done before sending `count` messages.
+    def finished(self):
+        return False
+
+    async def close(self):
+        for stream in self.streams:
+            await stream.output.close()
+
+    def report(self):
+        print("[{}] {} done with {} messages".format(datetime.datetime.now(), self.name, len(self.scheduler.latenessNs)))
+        self.scheduler.report()
+
+# Runs the devices from one asyncio event loop, each paced by its own scheduler, all starting at the
+# same time, until all are done.  The `timeout` is how long to wait for the first client of a TCP
+# stream.
+async def serve(devices, timeout=None):
+    for device in devices:
+        await device.start(timeout)
+    left = [device.count for device in devices]
+    ticks = asyncMergedBatches([device.scheduler for device in devices], left[:], [device.maxBatch for device in devices])
+    try:
+        async for due in ticks:
+            for k, indices in due:
+                devices[k].send(indices)
+                devices[k].flush()
+                left[k] -= len(indices)
+            if all(n <= 0 or device.finished() for n, device in zip(left, devices)):
+                break
+    finally:
+        await ticks.aclose()
+        for device in devices:
+            device.flush(True)
+            await device.close()
+
+# Runs the devices until all are done or the script is interrupted, and reports on each.
+def run(devices, timeout=None):
+    try:
+        asyncio.run(serve(devices, timeout))
+    except KeyboardInterrupt:
+        pass
+    for device in devices:
+        device.report()
+
+# The scripts that define devices, by the name used with `--device`, with their directories
+# relative to this one.  Each script has `argumentParser(prog)`, which returns its
+# `argparse.ArgumentParser`, and `makeDevice(args)`, which returns the `Device` for its arguments.
+# A script is loaded only when used, since some need NumPy.
+DEVICE_SCRIPTS = {
+    "fictrac": os.path.join("..", "org.janelia.fictrac", "FakeTrac.py"),
+    "pose": "ExampleWritingSocket.py",
+    "rtde": os.path.join("..", "org.janelia.ur", "fake-rtde-controller.py")
+}
+
+# Returns the module for the script of the device named `name`.
+def loadDeviceScript(name):
+    path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), DEVICE_SCRIPTS[name]))
+    if os.path.dirname(path) not in sys.path:
+        sys.path.insert(0, os.path.dirname(path))
+    moduleName = "devicesim_" + name
+    if moduleName not in sys.modules:
+        spec = importlib.util.spec_from_file_location(moduleName, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[moduleName] = module
+        spec.loader.exec_module(module)
+    return sys.modules[moduleName]
+
+# Returns the `Device` for `spec`, the name of a device followed by its script's arguments.
+def deviceFromSpec(spec):
+    name, *argv = shlex.split(spec)
+    if name not in DEVICE_SCRIPTS:
+        raise ValueError("Unknown device '{}' in '{}' (expected one of: {})".format(name, spec, ", ".join(DEVICE_SCRIPTS)))
+    script = loadDeviceScript(name)
+    return script.makeDevice(script.argumentParser(name).parse_args(argv))
+
+if __name__ == "__main__":
+    print("[{}] Rig starting".format(datetime.datetime.now()))
+
+    parser = argparse.ArgumentParser()
+    parser.set_defaults(deviceSpecs=[])
+    parser.add_argument("--device", "-dev", dest="deviceSpecs", action="append", required=True,
+        help="a device to simulate, as the name of its script ({}) followed by the script's arguments, in quotes (repeatable)".format(", ".join(DEVICE_SCRIPTS)))
+    parser.set_defaults(timeout=30)
+    parser.add_argument("--timeout", "-t", type=int, dest="timeout", help="how long to wait for the first client of each TCP device (sec)")
+    args = parser.parse_args()
+
+    devices = [deviceFromSpec(spec) for spec in args.deviceSpecs]
+    run(devices, args.timeout)
+    print("[{}] Rig done".format(datetime.datetime.now()))
@@ -0,0 +1,72 @@
+# The parsing of `IoUtilities` and the message separation of `SocketMessageReader`, in Python, for
+# reference receivers that check what the Unity code would make of a stream (e.g., the `--echo`
+# receiver of FakeTrac.py in the org.janelia.fictrac package, and benchmark.py in this package).
+# The results match the C# code, including what is rejected as invalid (e.g., scientific notation).
+# Only the standard library is needed.  Scripts in other packages import this module by adding
+# this directory to `sys.path`.
+
+# Returns the start index and length of the `n`th field after index `i0`, as `IoUtilities.NthSplit`,
+# or None if there are not that many fields (which the C# code does not handle).
+def nthSplit(b, separator, i0, n):
+    i = i0
+    for _ in range(n):
+        i = b.find(separator, i)
+        if i == -1:
+            return None
+        i += 1
+    j = b.find(separator, i)
+    return i, (j if j != -1 else len(b)) - i
+
+# Returns the field with the spaces trimmed, and the sign from any leading "-", as
+# `IoUtilities.StartEndSign`.
+def trimSign(b, i, length):
+    field = b[i:i + length]
+    if field.endswith(b"\0"):
+        field = field[:-1]
+    sign = 1
+    k = 0
+    while k < len(field) and field[k] in b"- ":
+        if field[k] == ord("-"):
+            sign = -sign
+        k += 1
+    return field[k:].rstrip(b" "), sign
+
+# Returns the value and whether it is valid, as `IoUtilities.ParseLong`.
+def parseLong(b, i, length):
+    digits, sign = trimSign(b, i, length)
+    if digits and not digits.isdigit():
+        return 0, False
+    return sign * int(digits or b"0"), True
+
+# Returns the value and whether it is valid, as `IoUtilities.ParseDouble`.
+def parseDouble(b, i, length):
+    digits, sign = trimSign(b, i, length)
+    whole, point, fraction = digits.partition(b".")
+    if (whole and not whole.isdigit()) or (fraction and not fraction.isdigit()):
+        return 0.0, False
+    return sign * float((whole or b"0") + b"." + (fraction or b"0")), True
+
+# Returns the start index and length of each message in `b`, the data from one read of a socket,
+# as `SocketMessageReader.SeparateMessages` and `GetNextMessage`.  With a `header` character, each
+# message starts at an occurrence of it and runs to the next one (or the end), and with a
+# `terminator`, each message runs up to (but not including) an occurrence of it, and anything
+# after the last occurrence is not a message.
+def separateMessages(b, header=None, terminator=None):
+    starts = []
+    if header is not None:
+        i = b.find(header)
+        while i != -1:
+            starts.append(i)
+            i = b.find(header, i + 1)
+        ends = starts[1:] + [len(b)]
+    else:
+        i = 0
+        j = b.find(terminator)
+        while j != -1:
+            starts.append(i)
+            i = j + 1
+            j = b.find(terminator, i)
+        # `GetNextMessage` gives each message the length up to the next message's start, so it
+        # includes the terminator, except for the last, which runs to the end of the data.
+        ends = starts[1:] + [len(b)]
+    return [(i, j - i) for i, j in zip(starts, ends)]
@@ -0,0 +1,317 @@
+# Support for Python scripts that send simulated device data over sockets (e.g., FakeTrac.py in the
+# org.janelia.fictrac package and ExampleWritingSocket.py in this package): pacing messages at a
+# fixed rate, and sending them with as few system calls as possible.  Only the standard library
+# is needed.  Scripts in other packages import this module by adding this directory to `sys.path`.
+
+import array
+import asyncio
+import ctypes
+import datetime
+import os
+import socket
+import statistics
+import struct
+import sys
+import time
+
+# Paces messages at a fixed rate against absolute deadlines from `time.perf_counter_ns()`, so the
+# time taken to build and send each message, and any oversleeping, does not make the rate drift.
+# It sleeps until shortly before each deadline and then spins for the rest, because `time.sleep()`
+# alone can oversleep by a millisecond or more.  If sending falls behind, the "catchup" policy
+# sends the late messages immediately, and the "drop" policy skips them, as a real tracker drops
+# camera frames.
+class Scheduler:
+    def __init__(self, rateHz, latePolicy="catchup", spinNs=1000000):
+        self.periodNs = round(1e9 / rateHz)
+        self.latePolicy = latePolicy
+        self.spinNs = spinNs
+        # For each message sent, how late it was relative to its deadline.
+        self.latenessNs = array.array("q")
+        self.dropped = 0
+        self.startNs = None
+        self.endNs = None
+
+    # Waits until `deadlineNs`, a time from `time.perf_counter_ns()`.
+    def _waitUntil(self, deadlineNs):
+        while True:
+            remainingNs = deadlineNs - time.perf_counter_ns()
+            if remainingNs <= 0:
+                return
+            if remainingNs > self.spinNs:
+                time.sleep((remainingNs - self.spinNs) / 1e9)
+
+    # Like `_waitUntil`, but lets other asyncio tasks run while sleeping.
+    async def _asyncWaitUntil(self, deadlineNs):
+        while True:
+            remainingNs = deadlineNs - time.perf_counter_ns()
+            if remainingNs <= 0:
+                return
+            if remainingNs > self.spinNs:
+                await asyncio.sleep((remainingNs - self.spinNs) / 1e9)
+            else:
+                # A zero sleep still lets ready tasks (e.g., accepting a connection) run.
+                await asyncio.sleep(0)
+
+    # Called when the deadline for message `i` has passed, and returns the index of the message
+    # to send, which is later if messages are dropped.
+    def _due(self, i, count):
+        deadlineNs = self.startNs + i * self.periodNs
+        nowNs = time.perf_counter_ns()
+        if self.latePolicy == "drop" and nowNs - deadlineNs >= self.periodNs:
+            # Skip to the latest message whose deadline has passed.
+            latest = min((nowNs - self.startNs) // self.periodNs, count - 1)
+            self.dropped += latest - i
+            i = latest
+            deadlineNs = self.startNs + i * self.periodNs
+        self.latenessNs.append(nowNs - deadlineNs)
+        return i
+
+    # Yields the index of each message to send, from 0 to `count` - 1, when it is time to send it.
+    def ticks(self, count):
+        self.startNs = time.perf_counter_ns()
+        i = 0
+        while i < count:
+            self._waitUntil(self.startNs + i * self.periodNs)
+            i = self._due(i, count)
+            yield i
+            i += 1
+        self.endNs = time.perf_counter_ns()
+
+    # Yields the data from each (offsetNs, data) pair of `records` when it is time to send it,
+    # at `offsetNs` after the start divided by `speed`, or immediately if `speed` is 0.
+    def replay(self, records, speed=1.0):
+        self.startNs = time.perf_counter_ns()
+        for offsetNs, data in records:
+            if speed > 0:
+                deadlineNs = self.startNs + round(offsetNs / speed)
+                self._waitUntil(deadlineNs)
+                self.latenessNs.append(time.perf_counter_ns() - deadlineNs)
+            else:
+                self.latenessNs.append(0)
+            yield data
+        self.endNs = time.perf_counter_ns()
+
+    def stats(self):
+        sent = len(self.latenessNs)
+        elapsedSecs = (self.endNs - self.startNs) / 1e9 if self.endNs else 0
+        latenessUs = sorted(x / 1000 for x in self.latenessNs)
+        result = {
+            "targetRateHz": 1e9 / self.periodNs,
+            "achievedRateHz": (sent - 1) / elapsedSecs if sent > 1 and elapsedSecs > 0 else 0,
+            "sent": sent,
+            "dropped": self.dropped
+        }
+        if latenessUs:
+            result["latenessUs"] = {
+                "mean": statistics.fmean(latenessUs),
+                "stdev": statistics.pstdev(latenessUs),
+                "p50": latenessUs[len(latenessUs) // 2],
+                "p99": latenessUs[min(int(len(latenessUs) * 0.99), len(latenessUs) - 1)],
+                "max": latenessUs[-1]
+            }
+        return result
+
+    def report(self):
+        s = self.stats()
+        print("[{}] Target rate {:.2f} Hz, achieved {:.2f} Hz, {} sent, {} dropped".format(
+            datetime.datetime.now(), s["targetRateHz"], s["achievedRateHz"], s["sent"], s["dropped"]))
+        if "latenessUs" in s:
+            l = s["latenessUs"]
+            print("[{}] Lateness (usec): mean {:.1f}, stdev {:.1f}, p50 {:.1f}, p99 {:.1f}, max {:.1f}".format(
+                datetime.datetime.now(), l["mean"], l["stdev"], l["p50"], l["p99"], l["max"]))
+
+# Paces several schedulers, each with its own rate (and late policy), from one asyncio task, so
+# devices with different rates can be simulated together with consistent timing: the schedulers
+# all start at the same time, and each wait is for the earliest deadline of any of them.  After
+# each wait, yields a list of (k, range(i0, i1)) for the `k`th scheduler, for each scheduler with
+# messages due: all those whose deadlines have passed, up to `maxBatches[k]` of them, with the
+# "catchup" policy, so a sender that has fallen behind can send them together, or just the latest
+# with the "drop" policy.  The `k`th scheduler stops after `counts[k]` messages, and each
+# scheduler's statistics are kept as if it ran alone.
+async def asyncMergedBatches(schedulers, counts, maxBatches):
+    startNs = time.perf_counter_ns()
+    for scheduler in schedulers:
+        scheduler.startNs = startNs
+        scheduler.endNs = None
+    nexts = [0] * len(schedulers)
+    try:
+        while True:
+            active = [k for k in range(len(schedulers)) if nexts[k] < counts[k]]
+            if not active:
+                break
+            first = min(active, key=lambda k: nexts[k] * schedulers[k].periodNs)
+            await schedulers[first]._asyncWaitUntil(startNs + nexts[first] * schedulers[first].periodNs)
+            due = []
+            for k in active:
+                scheduler = schedulers[k]
+                if startNs + nexts[k] * scheduler.periodNs > time.perf_counter_ns():
+                    continue
+                i = scheduler._due(nexts[k], counts[k])
+                i1 = i + 1
+                if scheduler.latePolicy == "catchup":
+                    nowNs = time.perf_counter_ns()
+                    i1 = max(min((nowNs - startNs) // scheduler.periodNs + 1, counts[k], i + maxBatches[k]), i1)
+                    for j in range(i + 1, i1):
+                        scheduler.latenessNs.append(nowNs - (startNs + j * scheduler.periodNs))
+                due.append((k, range(i, i1)))
+                nexts[k] = i1
+                if i1 == counts[k]:
+                    scheduler.endNs = time.perf_counter_ns()
+            yield due
+    finally:
+        endNs = time.perf_counter_ns()
+        for scheduler in schedulers:
+            if scheduler.endNs is None:
+                scheduler.endNs = endNs
+
+# The `sendmmsg` system call from the C library, which sends several datagrams with one call, or
+# None if it is not available (e.g., on Windows or macOS).  Python's `socket` module has no
+# equivalent, so it is called through `ctypes` with the structures from `<sys/socket.h>`.
+class _IoVec(ctypes.Structure):
+    _fields_ = [("base", ctypes.c_void_p), ("len", ctypes.c_size_t)]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("name", ctypes.c_void_p), ("namelen", ctypes.c_uint32), ("iov", ctypes.POINTER(_IoVec)),
+                ("iovlen", ctypes.c_size_t), ("control", ctypes.c_void_p), ("controllen", ctypes.c_size_t),
+                ("flags", ctypes.c_int)]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("hdr", _MsgHdr), ("len", ctypes.c_uint)]
+
+def _findSendmmsg():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        f = getattr(ctypes.CDLL(None, use_errno=True), "sendmmsg", None)
+    except OSError:
+        return None
+    if f is not None:
+        f.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+        f.restype = ctypes.c_int
+    return f
+
+_sendmmsg = _findSendmmsg()
+
+# Sends UDP datagrams to one address, with each call to `flush()` sending the messages added since
+# the last call with one `sendmmsg` system call where available, and otherwise one `sendto` each.
+# For `sendmmsg`, the messages are joined into a preallocated buffer, and the `struct iovec` for
+# each is filled in with one `struct.pack_into`, because setting the fields of `ctypes` structures
+# one at a time costs more than the system calls saved.  A message longer than `maxMessageBytes`
+# is sent by itself.  The messages must not be modified until `flush()` returns.
+class UdpBatchSender:
+    def __init__(self, sock, address, maxBatch=64, maxMessageBytes=2048, useSendmmsg=True):
+        self.sock = sock
+        # The socket is not connected to the address, because then sending would fail if nothing
+        # was listening yet.
+        self.address = (socket.gethostbyname(address[0]), address[1])
+        self.maxBatch = maxBatch
+        self.maxMessageBytes = maxMessageBytes
+        self.pending = []
+        self.sent = 0
+        self.syscalls = 0
+        self.useSendmmsg = useSendmmsg and _sendmmsg is not None
+        if self.useSendmmsg:
+            self.buffer = bytearray(maxBatch * maxMessageBytes)
+            self.base = ctypes.addressof(ctypes.c_char.from_buffer(self.buffer))
+            # A `struct sockaddr_in`, with the family in native byte order and the port in network order.
+            self.sockaddr = ctypes.create_string_buffer(struct.pack("=H", socket.AF_INET) +
+                struct.pack(">H", self.address[1]) + socket.inet_aton(self.address[0]) + bytes(8))
+            self.iovecs = (_IoVec * maxBatch)()
+            self.msgs = (_MMsgHdr * maxBatch)()
+            for k in range(maxBatch):
+                self.msgs[k].hdr.name = ctypes.addressof(self.sockaddr)
+                self.msgs[k].hdr.namelen = 16
+                self.msgs[k].hdr.iov = ctypes.pointer(self.iovecs[k])
+                self.msgs[k].hdr.iovlen = 1
+            # For each batch size, the layout of that many `struct iovec` (a pointer and a `size_t`).
+            self.iovecLayouts = [struct.Struct("@" + "PN" * n) for n in range(maxBatch + 1)]
+            self.fields = [0] * (2 * maxBatch)
+
+    def add(self, msg):
+        if len(msg) > self.maxMessageBytes:
+            self.flush()
+            self.sock.sendto(msg, self.address)
+            self.sent += 1
+            self.syscalls += 1
+            return
+        self.pending.append(msg)
+        if len(self.pending) == self.maxBatch:
+            self.flush()
+
+    def flush(self):
+        n = len(self.pending)
+        if n == 1 or (n > 1 and not self.useSendmmsg):
+            for msg in self.pending:
+                self.sock.sendto(msg, self.address)
+            self.syscalls += n
+        elif n > 1:
+            data = b"".join(self.pending)
+            self.buffer[:len(data)] = data
+            lengths = list(map(len, self.pending))
+            fields = self.fields
+            fields[1:2 * n:2] = lengths
+            offset = self.base
+            for k in range(n):
+                fields[2 * k] = offset
+                offset += lengths[k]
+            self.iovecLayouts[n].pack_into(self.iovecs, 0, *fields[:2 * n])
+            done = 0
+            while done < n:
+                result = _sendmmsg(self.sock.fileno(), ctypes.byref(self.msgs[done]), n - done, 0)
+                self.syscalls += 1
+                if result < 0:
+                    error = ctypes.get_errno()
+                    raise OSError(error, os.strerror(error))
+                done += result
+        self.sent += n
+        self.pending.clear()
+
+# Sends messages over a TCP connection, coalescing the messages added within `flushIntervalNs`
+# of the first unsent one into one write, to reduce the number of system calls and TCP segments.
+# With an interval of 0, each call to `flushIfDue()` sends what has been added.  The messages are
+# written with one `sendmsg` (a gathering write, so they are not copied into one buffer first),
+# which happens early if they reach `maxPendingBytes` or `maxPendingCount` (less than the
+# `IOV_MAX` limit of 1024).  The connection has Nagle's algorithm disabled, so the coalescing here
+# bounds the delay.  The messages must not be modified until they are sent.
+class TcpCoalescingSender:
+    def __init__(self, conn, flushIntervalNs=0, maxPendingBytes=1 << 16, maxPendingCount=512):
+        self.conn = conn
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.flushIntervalNs = flushIntervalNs
+        self.maxPendingBytes = maxPendingBytes
+        self.maxPendingCount = maxPendingCount
+        self.pending = []
+        self.pendingBytes = 0
+        self.firstPendingNs = None
+        self.sent = 0
+        self.syscalls = 0
+
+    def add(self, msg):
+        if not self.pending:
+            self.firstPendingNs = time.perf_counter_ns()
+        self.pending.append(msg)
+        self.pendingBytes += len(msg)
+        self.sent += 1
+        if self.pendingBytes >= self.maxPendingBytes or len(self.pending) >= self.maxPendingCount:
+            self.flush()
+
+    # Sends what has been added, if the first of it was added at least the flush interval ago.
+    # Since this is called once per batch from the scheduler, the actual delay is at most the flush
+    # interval rounded up to the message period.
+    def flushIfDue(self):
+        if self.pending and time.perf_counter_ns() - self.firstPendingNs >= self.flushIntervalNs:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 1:
+            self.conn.sendall(self.pending[0])
+            self.syscalls += 1
+        elif self.pending:
+            done = self.conn.sendmsg(self.pending)
+            self.syscalls += 1
+            if done < self.pendingBytes:
+                # A partial write, when the socket's send buffer is full.
+                self.conn.sendall(memoryview(b"".join(self.pending))[done:])
+                self.syscalls += 1
+        self.pending.clear()
+        self.pendingBytes = 0
@@ -0,0 +1,317 @@
+# Benchmarks for simplify.py and logreader.py, using synthetic logs so no real log files are needed.
+
+# The "merge" benchmark compares the merge engine, `simplify.merge_stream`, with the reference
+# merge loop built from the per-entry functions `headers_match`, `skip`, `mergeable` and
+# `merge_into`, for logs with various numbers of keys per entry.  It checks that both give the
+# same result, and with `--min-speedup` it exits with an error if the engine is not at least
+# that much faster, to guard against performance regressions.  With `--jobs`, it also times
+# merging a log file with `simplify.simplify_parallel` using each number of processes, and reports
+# the wall-clock speedup over `simplify.simplify_stream`, checking that the outputs are the same.
+# python benchmark.py merge --entries 1000000 --keys 1 8 32 --min-speedup 2 --jobs 2 4 8
+
+# The "reader" benchmark compares `logreader.LogReader` with loading a log with `json.load`,
+# for reading all the entries as records, reading only the entries with a key, and reading a
+# range of frames, and compares the memory used for the records with that for dictionaries.
+# Reading all the entries is slower than `json.load`, and the advantage there is the memory, so
+# `--min-speedup` applies only to the reads of some of the entries, and it exits with an error if
+# they are not at least that much faster, or if the records do not use less memory.
+# python benchmark.py reader --entries 1000000 --keys 4 --min-speedup 2
+
+# The "compression" benchmark times merging a log with `simplify.simplify_stream` from start to
+# finish, with the log and the merged output compressed in each of the formats available (and
+# uncompressed), and with the output indented or compact, and reports the bytes on disk.
+# python benchmark.py compression --entries 10000000
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import logreader
+import simplify
+
+# Returns a list of `n` synthetic log entries, with 1 to `max_per_frame` entries per frame,
+# each having `keys` fields in addition to the header.  Some entries have a key that is
+# skipped, and some have keys conflicting with another entry for the same frame.  To keep
+# memory use low for large `n`, the list repeats a pool of distinct entries (merging does
+# not modify entries, so sharing them is safe).
+def synthetic_entries(n, keys, max_per_frame=6, pool_frames=10000, seed=0):
+    r = random.Random(seed)
+    pool = []
+    for frame in range(1, pool_frames + 1):
+        t = frame / 240
+        header = {"timeSecs": t, "frame": float(frame), "timeSecsAfterSplash": t, "frameAfterSplash": float(frame)}
+        for j in range(r.randint(1, max_per_frame)):
+            entry = dict(header)
+            c = r.random()
+            if c < 0.05:
+                entry["meshGameObjectPath"] = "World/Object" + str(r.randint(0, 9))
+            elif c < 0.1:
+                # Conflicts with the first entry of the frame.
+                entry.update({f"entry0_key{k}": r.random() for k in range(keys)})
+            else:
+                entry.update({f"entry{j}_key{k}": r.random() for k in range(keys)})
+            pool.append(entry)
+    return [pool[i % len(pool)] for i in range(n)]
+
+# The merge loop written with the per-entry functions, as the default mode of `simplify.py`
+# originally was.
+def merge_reference(json_orig, skippable):
+    json_result = []
+    n = len(json_orig)
+    i1 = 0
+    while i1 < n:
+        json1 = json_orig[i1]
+        json1_merged = json1.copy()
+        i2 = i1 + 1
+        if not simplify.skip(json1, skippable):
+            while i2 < n:
+                json2 = json_orig[i2]
+                if not simplify.headers_match(json1_merged, json2):
+                    break
+                if simplify.skip(json2, skippable):
+                    break
+                if simplify.mergeable(json1_merged, json2):
+                    simplify.merge_into(json1_merged, json2)
+                i2 += 1
+        i1 = i2
+        json_result.append(json1_merged)
+    return json_result
+
+# Writes the `entries` to `path` as Logger.cs does, with each entry formatted as by
+# `JsonUtility.ToJson(entry, true)`, and compressed according to the extension of `path`.
+def write_log(path, entries):
+    with logreader.open_log(path, "w") as f:
+        f.write("[\n")
+        for i, entry in enumerate(entries):
+            if i > 0:
+                f.write(",\n")
+            f.write(json.dumps(entry, indent=4))
+        f.write("\n]\n")
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def benchmark_merge(args):
+    skippable = ["meshGameObjectPath"]
+    report = []
+    failed = False
+    for keys in args.keys:
+        entries = synthetic_entries(args.entries, keys)
+        t_ref, result_ref = best_time(lambda: merge_reference(entries, skippable), args.repeat)
+        t_new, result_new = best_time(lambda: list(simplify.merge_stream(entries, skippable)), args.repeat)
+        if result_ref != result_new:
+            print(f"Results differ for {keys} keys per entry")
+            failed = True
+        speedup = t_ref / t_new
+        print(f"{keys:>4} keys/entry: reference {t_ref:.3f} s, engine {t_new:.3f} s, "
+              f"{args.entries / t_new:,.0f} entries/s, speedup {speedup:.2f}x")
+        report.append({"keysPerEntry": keys, "entries": args.entries, "referenceSecs": t_ref,
+                       "engineSecs": t_new, "speedup": speedup})
+        if args.min_speedup and speedup < args.min_speedup:
+            print(f"Speedup is below the minimum of {args.min_speedup}x")
+            failed = True
+        if args.jobs:
+            jobs_report, jobs_failed = benchmark_jobs(args, entries, skippable)
+            report += jobs_report
+            failed = failed or jobs_failed
+    return report, failed
+
+# Times merging the `entries`, written as a log file, with `simplify.simplify_stream` and with
+# `simplify.simplify_parallel` for each number of processes in `args.jobs`.
+def benchmark_jobs(args, entries, skippable):
+    report = []
+    failed = False
+    keys = len(entries[0]) - len(logreader.HEADER_KEYS)
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        input = os.path.join(directory, "log.json")
+        write_log(input, entries)
+        stream_output = os.path.join(directory, "stream-merged.json")
+        t_stream, _ = best_time(lambda: simplify.simplify_stream(input, stream_output, skippable, 0, verbose=False), args.repeat)
+        with open(stream_output, "rb") as f:
+            expected = f.read()
+        os.remove(stream_output)
+        print(f"{keys:>4} keys/entry: stream {t_stream:.3f} s, {os.path.getsize(input) / 1e6 / t_stream:,.1f} MB/s")
+        for jobs in args.jobs:
+            output = os.path.join(directory, f"jobs{jobs}-merged.json")
+
+            def merge_parallel():
+                # Without the progress messages.
+                with contextlib.redirect_stdout(io.StringIO()):
+                    simplify.simplify_parallel(input, output, skippable, jobs)
+
+            t_jobs, _ = best_time(merge_parallel, args.repeat)
+            with open(output, "rb") as f:
+                if f.read() != expected:
+                    print(f"Results differ for {keys} keys per entry with {jobs} jobs")
+                    failed = True
+            os.remove(output)
+            speedup = t_stream / t_jobs
+            print(f"{keys:>4} keys/entry: {jobs} jobs {t_jobs:.3f} s, speedup {speedup:.2f}x over stream "
+                  f"({os.cpu_count()} processor cores)")
+            report.append({"keysPerEntry": keys, "entries": len(entries), "jobs": jobs, "cores": os.cpu_count(),
+                           "streamSecs": t_stream, "jobsSecs": t_jobs, "speedup": speedup})
+    return report, failed
+
+# Returns the memory allocated by `func` for its result, per item in the result.
+def memory_per_item(func):
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / max(len(result), 1)
+
+def benchmark_reader(args):
+    report = []
+    failed = False
+    for keys in args.keys:
+        # No frames are repeated, so the frames are in order, as in a log from Logger.cs.
+        entries = synthetic_entries(args.entries, keys, pool_frames=args.entries)
+        # A record class for each kind of entry from `synthetic_entries`.
+        types = [type("MeshEntry", (logreader.Entry,), {"__slots__": ("meshGameObjectPath",)})]
+        types += [type(f"Entry{j}", (logreader.Entry,), {"__slots__": tuple(f"entry{j}_key{k}" for k in range(keys))}) for j in range(6)]
+        frames = (entries[len(entries) // 2]["frame"], entries[len(entries) // 2 + len(entries) // 10]["frame"])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "log.json")
+            write_log(path, entries)
+            del entries
+
+            def load(keep):
+                with open(path, "r") as f:
+                    return [d for d in json.load(f) if keep(d)]
+
+            cases = [
+                ("all", lambda: load(lambda d: True), lambda: list(logreader.LogReader(path, types))),
+                ("key", lambda: load(lambda d: "meshGameObjectPath" in d),
+                    lambda: list(logreader.LogReader(path, types[:1], other=None))),
+                ("frames", lambda: load(lambda d: frames[0] <= d["frame"] <= frames[1]),
+                    lambda: list(logreader.LogReader(path, types, frames=frames)))
+            ]
+            for name, load_dicts, load_records in cases:
+                t_dicts, dicts = best_time(load_dicts, args.repeat)
+                t_records, records = best_time(load_records, args.repeat)
+                if [record.frame for record in records] != [d["frame"] for d in dicts]:
+                    print(f"Results differ for {keys} keys per entry, reading {name}")
+                    failed = True
+                speedup = t_dicts / t_records
+                print(f"{keys:>4} keys/entry, {name:>6}: json.load {t_dicts:.3f} s, LogReader {t_records:.3f} s, speedup {speedup:.2f}x")
+                report.append({"keysPerEntry": keys, "entries": args.entries, "read": name, "jsonLoadSecs": t_dicts,
+                               "logReaderSecs": t_records, "speedup": speedup})
+                if args.min_speedup and name != "all" and speedup < args.min_speedup:
+                    print(f"Speedup is below the minimum of {args.min_speedup}x")
+                    failed = True
+                del dicts, records
+
+            bytes_dicts = memory_per_item(lambda: load(lambda d: True))
+            bytes_records = memory_per_item(lambda: list(logreader.LogReader(path, types)))
+            print(f"{keys:>4} keys/entry, memory: dicts {bytes_dicts:.0f} bytes/entry, records {bytes_records:.0f} bytes/entry, "
+                  f"{bytes_dicts / bytes_records:.2f}x less")
+            report.append({"keysPerEntry": keys, "entries": args.entries, "dictBytesPerEntry": bytes_dicts,
+                           "recordBytesPerEntry": bytes_records})
+            if args.min_speedup and bytes_records >= bytes_dicts:
+                print("Records do not use less memory than dictionaries")
+                failed = True
+    return report, failed
+
+# Returns the compression extensions whose Python packages are installed, including "" for none.
+def available_compressions():
+    available = [""]
+    for ext, package in logreader.COMPRESSIONS.items():
+        try:
+            __import__(package)
+            available.append(ext)
+        except ImportError:
+            print(f"Skipping {ext} compression, which needs the '{package}' package")
+    return available
+
+def benchmark_compression(args):
+    report = []
+    failed = False
+    entries = synthetic_entries(args.entries, args.keys[0], pool_frames=args.entries)
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        reference = None
+        for ext in available_compressions():
+            input = os.path.join(directory, "log.json" + ext)
+            write_log(input, entries)
+            input_bytes = os.path.getsize(input)
+            for compact in (False, True):
+                output = os.path.join(directory, ("compact" if compact else "indented") + "-merged.json" + ext)
+                t, _ = best_time(lambda: simplify.simplify_stream(input, output, ["meshGameObjectPath"], 0, verbose=False, compact=compact), args.repeat)
+                output_bytes = os.path.getsize(output)
+                with logreader.open_log(output) as f:
+                    records = list(logreader.iter_entries(f))
+                if reference is None:
+                    reference = records
+                elif records != reference:
+                    print(f"Results differ for {ext or 'no'} compression{', compact' if compact else ''}")
+                    failed = True
+                name = (ext or "none") + (", compact" if compact else "")
+                print(f"{name:>14}: {t:.3f} s, log {input_bytes / 1e6:,.1f} MB, merged {output_bytes / 1e6:,.1f} MB")
+                report.append({"compression": ext, "compact": compact, "entries": args.entries, "secs": t,
+                               "logBytes": input_bytes, "mergedBytes": output_bytes})
+                os.remove(output)
+            os.remove(input)
+    return report, failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--report", help="path for a JSON report of the results")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    merge_parser = subparsers.add_parser("merge", help="merge engine versus the reference merge loop")
+    merge_parser.set_defaults(entries=1000000)
+    merge_parser.add_argument("--entries", "-n", type=int, help="number of log entries")
+    merge_parser.set_defaults(keys=[1, 8, 32])
+    merge_parser.add_argument("--keys", "-k", type=int, nargs="+", help="numbers of keys per entry to try")
+    merge_parser.set_defaults(repeat=3)
+    merge_parser.add_argument("--repeat", "-r", type=int, help="report the best of this many runs")
+    merge_parser.set_defaults(min_speedup=0)
+    merge_parser.add_argument("--min-speedup", type=float, help="exit with an error if the speedup is less than this")
+    merge_parser.add_argument("--jobs", "-j", type=int, nargs="+", help="also time simplify.py --jobs with these numbers of processes, versus --stream")
+    merge_parser.add_argument("--directory", "-d", help="with --jobs, directory for the temporary files (default: the system's)")
+
+    reader_parser = subparsers.add_parser("reader", help="logreader.LogReader versus json.load")
+    reader_parser.set_defaults(entries=1000000)
+    reader_parser.add_argument("--entries", "-n", type=int, help="number of log entries")
+    reader_parser.set_defaults(keys=[1, 4])
+    reader_parser.add_argument("--keys", "-k", type=int, nargs="+", help="numbers of keys per entry to try")
+    reader_parser.set_defaults(repeat=3)
+    reader_parser.add_argument("--repeat", "-r", type=int, help="report the best of this many runs")
+    reader_parser.set_defaults(min_speedup=0)
+    reader_parser.add_argument("--min-speedup", type=float,
+        help="exit with an error if the speedup reading some of the entries is less than this, or the records use more memory")
+
+    compression_parser = subparsers.add_parser("compression", help="merging with compressed and uncompressed files")
+    compression_parser.set_defaults(entries=1000000)
+    compression_parser.add_argument("--entries", "-n", type=int, help="number of log entries")
+    compression_parser.set_defaults(keys=[4])
+    compression_parser.add_argument("--keys", "-k", type=int, nargs=1, help="number of keys per entry")
+    compression_parser.set_defaults(repeat=1)
+    compression_parser.add_argument("--repeat", "-r", type=int, help="report the best of this many runs")
+    compression_parser.add_argument("--directory", "-d", help="directory for the temporary files (default: the system's)")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "merge":
+        report, failed = benchmark_merge(args)
+    elif args.benchmark == "reader":
+        report, failed = benchmark_reader(args)
+    elif args.benchmark == "compression":
+        report, failed = benchmark_compression(args)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"benchmark": args.benchmark, "results": report}, f, indent=2)
+    sys.exit(1 if failed else 0)
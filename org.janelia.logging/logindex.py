@@ -0,0 +1,208 @@
+# Builds a sidecar index for a log file from Logger.cs (or a merged log from simplify.py),
+# for random access to the entries for a range of frames or times without parsing the whole log.
+
+# The index is built in a single pass, and is stored next to the log with the suffix ".idx".
+# It has one row for each frame, holding the frame number, the `timeSecs` of the frame's first
+# entry (or of the previous frame, if that entry has none), and the byte offset of that entry in
+# the log.  Queries use a binary search of the
+# memory-mapped index to find the byte range of the entries, and parse only those entries,
+# so their cost does not depend on the size of the log.
+
+# For example, to print the entries for frames 500000 through 500010:
+# python logindex.py --input Log_2024-01-01_12-00-00.json --frames 500000 500010
+
+# Or to use the index from Python:
+# from logindex import LogIndex
+# with LogIndex("Log_2024-01-01_12-00-00.json") as index:
+#     for entry in index.entries_between(500000, 500010):
+#         ...
+
+import argparse
+import array
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+
+from logreader import EntryParser, compression_of
+
+INDEX_MAGIC = b"JLOGIDX3"
+
+# The magic string, then the number of rows, and the size and modification time (in nanoseconds)
+# of the log when it was indexed.
+INDEX_HEADER = struct.Struct("<8sqqq")
+
+def index_path_for(log_path):
+    return log_path + ".idx"
+
+# The offsets in an index are positions in the log file, so a compressed log, which would have to
+# be decompressed from the start to reach an offset, cannot be indexed.
+def check_uncompressed(log_path):
+    if compression_of(log_path):
+        raise ValueError(f"Cannot index a compressed log: {log_path} (decompress it first)")
+
+# Builds the index for the log at `log_path`, and returns the path of the index.
+def build_index(log_path, index_path=None, chunk_size=1 << 20):
+    check_uncompressed(log_path)
+    if index_path is None:
+        index_path = index_path_for(log_path)
+
+    # The log's size and modification time from before reading it, so if it changes while being
+    # indexed, the index is not current.
+    stat = os.stat(log_path)
+    frames = array.array("d")
+    times = array.array("d")
+    offsets = array.array("q")
+    end = 0
+
+    # Decoding as Latin-1 makes each character one byte, so positions in the text are byte
+    # offsets in the file.  Any non-ASCII text is decoded incorrectly, but only the frames and
+    # times are used here.
+    parser = EntryParser()
+    with open(log_path, "r", encoding="latin-1", newline="") as f:
+        while True:
+            text = f.read(chunk_size)
+            if not text:
+                break
+            for entry, start, end in parser.feed_positions(text):
+                frame = entry.get("frame")
+                if frame is None:
+                    continue
+                if frames and frame == frames[-1]:
+                    continue
+                if frames and frame < frames[-1]:
+                    raise ValueError(f"Frame {frame} at byte {start} is before the previous frame {frames[-1]}")
+                # The times must be sorted for the binary search, so a frame whose first entry
+                # has no time (or a NaN time) gets the previous frame's time, which is no later
+                # than any of its entries' times.
+                time = entry.get("timeSecs", math.nan)
+                if math.isnan(time):
+                    time = times[-1] if times else -math.inf
+                frames.append(frame)
+                times.append(time)
+                offsets.append(start)
+    parser.close()
+    # The end of the last entry, so each row's entries end where the next row's begin.
+    offsets.append(end)
+
+    if sys.byteorder == "big":
+        for a in (frames, times, offsets):
+            a.byteswap()
+    with open(index_path, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(frames), stat.st_size, stat.st_mtime_ns))
+        frames.tofile(f)
+        times.tofile(f)
+        offsets.tofile(f)
+    return index_path
+
+# Random access to the entries of a log, using its index.  The index is built if it does
+# not exist or if the log has changed size or modification time since it was built (e.g., a
+# merged log written again with other options, which may have the same size).
+class LogIndex:
+    def __init__(self, log_path, index_path=None):
+        check_uncompressed(log_path)
+        self.log_path = log_path
+        if index_path is None:
+            index_path = index_path_for(log_path)
+        if not self._is_current(index_path):
+            build_index(log_path, index_path)
+
+        self._index_file = open(index_path, "rb")
+        self._mmap = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, _, _ = INDEX_HEADER.unpack_from(self._mmap)
+        view = memoryview(self._mmap)
+        i = INDEX_HEADER.size
+        if sys.byteorder == "little":
+            self._frames = view[i:i + 8 * n].cast("d")
+            self._times = view[i + 8 * n:i + 16 * n].cast("d")
+            self._offsets = view[i + 16 * n:i + 24 * n + 8].cast("q")
+        else:
+            self._frames = self._load_swapped(view[i:i + 8 * n], "d")
+            self._times = self._load_swapped(view[i + 8 * n:i + 16 * n], "d")
+            self._offsets = self._load_swapped(view[i + 16 * n:i + 24 * n + 8], "q")
+        self._log = open(log_path, "rb")
+
+    def _is_current(self, index_path):
+        if not os.path.exists(index_path):
+            return False
+        with open(index_path, "rb") as f:
+            header = f.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            return False
+        magic, _, log_size, log_mtime_ns = INDEX_HEADER.unpack(header)
+        stat = os.stat(self.log_path)
+        return magic == INDEX_MAGIC and log_size == stat.st_size and log_mtime_ns == stat.st_mtime_ns
+
+    @staticmethod
+    def _load_swapped(view, typecode):
+        a = array.array(typecode, view.tobytes())
+        a.byteswap()
+        return a
+
+    def __len__(self):
+        return len(self._frames)
+
+    # Parses the entries for index rows `i0` up to (but not including) `i1`.
+    def _entries(self, i0, i1):
+        if i0 >= i1:
+            return []
+        start = self._offsets[i0]
+        self._log.seek(start)
+        text = self._log.read(self._offsets[i1] - start).decode("utf-8")
+        parser = EntryParser(in_array=True)
+        entries = list(parser.feed(text))
+        parser.close(require_end=False)
+        return entries
+
+    # Returns the entries with frames from `frame_a` through `frame_b`, inclusive.
+    def entries_between(self, frame_a, frame_b):
+        i0 = bisect.bisect_left(self._frames, frame_a)
+        i1 = bisect.bisect_right(self._frames, frame_b)
+        return [e for e in self._entries(i0, i1) if "frame" in e and frame_a <= e["frame"] <= frame_b]
+
+    # Returns the entries with times (`timeSecs`) from `t0` through `t1`, inclusive.
+    def entries_at_time(self, t0, t1):
+        # A row's time is that of its first entry, so the row before the first with a time of at
+        # least `t0` may also have entries with later times.
+        i0 = max(bisect.bisect_left(self._times, t0) - 1, 0)
+        i1 = bisect.bisect_right(self._times, t1)
+        return [e for e in self._entries(i0, i1) if "timeSecs" in e and t0 <= e["timeSecs"] <= t1]
+
+    def close(self):
+        # The views must be released before the memory map can be closed.
+        self._frames = self._times = self._offsets = None
+        self._mmap.close()
+        self._index_file.close()
+        self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", "-i", help="path to log file")
+    parser.add_argument("--index", help="path for the index (default: the input path plus '.idx')")
+    parser.add_argument("--frames", type=float, nargs=2, metavar=("FIRST", "LAST"), help="print the entries for this range of frames")
+    parser.add_argument("--times", type=float, nargs=2, metavar=("FIRST", "LAST"), help="print the entries for this range of times (secs)")
+    args = parser.parse_args()
+    if compression_of(args.input):
+        parser.error(f"cannot index a compressed log: {args.input} (decompress it first)")
+
+    if args.frames is None and args.times is None:
+        print(f"Using input: {args.input}")
+        index_path = build_index(args.input, args.index)
+        print(f"Wrote index: {index_path}")
+    else:
+        with LogIndex(args.input, args.index) as index:
+            if args.frames is not None:
+                entries = index.entries_between(*args.frames)
+            else:
+                entries = index.entries_at_time(*args.times)
+            json.dump(entries, sys.stdout, indent=2)
+            print()
@@ -0,0 +1,515 @@
+# Reads log files from Logger.cs (or merged logs from simplify.py) lazily, as compact records
+# instead of dictionaries, for analysis code that would otherwise load a whole log with
+# `json.load`.  This is the Python counterpart of `Logger.Read<T>`.
+
+# A record class lists its fields in `__slots__`, and is registered with the keys that an entry
+# must have to be read as that class (by default, its own fields).  Fields not in the class are
+# ignored, as with `JsonUtility.FromJson<T>`.  For example:
+# from logreader import Entry, LogReader, register
+#
+# @register
+# class MeshEntry(Entry):
+#     __slots__ = ("meshGameObjectPath",)
+#
+# for record in LogReader("Log_2024-01-01_12-00-00.json", other=None, frames=(1000, 2000)):
+#     print(record.frame, record.meshGameObjectPath)
+
+# Entries are found in the text without being decoded, so the filters (`keys`, `frames` and
+# `times`) and the choice of class are applied first, and only the entries that pass are decoded.
+# So reading some of the entries is faster than `json.load`, but reading all of them is slower,
+# since the records are made from decoded dictionaries, and the advantage is the memory saved.
+# The log is read in chunks, so memory use does not depend on its size.
+
+import gzip
+import io
+import json
+import operator
+import os
+import queue
+import re
+import threading
+
+HEADER_KEYS = ("timeSecs", "frame", "timeSecsAfterSplash", "frameAfterSplash")
+
+# Returns the header values of an entry as a tuple, or raises `KeyError` if any is missing.
+header_values = operator.itemgetter(*HEADER_KEYS)
+
+# Incrementally parses a JSON array of entries, like the log written by Logger.cs, from text
+# that is fed to it in pieces.  Only the entries not yet complete are buffered, so memory use
+# does not depend on the size of the whole log.  With `in_array` true, the text starts inside
+# the array (after the opening '['), as for a piece of the log that begins at an entry.
+class EntryParser:
+    def __init__(self, in_array=False):
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        # The position in all the text fed so far of the start of the buffer.
+        self._base = 0
+        self._started = in_array
+        self._finished = False
+
+    # Whether the closing ']' of the array has been parsed.
+    @property
+    def finished(self):
+        return self._finished
+
+    # Adds `text` to the buffer and yields each entry that is now complete.
+    def feed(self, text):
+        for entry, _, _ in self.feed_positions(text):
+            yield entry
+
+    # Like `feed`, but yields each entry with its start and end positions in all the text fed so far.
+    def feed_positions(self, text):
+        if self._pos > 0:
+            self._buf = self._buf[self._pos:]
+            self._base += self._pos
+            self._pos = 0
+        self._buf += text
+
+        buf = self._buf
+        n = len(buf)
+        pos = self._pos
+        while not self._finished:
+            while pos < n and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == n:
+                break
+            c = buf[pos]
+            if not self._started:
+                if c != "[":
+                    raise ValueError(f"Expected '[' at the start of the log, found {c!r}")
+                self._started = True
+                pos += 1
+            elif c == "]":
+                self._finished = True
+                pos += 1
+            else:
+                try:
+                    entry, end = self._decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # Most likely the entry is not complete yet, so wait for more text.
+                    break
+                self._pos = end
+                yield entry, self._base + pos, self._base + end
+                pos = end
+        self._pos = pos
+
+    # Checks that the text fed so far ended with a complete entry, and also with the closing ']'
+    # unless `require_end` is false.
+    def close(self, require_end=True):
+        rest = self._buf[self._pos:].strip()
+        if rest and not self._finished:
+            # Decoding again raises the error that describes the problem.
+            self._decoder.raw_decode(rest)
+        if require_end and not self._finished:
+            raise ValueError("Log ended before the closing ']'")
+
+# Yields the entries of the log in file `f` one at a time, reading `chunk_size` characters
+# at a time.  The optional `progress` function is called with the number of characters read.
+def iter_entries(f, chunk_size=1 << 20, progress=None):
+    parser = EntryParser()
+    n_read = 0
+    while True:
+        text = f.read(chunk_size)
+        if not text:
+            break
+        n_read += len(text)
+        yield from parser.feed(text)
+        if progress:
+            progress(n_read)
+    parser.close()
+
+
+# Returns a function that makes a record of class `cls` from a decoded entry `d` and its header
+# values `header` (in the order of `HEADER_KEYS`).  The function is generated with a statement
+# assigning each field by name, which is several times faster than a loop calling `setattr`.
+def _record_maker(cls):
+    lines = ["def make(d, header):", "    record = new(cls)",
+             "    " + ", ".join(f"record.{name}" for name in HEADER_KEYS) + " = header"]
+    for name in cls.FIELDS[len(HEADER_KEYS):]:
+        lines.append(f"    record.{name} = {cls.COMPUTED.get(name, f'd.get({name!r})')}")
+    lines.append("    return record")
+    namespace = {"new": object.__new__, "cls": cls, "header_keys": frozenset(HEADER_KEYS)}
+    exec("\n".join(lines), namespace)
+    return namespace["make"]
+
+# The base class for records, with the fields that every entry has, as `Logger.Entry`.  A subclass
+# adds its fields in `__slots__`, and `KEYS` are the keys an entry must have to be read as the
+# subclass (by default, the fields the subclass adds).  A field missing from an entry is `None`.
+# A field in `COMPUTED` gets the value of that Python expression of the decoded entry `d`
+# instead.
+class Entry:
+    __slots__ = HEADER_KEYS
+    KEYS = ()
+    FIELDS = HEADER_KEYS
+    COMPUTED = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        slots = cls.__dict__.get("__slots__", ())
+        slots = (slots,) if isinstance(slots, str) else tuple(slots)
+        if "KEYS" not in cls.__dict__:
+            cls.KEYS = slots
+        cls.FIELDS = cls.FIELDS + slots
+        cls._make = staticmethod(_record_maker(cls))
+
+    # Returns the record for the decoded entry `d`.
+    @classmethod
+    def from_dict(cls, d):
+        return cls._make(d, tuple(map(d.get, HEADER_KEYS)))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.FIELDS)
+        return f"{type(self).__name__}({fields})"
+
+Entry._make = staticmethod(_record_maker(Entry))
+
+# The record for an entry not matching any registered class, with its other keys in the
+# dictionary `fields`.
+class OtherEntry(Entry):
+    __slots__ = ("fields",)
+    KEYS = ()
+    COMPUTED = {"fields": "{key: value for key, value in d.items() if key not in header_keys}"}
+
+# Raised when an entry is past the end of the frames or times to be read.
+class _PastEnd(Exception):
+    pass
+
+# The record classes registered with `register`, in the order they are tried.
+RECORD_TYPES = []
+
+# Registers the record class `cls`, for use as a decorator.
+def register(cls):
+    RECORD_TYPES.append(cls)
+    return cls
+
+# Returns the number in the text `s` of an undecoded entry after `marker` (the quoted key and
+# colon), or `None` if the key is missing or its value is not a number.
+def raw_number(s, marker):
+    i = s.find(marker)
+    if i == -1:
+        return None
+    i += len(marker)
+    j = s.find("\n", i)
+    try:
+        return float(s[i:j if j != -1 else len(s)].strip(" ,}"))
+    except ValueError:
+        return None
+
+# Reads the entries of the log at `path` lazily, as records, when iterated.  Each entry becomes
+# a record of the first class in `types` (by default, the registered classes) whose `KEYS` it
+# has, or else of class `other`, or is skipped if `other` is `None`.  Only the entries having all
+# the `keys`, and with frames (and times, `timeSecs`) in the inclusive ranges `frames` (and
+# `times`) are read.  Since Logger.cs writes entries in order, reading stops after the end of the
+# ranges.
+class LogReader:
+    def __init__(self, path, types=None, other=OtherEntry, keys=(), frames=None, times=None, chunk_size=1 << 20):
+        self.path = path
+        self.types = list(RECORD_TYPES if types is None else types)
+        self.other = other
+        self.keys = tuple(keys)
+        self.frames = frames
+        self.times = times
+        self.chunk_size = chunk_size
+        self._decode = json.JSONDecoder().raw_decode
+        self._key_markers = tuple(f'"{key}"' for key in self.keys)
+        # Matches the text of an entry that may have the keys of one of the `types`, for skipping
+        # the other entries without decoding them when `other` is `None`.
+        self._type_pattern = None
+        if other is None and all(cls.KEYS for cls in self.types):
+            self._type_pattern = re.compile("|".join(re.escape(f'"{cls.KEYS[0]}"') for cls in self.types) or "(?!)")
+
+    def __iter__(self):
+        with open_log(self.path) as f:
+            text = f.read(self.chunk_size)
+            # Logger.cs writes each entry with the opening and closing braces at the start of a
+            # line, and `json.dump(..., indent=2)` in simplify.py with them indented by two spaces,
+            # so entries are separated by closing and opening braces with that indentation.  Other
+            # layouts are decoded completely to find the entries.
+            match = re.match(r"\s*\[\s*?\n( *)\{\n", text)
+            if match:
+                indent = match.group(1)
+                yield from self._read_texts(self._entry_texts(f, text[match.end():], indent))
+            else:
+                yield from self._read_dicts(self._entry_dicts(f, text))
+
+    # Yields lists of the texts of the entries between their braces, one list for each chunk read,
+    # from the text `buf` after the opening brace of the first entry.
+    def _entry_texts(self, f, buf, indent):
+        separator = f"\n{indent}}},\n{indent}{{"
+        while True:
+            texts = buf.split(separator)
+            # The last entry may not be complete yet.
+            buf = texts.pop()
+            yield texts
+            more = f.read(self.chunk_size)
+            if not more:
+                break
+            buf += more
+        end = buf.rfind(f"\n{indent}}}")
+        # As with `Logger.Read`, an entry written in part is ignored.
+        if end != -1:
+            yield [buf[:end]]
+
+    def _entry_dicts(self, f, text):
+        parser = EntryParser()
+        while text:
+            yield from parser.feed(text)
+            text = f.read(self.chunk_size)
+        parser.close(require_end=False)
+
+    # Returns the class for the decoded entry `d`, or `None` if it is to be skipped.
+    def _record_type(self, d):
+        for cls in self.types:
+            for key in cls.KEYS:
+                if key not in d:
+                    break
+            else:
+                return cls
+        return self.other
+
+    # Whether the value is in the inclusive `bounds`, or raises `_PastEnd` if it is past them.
+    @staticmethod
+    def _in_bounds(value, bounds):
+        if value is None or value < bounds[0]:
+            return False
+        if value > bounds[1]:
+            raise _PastEnd
+        return True
+
+    # Yields the records for the lists of decoded entries `batches` that pass the `keys` filter.
+    # The entries for one frame share their header values, so the records do too, to save memory.
+    def _records(self, batches):
+        keys = self.keys
+        record_type = self._record_type
+        # The function making the record for each set of keys, in order, since an application
+        # logs only a few, or `None` to skip the entry.
+        makers = {}
+        header = None
+        for batch in batches:
+            for d in batch:
+                if keys and not all(key in d for key in keys):
+                    continue
+                signature = tuple(d)
+                make = makers.get(signature, False)
+                if make is False:
+                    cls = record_type(d)
+                    make = makers[signature] = cls._make if cls is not None else None
+                if make is None:
+                    continue
+                try:
+                    values = header_values(d)
+                except KeyError:
+                    values = tuple(map(d.get, HEADER_KEYS))
+                if values == header:
+                    values = header
+                else:
+                    header = values
+                yield make(d, values)
+
+    def _read_texts(self, texts):
+        key_markers = self._key_markers
+        type_pattern = self._type_pattern
+        frames = self.frames
+        times = self.times
+        in_bounds = self._in_bounds
+        decode = self._decode
+
+        # The entries that pass the filters are decoded together, which is faster than decoding
+        # each one separately.
+        def batches():
+            for batch in texts:
+                if not (key_markers or type_pattern or frames or times):
+                    if batch:
+                        yield decode("[{" + "},{".join(batch) + "}]", 0)[0]
+                    continue
+                passed = []
+                try:
+                    for s in batch:
+                        if key_markers and not all(marker in s for marker in key_markers):
+                            continue
+                        if type_pattern and not type_pattern.search(s):
+                            continue
+                        if frames and not in_bounds(raw_number(s, '"frame":'), frames):
+                            continue
+                        if times and not in_bounds(raw_number(s, '"timeSecs":'), times):
+                            continue
+                        passed.append(s)
+                except _PastEnd:
+                    if passed:
+                        yield decode("[{" + "},{".join(passed) + "}]", 0)[0]
+                    return
+                if passed:
+                    yield decode("[{" + "},{".join(passed) + "}]", 0)[0]
+
+        return self._records(batches())
+
+    def _read_dicts(self, dicts):
+        def batches():
+            try:
+                for d in dicts:
+                    if self.frames and not self._in_bounds(d.get("frame"), self.frames):
+                        continue
+                    if self.times and not self._in_bounds(d.get("timeSecs"), self.times):
+                        continue
+                    yield (d,)
+            except _PastEnd:
+                return
+
+        return self._records(batches())
+
+# Returns all the entries of the log at `path` as records of class `cls`, as `Logger.Read<T>`.
+def read(path, cls=OtherEntry):
+    return list(LogReader(path, types=[], other=cls))
+
+# The file extensions of compressed logs, and the Python packages needed for them, which are
+# imported only when used: gzip is in the standard library, and `zstandard` and `lz4` can be
+# installed with pip.
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstandard", ".lz4": "lz4"}
+
+# Returns the extension of the compression used for the file at `path`, or "" if it is not
+# compressed.
+def compression_of(path):
+    ext = os.path.splitext(path)[1].lower()
+    return ext if ext in COMPRESSIONS else ""
+
+# Returns `path` without the extension of any compression, and that extension, so
+# "Log.json.gz" gives ("Log.json", ".gz").
+def split_compression(path):
+    ext = compression_of(path)
+    return (path[:-len(ext)], path[-len(ext):]) if ext else (path, "")
+
+# Returns a binary stream that decompresses from or compresses to the file `f`, in binary `mode`
+# ("rb" or "wb"), with the compression for the extension `ext`.  Compressing with zstandard uses
+# all the processor cores.
+def _open_compressed(f, mode, ext, level=None):
+    if ext == ".gz":
+        return gzip.GzipFile(fileobj=f, mode=mode, compresslevel=(6 if level is None else level))
+    if ext == ".zst":
+        import zstandard
+        cctx = zstandard.ZstdCompressor(level=(3 if level is None else level), threads=-1) if mode == "wb" else None
+        return zstandard.open(f, mode, cctx=cctx)
+    import lz4.frame
+    return lz4.frame.open(f, mode, compression_level=(0 if level is None else level))
+
+# A binary stream for `io.BufferedReader`, with a thread that reads and decompresses blocks of
+# `compressed` ahead of their use.  The compression libraries release the GIL, so decompressing
+# overlaps with parsing.
+class _ThreadedReader(io.RawIOBase):
+    def __init__(self, compressed, f, block_size=1 << 20, depth=4):
+        self._compressed = compressed
+        self._f = f
+        self._blocks = queue.Queue(depth)
+        self._block = memoryview(b"")
+        self._done = False
+        self._error = None
+        self._stopping = False
+        self._thread = threading.Thread(target=self._read_ahead, args=(block_size,), daemon=True)
+        self._thread.start()
+
+    def _read_ahead(self, block_size):
+        try:
+            while not self._stopping:
+                block = self._compressed.read(block_size)
+                self._blocks.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self._error = e
+            self._blocks.put(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._block and not self._done:
+            self._block = memoryview(self._blocks.get())
+            if not self._block:
+                self._done = True
+                if self._error:
+                    raise self._error
+        n = min(len(b), len(self._block))
+        b[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stopping = True
+            # Makes room for the thread to finish a pending `put`.
+            while self._thread.is_alive():
+                try:
+                    self._blocks.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            self._compressed.close()
+            self._f.close()
+        super().close()
+
+# A binary stream for `io.BufferedWriter`, with a thread that compresses and writes the blocks
+# written to it, so compressing overlaps with merging.
+class _ThreadedWriter(io.RawIOBase):
+    def __init__(self, compressed, f, depth=4):
+        self._compressed = compressed
+        self._f = f
+        self._blocks = queue.Queue(depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_behind, daemon=True)
+        self._thread.start()
+
+    def _write_behind(self):
+        while True:
+            block = self._blocks.get()
+            if block is None:
+                break
+            if self._error is None:
+                try:
+                    self._compressed.write(block)
+                except Exception as e:
+                    self._error = e
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self._error:
+            raise self._error
+        self._blocks.put(bytes(b))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self._blocks.put(None)
+            self._thread.join()
+            self._compressed.close()
+            self._f.close()
+            if self._error:
+                raise self._error
+        super().close()
+
+# Opens the log at `path` as text, for reading (`mode` "r") or writing ("w"), compressed or not
+# according to its extension (see `COMPRESSIONS`).  A compressed log is read and written as a
+# stream, with the decompressing or compressing done in a separate thread, and `level` is the
+# compression level (by default, the usual one for the format: 6 for gzip, 3 for zstandard and
+# 0 for lz4).
+def open_log(path, mode="r", level=None, block_size=1 << 20):
+    ext = compression_of(path)
+    if not ext:
+        return open(path, mode, encoding="utf-8")
+    f = open(path, mode + "b")
+    compressed = _open_compressed(f, mode + "b", ext, level)
+    if mode == "r":
+        binary = io.BufferedReader(_ThreadedReader(compressed, f, block_size), block_size)
+    else:
+        binary = io.BufferedWriter(_ThreadedWriter(compressed, f), block_size)
+    text = io.TextIOWrapper(binary, encoding="utf-8")
+    text.log_file = f
+    return text
+
+# Returns how far into its file the log `f` from `open_log` has been read, in bytes of the file
+# (compressed or not), for showing progress.
+def log_position(f):
+    return getattr(f, "log_file", f.buffer).tell()
@@ -61,12 +61,27 @@
 # ]
 
 import argparse
+import array
+import collections
+import contextlib
+import glob
+import hashlib
 import json
+import math
+import multiprocessing
 import os
+import pstats
+import struct
 import sys
+import time
+
+from logreader import (COMPRESSIONS, HEADER_KEYS, EntryParser, compression_of, header_values, iter_entries, log_position, open_log,
+    split_compression)
+
+HEADER_KEY_SET = frozenset(HEADER_KEYS)
 
 def header_keys():
-    return ["timeSecs", "frame", "timeSecsAfterSplash", "frameAfterSplash"]
+    return list(HEADER_KEYS)
 
 def skip(json, skippable):
     for key in json.keys():
@@ -105,58 +120,1011 @@ def merge_into(json1_merged, json2):
     for key2, val2 in json2.items():
         json1_merged[key2] = val2
 
+# Yields the merged records for the `entries`, one record as soon as the entries for its frame
+# are complete.  Merging follows the rules of `headers_match`, `skip`, `mergeable` and `merge_into`,
+# but for speed those checks are done here with precomputed sets and header tuples, so the work
+# for each entry is proportional to its number of keys.  Merging stops after the record that uses
+# more than `limit` of the input entries (if `limit` is not 0).  Each record is also added to
+# `stats` (if not `None`), with the number of entries merged into it.
+def merge_stream(entries, skippable, limit=0, stats=None):
+    skippable = frozenset(skippable)
+    merged = None
+    # The header values of the entries being merged, or `None` if any header key is missing,
+    # in which case no other entry can be merged.
+    merged_header = None
+    n_used = 0
+    # The value of `n_used` before the first entry of `merged`.
+    first = 0
+    for entry in entries:
+        try:
+            header = header_values(entry)
+        except KeyError:
+            header = None
+
+        if merged is not None:
+            if header is not None and header == merged_header and skippable.isdisjoint(entry):
+                # Mergeable only if no key other than the headers is already present, and
+                # the entry is not an exact duplicate (in which case merging would do nothing).
+                if merged.keys().isdisjoint(entry.keys() - HEADER_KEY_SET) and merged != entry:
+                    merged.update(entry)
+                n_used += 1
+                continue
+            if stats is not None:
+                stats.add_record(merged, n_used - first)
+            yield merged
+            merged = None
+            if limit > 0 and n_used > limit:
+                return
+
+        first = n_used
+        n_used += 1
+        merged = entry.copy()
+        merged_header = header
+        if not skippable.isdisjoint(entry):
+            if stats is not None:
+                stats.add_record(merged, 1)
+            yield merged
+            merged = None
+            if limit > 0 and n_used > limit:
+                return
+
+    if merged is not None:
+        if stats is not None:
+            stats.add_record(merged, n_used - first)
+        yield merged
+
+# Returns the peak resident set size (memory in use) of this process, in bytes, or of its
+# finished child processes (e.g., the pool for `--jobs`) with `children`, or `None` if unknown.
+def peak_rss(children=False):
+    try:
+        import resource
+    except ImportError:
+        # On Windows, the peak working set is the equivalent (for this process only).
+        if children or sys.platform != "win32":
+            return None
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in ("PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage",
+                    "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage",
+                    "PeakPagefileUsage")]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # The units of `ru_maxrss` are bytes on macOS and kilobytes elsewhere.
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+# Collects statistics on merging, for finding which logs, and which parts of the work, are slow:
+# the time spent in each phase ("parse" for reading and decoding entries, "merge", and "serialize"
+# for encoding and writing records), the counts of entries and records, the records left unmerged
+# because of each key in `skippable`, and a histogram of the number of entries per frame.  Time is
+# charged to one phase at a time, the innermost one, using `phase` and `timed`.  The statistics
+# from worker processes are combined with `add`.  With `piece`, the records are from a piece of
+# the log, whose first and last frames may continue in the pieces before and after it, so those
+# frames are kept out of the histogram (as `head_frame` and the open frame), for `add` to
+# combine with the frames they continue.
+class Stats:
+    PHASES = ("parse", "merge", "serialize")
+
+    def __init__(self, skippable=(), piece=False):
+        self.skippable = frozenset(skippable)
+        self.start_secs = time.perf_counter()
+        self.wall_secs = None
+        self.phase_secs = dict.fromkeys(self.PHASES, 0.0)
+        self.entries = 0
+        self.records = 0
+        self.merged_records = 0
+        self.merged_entries = 0
+        self.skipped = collections.Counter()
+        self.entries_per_frame = collections.Counter()
+        self.peak_rss = None
+        self.peak_child_rss = None
+        self._phase = None
+        self._phase_start = self.start_secs
+        # The frame of the last record, and the number of entries in that frame so far.
+        self._frame = None
+        self._frame_entries = 0
+        self._piece = piece
+        # For a piece, the first frame and its number of entries, once a later frame has started.
+        self.head_frame = None
+
+    def add_record(self, record, n_entries):
+        self.records += 1
+        self.entries += n_entries
+        if n_entries > 1:
+            self.merged_records += 1
+            self.merged_entries += n_entries
+        elif not self.skippable.isdisjoint(record):
+            for key in self.skippable.intersection(record):
+                self.skipped[key] += 1
+        self._continue_frame(record.get("frame"), n_entries)
+
+    # Adds `n_entries` entries in `frame`, which continue the last frame if it is the same.
+    def _continue_frame(self, frame, n_entries):
+        if frame != self._frame or frame is None:
+            self._end_frame()
+            self._frame = frame
+        self._frame_entries += n_entries
+
+    def _end_frame(self):
+        if self._frame_entries > 0:
+            if self._piece and self.head_frame is None:
+                self.head_frame = (self._frame, self._frame_entries)
+            else:
+                self.entries_per_frame[self._frame_entries] += 1
+        self._frame_entries = 0
+
+    # Charges the time since the last switch to the current phase, and makes `phase` current.
+    # Returns the phase that was current.
+    def _switch(self, phase):
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.phase_secs[self._phase] += now - self._phase_start
+        self._phase_start = now
+        previous, self._phase = self._phase, phase
+        return previous
+
+    # A context manager charging the time in its body to `phase`.
+    @contextlib.contextmanager
+    def phase(self, phase):
+        previous = self._switch(phase)
+        try:
+            yield
+        finally:
+            self._switch(previous)
+
+    # Yields the items of `iterable`, charging the time spent getting each one to `phase`.
+    def timed(self, iterable, phase):
+        it = iter(iterable)
+        while True:
+            previous = self._switch(phase)
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self._switch(previous)
+            yield item
+
+    # Adds the statistics from `other`, for a `piece` of the log that follows the records added so
+    # far, finished in another process, except for the wall time.  A frame spanning the seam
+    # between them is counted once.
+    def add(self, other):
+        for phase, secs in other.phase_secs.items():
+            self.phase_secs[phase] += secs
+        self.entries += other.entries
+        self.records += other.records
+        self.merged_records += other.merged_records
+        self.merged_entries += other.merged_entries
+        self.skipped.update(other.skipped)
+        if other.head_frame is not None:
+            self._continue_frame(*other.head_frame)
+            self._end_frame()
+            self._frame = None
+        self.entries_per_frame.update(other.entries_per_frame)
+        if other._frame_entries > 0:
+            self._continue_frame(other._frame, other._frame_entries)
+
+    def finish(self):
+        self._switch(None)
+        # The last frame of a piece may continue in the next piece.
+        if not self._piece:
+            self._end_frame()
+            self._frame = None
+        self.wall_secs = time.perf_counter() - self.start_secs
+        self.peak_rss = peak_rss()
+        self.peak_child_rss = peak_rss(children=True)
+        return self
+
+    # Returns the statistics as a dictionary for JSON, for merging the log at `input` into
+    # `output` (a file or a directory).
+    def to_dict(self, input, output):
+        def size(path):
+            if os.path.isdir(path):
+                return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            return os.path.getsize(path) if os.path.exists(path) else 0
+
+        input_bytes = size(input)
+        wall_secs = max(self.wall_secs, 1e-9)
+        frames = sum(self.entries_per_frame.values())
+        return {
+            "input": os.path.abspath(input),
+            "output": os.path.abspath(output),
+            "inputBytes": input_bytes,
+            "outputBytes": size(output),
+            "wallSecs": self.wall_secs,
+            "phaseSecs": self.phase_secs,
+            "entries": self.entries,
+            "records": self.records,
+            "frames": frames,
+            "entriesPerSec": self.entries / wall_secs,
+            "inputMBPerSec": input_bytes / 1e6 / wall_secs,
+            "mergedRecords": self.merged_records,
+            "mergedEntries": self.merged_entries,
+            "skippedRecords": {key: self.skipped[key] for key in sorted(self.skippable)},
+            "entriesPerFrame": {str(n): count for n, count in sorted(self.entries_per_frame.items())},
+            "peakRssBytes": self.peak_rss,
+            "peakChildRssBytes": self.peak_child_rss
+        }
+
+# Returns `stats.phase(phase)`, or a context manager doing nothing if `stats` is `None`.
+def stats_phase(stats, phase):
+    return contextlib.nullcontext() if stats is None else stats.phase(phase)
+
+# Returns `stats.timed(iterable, phase)`, or just `iterable` if `stats` is `None`.
+def stats_timed(stats, iterable, phase):
+    return iterable if stats is None else stats.timed(iterable, phase)
+
+# Returns the text for one record as it appears inside the array written by
+# `json.dump(records, f, indent=2)`, or with `compact`, on one line without spaces.
+def encode_record(record, compact=False):
+    if compact:
+        return json.dumps(record, separators=(",", ":"))
+    return json.dumps(record, indent=2).replace("\n", "\n  ")
+
+# Returns the text between records in the array written by `RecordWriter`.
+def record_separator(compact=False):
+    return ",\n" if compact else ",\n  "
+
+# Writes records to `f` as a JSON array, one at a time, producing exactly the same text as
+# `json.dump(records, f, indent=2)` would for the whole list, or with `compact`, one record per
+# line without indentation or spaces, which is smaller and faster to write and read.  With `count`
+# greater than 0, `f` already holds that many records (but not the closing ']'), and writing
+# continues after them.
+class RecordWriter:
+    def __init__(self, f, count=0, compact=False):
+        self._f = f
+        self._count = count
+        self._compact = compact
+        self._separator = record_separator(compact)
+
+    @property
+    def count(self):
+        return self._count
+
+    def write(self, record):
+        self.write_encoded(encode_record(record, self._compact), 1)
+
+    # Writes `text` holding `count` records already encoded and joined with `record_separator`.
+    def write_encoded(self, text, count):
+        if count > 0:
+            self._f.write(("[\n" + self._separator[2:]) if self._count == 0 else self._separator)
+            self._f.write(text)
+            self._count += count
+
+    def close(self):
+        self._f.write("[]" if self._count == 0 else "\n]")
+
+# Writes a column of values as a NumPy ".npy" file, without needing NumPy.  Values are
+# buffered in an `array.array` of `typecode` and appended to the file in blocks.  The header
+# has room for any final length, and is rewritten with that length by `close`.
+class NpyColumnFile:
+    DESCRS = {"d": "<f8", "q": "<i8", "B": "|u1", "b": "|b1"}
+    HEADER_SIZE = 128
+
+    def __init__(self, path, typecode):
+        self.path = path
+        self.length = 0
+        self._descr = self.DESCRS[typecode]
+        # Booleans are stored as bytes.
+        self._buf = array.array("B" if typecode == "b" else typecode)
+        self.typecode = self._buf.typecode
+        self._f = open(path, "wb")
+        self._f.write(self._header())
+
+    def _header(self):
+        d = f"{{'descr': '{self._descr}', 'fortran_order': False, 'shape': ({self.length},), }}"
+        # The magic string, version 1.0, and the length of the rest, padded so data is aligned.
+        prefix_size = 10
+        d = d.ljust(self.HEADER_SIZE - prefix_size - 1) + "\n"
+        return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(d)) + d.encode("latin1")
+
+    def append(self, value):
+        self._buf.append(value)
+        if len(self._buf) >= 1 << 16:
+            self.flush()
+
+    def extend(self, values):
+        self._buf.extend(values)
+        if len(self._buf) >= 1 << 16:
+            self.flush()
+
+    def flush(self):
+        if sys.byteorder == "big" and self._buf.itemsize > 1:
+            self._buf.byteswap()
+        self._buf.tofile(self._f)
+        self.length += len(self._buf)
+        del self._buf[:]
+
+    # Returns all the values written so far, for rewriting the column with another type.
+    def read_all(self):
+        self.flush()
+        self._f.flush()
+        values = array.array(self.typecode)
+        with open(self.path, "rb") as f:
+            f.seek(self.HEADER_SIZE)
+            values.fromfile(f, self.length)
+        if sys.byteorder == "big" and values.itemsize > 1:
+            values.byteswap()
+        return values
+
+    def close(self):
+        self.flush()
+        self._f.seek(0)
+        self._f.write(self._header())
+        self._f.close()
+
+# One column of the output from `ColumnWriter`.  The kind of the column comes from its first value:
+# "float64", "int64" or "bool" are stored as ".npy" arrays, while "str" (UTF-8 text) and "json"
+# (JSON text, for lists and for values whose types vary) are stored as the concatenated bytes
+# in "NAME.bytes.npy" plus the offsets of each value in "NAME.offsets.npy".  The mask of rows
+# that have a value, in "NAME.mask.npy", is kept only for columns missing in some rows.
+class Column:
+    TYPECODES = {"float64": "d", "int64": "q", "bool": "b"}
+    FILLS = {"float64": math.nan, "int64": 0, "bool": 0}
+
+    def __init__(self, directory, name, kind):
+        self.name = name
+        self.kind = kind
+        self.length = 0
+        self._present = 0
+        self._directory = directory
+        self._mask = NpyColumnFile(self._path("mask"), "b")
+        self._open()
+
+    def _path(self, suffix=None):
+        return os.path.join(self._directory, self.name + ("." + suffix if suffix else "") + ".npy")
+
+    def _open(self):
+        if self.kind in self.TYPECODES:
+            self._values = NpyColumnFile(self._path(), self.TYPECODES[self.kind])
+        else:
+            self._values = NpyColumnFile(self._path("bytes"), "B")
+            self._offsets = NpyColumnFile(self._path("offsets"), "q")
+            self._offsets.append(0)
+            self._offset = 0
+
+    @staticmethod
+    def kind_of(value):
+        if isinstance(value, bool):
+            return "bool"
+        if isinstance(value, int):
+            return "int64" if -(1 << 63) <= value < (1 << 63) else "json"
+        if isinstance(value, float):
+            return "float64"
+        if isinstance(value, str):
+            return "str"
+        return "json"
+
+    def _append_value(self, value):
+        if self.kind in self.TYPECODES:
+            self._values.append(value)
+        else:
+            text = value if self.kind == "str" else json.dumps(value)
+            data = text.encode("utf-8")
+            self._values.extend(data)
+            self._offset += len(data)
+            self._offsets.append(self._offset)
+
+    def _fill(self, n):
+        if self.kind in self.TYPECODES:
+            self._values.extend(array.array(self._values.typecode, [self.FILLS[self.kind]]) * n)
+        else:
+            self._offsets.extend(array.array("q", [self._offset]) * n)
+        self._mask.extend(array.array("B", [0]) * n)
+        self.length += n
+
+    # Adds `value` for row `row`, after filling any rows skipped since the last value.
+    def append(self, row, value):
+        if row > self.length:
+            self._fill(row - self.length)
+        kind = self.kind_of(value)
+        if kind != self.kind:
+            if self.kind == "float64" and kind == "int64":
+                value = float(value)
+            elif self.kind == "int64" and kind == "float64":
+                self._promote("float64")
+            elif self.kind != "json":
+                self._promote("json")
+        self._append_value(value)
+        self._mask.append(1)
+        self.length += 1
+        self._present += 1
+
+    # Rewrites the values so far with the new `kind`, for when a later value has another type.
+    def _promote(self, kind):
+        if self.kind in self.TYPECODES:
+            old = list(self._values.read_all())
+            # Booleans are stored as bytes, so restore them, to stay `true` and `false` as JSON.
+            if self.kind == "bool":
+                old = [bool(value) for value in old]
+        else:
+            data = self._values.read_all().tobytes()
+            offsets = self._offsets.read_all()
+            old = [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+            self._offsets.close()
+            os.remove(self._offsets.path)
+            if self.kind == "json":
+                old = [json.loads(text) if text else None for text in old]
+        self._values.close()
+        os.remove(self._values.path)
+        mask = self._mask.read_all()
+
+        self.kind = kind
+        self._open()
+        for value, present in zip(old, mask):
+            if present:
+                self._append_value(float(value) if kind == "float64" else value)
+            elif kind in self.TYPECODES:
+                self._values.append(self.FILLS[kind])
+            else:
+                self._offsets.append(self._offset)
+
+    # Finishes the column with `rows` rows, and returns its description.
+    def close(self, rows):
+        if rows > self.length:
+            self._fill(rows - self.length)
+        self._values.close()
+        if self.kind not in self.TYPECODES:
+            self._offsets.close()
+        self._mask.close()
+        sparse = self._present < rows
+        if not sparse:
+            os.remove(self._mask.path)
+        return {"kind": self.kind, "sparse": sparse}
+
+COLUMNS_META = "columns.json"
+
+# Writes merged records as typed columns in `directory`, one ".npy" file per column, which can be
+# loaded with `numpy.load(path, mmap_mode="r")` to access a column without parsing anything else.
+# Nested objects are flattened, so the "x" field of "c" becomes column "c.x".  The file
+# "columns.json" describes the columns.
+class ColumnWriter:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._columns = {}
+        self._rows = 0
+
+    def _write_value(self, name, value):
+        if isinstance(value, dict):
+            for key, sub_value in value.items():
+                self._write_value(name + "." + key, sub_value)
+        elif value is not None:
+            column = self._columns.get(name)
+            if column is None:
+                column = Column(self._directory, name, Column.kind_of(value))
+                self._columns[name] = column
+            column.append(self._rows, value)
+
+    def write(self, record):
+        for key, value in record.items():
+            self._write_value(key, value)
+        self._rows += 1
+
+    def close(self):
+        meta = {"rows": self._rows, "columns": {}}
+        for name, column in self._columns.items():
+            meta["columns"][name] = column.close(self._rows)
+        with open(os.path.join(self._directory, COLUMNS_META), "w") as f:
+            json.dump(meta, f, indent=2)
+
+# Loads the column `name` from a directory written by `ColumnWriter`.  Numeric columns are
+# memory mapped, so only the parts used are read from disk.  Returns the values, and the mask
+# of rows having values (or `None` if every row has a value).  Requires NumPy.
+def load_column(directory, name):
+    import numpy
+
+    with open(os.path.join(directory, COLUMNS_META), "r") as f:
+        info = json.load(f)["columns"][name]
+    path = os.path.join(directory, name)
+    if info["kind"] in Column.TYPECODES:
+        values = numpy.load(path + ".npy", mmap_mode="r")
+    else:
+        data = numpy.load(path + ".bytes.npy", mmap_mode="r")
+        offsets = numpy.load(path + ".offsets.npy", mmap_mode="r")
+        texts = [bytes(data[offsets[i]:offsets[i + 1]]).decode("utf-8") for i in range(len(offsets) - 1)]
+        values = texts if info["kind"] == "str" else [json.loads(text) if text else None for text in texts]
+    mask = numpy.load(path + ".mask.npy", mmap_mode="r") if info["sparse"] else None
+    return values, mask
+
+# Merges the log in `input` one entry at a time, using constant memory.  Either file may be
+# compressed (see `logreader.open_log`), with `level` the compression level for the output.
+# Statistics are added to `stats`, if not `None`.
+def simplify_stream(input, output, skippable, limit, verbose=True, format="json", compact=False, level=None, stats=None):
+    size = os.path.getsize(input)
+    next_decile = [1]
+
+    def progress(n_read):
+        position = log_position(f_in)
+        while next_decile[0] <= 10 and position >= size * next_decile[0] / 10:
+            print(f"{next_decile[0] * 10}%")
+            next_decile[0] += 1
+
+    if verbose:
+        print("0%")
+    # The time not spent getting entries or merging them is spent on the output.
+    with stats_phase(stats, "serialize"), open_log(input) as f_in, \
+            (open_log(output, "w", level) if format == "json" else contextlib.nullcontext()) as f_out:
+        writer = RecordWriter(f_out, compact=compact) if format == "json" else ColumnWriter(output)
+        entries = stats_timed(stats, iter_entries(f_in, progress=(progress if verbose else None)), "parse")
+        for record in stats_timed(stats, merge_stream(entries, skippable, limit, stats), "merge"):
+            writer.write(record)
+        writer.close()
+
+# Follows a log that Logger.cs is still writing, like `tail -f`, parsing the entries as they are
+# appended.  The file is read from byte offset `offset` (after the opening '[', if not 0), and
+# when no more is available, `idle` is called and the file is polled again after `poll_secs`.
+# An entry that Logger.cs has written in part is parsed once the rest arrives, and so is a
+# character, since the text is decoded only up to the last ASCII byte read.  Following stops at
+# the closing ']' of the log, or if `timeout` is not 0, when nothing has been appended for that
+# long (e.g., if Unity stopped without writing the ']'), in which case any entry written in part
+# is ignored.
+class LogFollower:
+    def __init__(self, path, offset=0, poll_secs=0.005, chunk_size=1 << 20):
+        self.path = path
+        self.offset = offset
+        self.poll_secs = poll_secs
+        self.chunk_size = chunk_size
+        self._parser = EntryParser(in_array=(offset > 0))
+        # For each piece of text fed to the parser, its start position in all the text fed, its
+        # byte offset in the file, and the text itself if it is not ASCII (in which case positions
+        # and byte offsets do not correspond one to one).
+        self._pieces = collections.deque()
+        self._chars = 0
+
+    # Yields each entry appended to the log, with its start and end positions, until the closing
+    # ']' of the log.  The positions are in all the text parsed, and `byte_offset` converts them
+    # to byte offsets in the file.
+    def entries(self, idle=None, timeout=0):
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            # Bytes read after the last ASCII byte, which may be part of a character.
+            partial = b""
+            last_data = time.monotonic()
+            while not self._parser.finished:
+                data = f.read(self.chunk_size)
+                if not data:
+                    if os.fstat(f.fileno()).st_size < self.offset + len(partial):
+                        raise ValueError(f"Log {self.path} was truncated while being followed")
+                    if timeout > 0 and time.monotonic() - last_data >= timeout:
+                        print(f"Nothing appended to the log for {timeout} seconds, so stopping")
+                        return
+                    if idle:
+                        idle()
+                    time.sleep(self.poll_secs)
+                    continue
+                last_data = time.monotonic()
+                data = partial + data
+                end = len(data)
+                while end > 0 and data[end - 1] >= 0x80:
+                    end -= 1
+                partial = data[end:]
+                if end == 0:
+                    continue
+                text = data[:end].decode("utf-8")
+                self._pieces.append((self._chars, self.offset, None if len(text) == end else text))
+                self._chars += len(text)
+                self.offset += end
+                yield from self._parser.feed_positions(text)
+
+    # Returns the byte offset in the file of the position `pos` from `entries`.  Positions must
+    # be converted in increasing order, since the text before `pos` is then discarded.
+    def byte_offset(self, pos):
+        pieces = self._pieces
+        while len(pieces) > 1 and pieces[1][0] <= pos:
+            pieces.popleft()
+        if not pieces:
+            return self.offset
+        chars, offset, text = pieces[0]
+        if text is None:
+            return offset + pos - chars
+        return offset + len(text[:pos - chars].encode("utf-8"))
+
+# Merges the log in `input` while Logger.cs is still writing it, writing each merged record to
+# `output` as soon as the first entry of the next frame appears in the log, and continuing until the
+# log's closing ']' (or for `timeout`, as for `LogFollower`).  The output is flushed whenever the log
+# has no more to read, so it lags the log by about `poll_secs`.  A checkpoint, saved next to the
+# output at most every `checkpoint_secs` and whenever the log has no more to read, records the byte
+# offset in the log of the first entry not yet in the output, so if the script is stopped and run
+# again, it resumes from there rather than reading the log again from the start.
+def simplify_follow(input, output, skippable, poll_secs=0.005, timeout=0, compact=False, checkpoint_secs=1.0):
+    checkpoint_path = output + ".follow"
+    options = {"skip": sorted(skippable)}
+    if compact:
+        options["compact"] = True
+    checkpoint = load_manifest(checkpoint_path)
+    resuming = (checkpoint.get("input") == os.path.abspath(input) and checkpoint.get("options") == options and
+        os.path.exists(output) and os.path.getsize(output) >= checkpoint["outputSize"] and
+        os.path.getsize(input) >= checkpoint["offset"])
+    if resuming:
+        print(f"Resuming at byte {checkpoint['offset']} of the log, after {checkpoint['records']} records")
+        f_out = open(output, "r+", encoding="utf-8", newline="")
+        f_out.truncate(checkpoint["outputSize"])
+        f_out.seek(checkpoint["outputSize"])
+    else:
+        checkpoint = {"input": os.path.abspath(input), "options": options, "offset": 0, "outputSize": 0, "records": 0}
+        f_out = open(output, "w", encoding="utf-8", newline="")
+
+    follower = LogFollower(input, checkpoint["offset"], poll_secs)
+    writer = RecordWriter(f_out, checkpoint["records"], compact)
+    skippable = frozenset(skippable)
+    # The position from `follower.entries` of the first entry not yet in the output.
+    resume_pos = None
+    saved = [writer.count, time.monotonic()]
+
+    def save(force):
+        if writer.count == saved[0] or (not force and time.monotonic() - saved[1] < checkpoint_secs):
+            return
+        f_out.flush()
+        if resume_pos is not None:
+            checkpoint["offset"] = follower.byte_offset(resume_pos)
+        checkpoint["outputSize"] = f_out.tell()
+        checkpoint["records"] = writer.count
+        save_manifest(checkpoint, checkpoint_path)
+        saved[:] = [writer.count, time.monotonic()]
+
+    # Yields the entries of the log, keeping track of the first entry not yet in the output.
+    # When the merging asks for the next entry, the records finished by the last entry have been
+    # written, and if there were any, that entry starts the frame still being merged, unless it
+    # was written as is because it has a key in `skippable`.
+    def entries():
+        nonlocal resume_pos
+        for entry, start, end in follower.entries(lambda: save(True), timeout):
+            count = writer.count
+            yield entry
+            if writer.count > count:
+                resume_pos = start if skippable.isdisjoint(entry) else end
+                save(False)
+
+    with f_out:
+        for record in merge_stream(entries(), skippable):
+            writer.write(record)
+        writer.close()
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+# Returns the byte offsets at which to split the log in `input` into pieces of about
+# `chunk_size` bytes.  Each piece starts at an entry, found as a '{' at the start of a line,
+# which is how Logger.cs writes the log.  The last offset is the size of the file.
+def chunk_offsets(input, chunk_size):
+    size = os.path.getsize(input)
+    offsets = [0]
+    with open(input, "rb") as f:
+        target = chunk_size
+        while target < size:
+            f.seek(target)
+            pos = target
+            found = -1
+            while found < 0:
+                window = f.read(1 << 12)
+                if len(window) < 2:
+                    break
+                found = window.find(b"\n{")
+                if found < 0:
+                    # Back up one byte so a "\n{" spanning two windows is not missed.
+                    pos += len(window) - 1
+                    f.seek(pos)
+            if found < 0:
+                break
+            offsets.append(pos + found + 1)
+            target = offsets[-1] + chunk_size
+    offsets.append(size)
+    return offsets
+
+# Merges the entries from the piece of the log in `input` between byte offsets `start` and `end`,
+# for a worker process.  Entries before the first frame boundary (where `headers_match` fails
+# for two successive entries) and after the last one may belong to frames continuing from
+# the previous piece or into the next one, so they are returned unmerged, as the `head` and
+# `tail` lists.  The entries in between are merged and returned as encoded text.  A frame
+# boundary is where a new merged record must start no matter what came before, so merging
+# the pieces separately gives the same result as merging the whole log.  With `with_stats`, the
+# statistics for the merged entries are returned too, as a `Stats`, or else `None`.
+def merge_chunk(task):
+    input, start, end, skippable, compact, with_stats = task
+    stats = Stats(skippable, piece=True) if with_stats else None
+    with stats_phase(stats, "parse"):
+        with open(input, "rb") as f:
+            f.seek(start)
+            text = f.read(end - start).decode("utf-8")
+        parser = EntryParser(in_array=(start > 0))
+        entries = list(parser.feed(text))
+        parser.close(require_end=False)
+
+    with stats_phase(stats, "merge"):
+        boundaries = [j for j in range(1, len(entries)) if not headers_match(entries[j - 1], entries[j])]
+    if not boundaries:
+        return (entries, None, 0, [], stats and stats.finish())
+    first, last = boundaries[0], boundaries[-1]
+    with stats_phase(stats, "serialize"):
+        records = stats_timed(stats, merge_stream(entries[first:last], skippable, stats=stats), "merge")
+        encoded = [encode_record(record, compact) for record in records]
+        text = record_separator(compact).join(encoded)
+    return (entries[:first], text, len(encoded), entries[last:], stats and stats.finish())
+
+# Merges the log in `input` using a pool of `jobs` processes, each merging a piece of the log,
+# and stitches the results together in order.  The input must not be compressed, since the
+# pieces are found by their byte offsets, but the output may be.  Statistics from all the
+# processes are added to `stats`, if not `None`, so its phase times may exceed the wall time.
+def simplify_parallel(input, output, skippable, jobs, chunk_size=None, compact=False, level=None, stats=None):
+    size = os.path.getsize(input)
+    if chunk_size is None:
+        chunk_size = min(max(size // (jobs * 4), 1 << 20), 16 << 20)
+    offsets = chunk_offsets(input, chunk_size)
+    tasks = [(input, offsets[k], offsets[k + 1], skippable, compact, stats is not None) for k in range(len(offsets) - 1)]
+    print(f"Merging {len(tasks)} pieces with {jobs} processes")
+
+    with multiprocessing.Pool(jobs) as pool, open_log(output, "w", level) as f_out:
+        writer = RecordWriter(f_out, compact=compact)
+        # Unmerged entries at the seam between pieces, from a frame that may span them.
+        seam = []
+        next_decile = 1
+        for k, (head, encoded, count, tail, chunk_stats) in enumerate(pool.imap(merge_chunk, tasks)):
+            seam += head
+            if encoded is not None:
+                with stats_phase(stats, "serialize"):
+                    for record in stats_timed(stats, merge_stream(seam, skippable, stats=stats), "merge"):
+                        writer.write(record)
+                    writer.write_encoded(encoded, count)
+                seam = tail
+            # After the records at the seam, which come before the piece's records.
+            if chunk_stats is not None:
+                stats.add(chunk_stats)
+            while next_decile <= 10 and offsets[k + 1] >= size * next_decile / 10:
+                print(f"{next_decile * 10}%")
+                next_decile += 1
+        with stats_phase(stats, "serialize"):
+            for record in stats_timed(stats, merge_stream(seam, skippable, stats=stats), "merge"):
+                writer.write(record)
+            writer.close()
+
+# The default path for the output, merged log from the log at `input`, compressed as the input
+# is, so "Log.json.gz" gives "Log-merged.json.gz".  With the "columns" `format`, the output is
+# a directory.
+def merged_path(input, format="json"):
+    input, compression = split_compression(input)
+    root, ext = os.path.splitext(input)
+    return root + "-merged" + (ext + compression if format == "json" else ".columns")
+
+MANIFEST_NAME = "simplify-manifest.json"
+
+# Returns the logs to be merged for `pattern`, which can be a directory (meaning all its
+# JSON files, compressed or not) or a glob pattern.  Outputs from earlier merging are not included.
+def find_inputs(pattern):
+    if os.path.isdir(pattern):
+        patterns = [os.path.join(pattern, "*.json" + ext) for ext in ("",) + tuple(COMPRESSIONS)]
+    else:
+        patterns = [pattern]
+    paths = []
+    for path in sorted(set(path for pattern in patterns for path in glob.glob(pattern))):
+        name = os.path.basename(path)
+        if os.path.isfile(path) and name not in (MANIFEST_NAME, COLUMNS_META) and not os.path.splitext(split_compression(name)[0])[0].endswith("-merged"):
+            paths.append(path)
+    return paths
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest(path):
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(manifest, path):
+    # Write to a temporary file first, so an interruption does not leave a corrupt manifest.
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+# Returns the manifest record for the input log at `path`, given its current `stat` result.
+# The content hash is computed only when the size and modification time no longer match
+# the `previous` record, so checking an unchanged log is just a call to `os.stat`.
+def input_record(path, stat, previous):
+    if previous and previous["size"] == stat.st_size and previous["mtimeNs"] == stat.st_mtime_ns:
+        digest = previous["sha256"]
+    else:
+        digest = file_digest(path)
+    return {"size": stat.st_size, "mtimeNs": stat.st_mtime_ns, "sha256": digest}
+
+# Whether the output for the input log at `path` is up to date with the `previous` manifest
+# entry, for merging with `options`.
+def up_to_date(path, options, previous):
+    if not previous or previous["options"] != options:
+        return False
+    try:
+        stat = os.stat(path)
+        output_stat = os.stat(previous["output"]["path"])
+    except OSError:
+        return False
+    if output_stat.st_size != previous["output"]["size"] or output_stat.st_mtime_ns != previous["output"]["mtimeNs"]:
+        return False
+    if stat.st_size != previous["input"]["size"]:
+        return False
+    if stat.st_mtime_ns == previous["input"]["mtimeNs"]:
+        return True
+    # The log was touched, so check whether its content really changed.
+    return file_digest(path) == previous["input"]["sha256"]
+
+# Merges one log for `simplify_batch`, in a worker process.  With `with_stats`, the statistics
+# for the log are returned too, as a dictionary, or else `None`.
+def simplify_file(task):
+    input, skippable, limit, format, compact, level, previous_input, with_stats = task
+    stat = os.stat(input)
+    output = merged_path(input, format)
+    stats = Stats(skippable) if with_stats else None
+    simplify_stream(input, output, skippable, limit, verbose=False, format=format, compact=compact, level=level, stats=stats)
+    stats = stats and stats.finish().to_dict(input, output)
+    # For columns, the description file is written last, so it tells when the output was finished.
+    if format == "columns":
+        output = os.path.join(output, COLUMNS_META)
+    output_stat = os.stat(output)
+    return input, {
+        "input": input_record(input, stat, previous_input),
+        "output": {"path": os.path.abspath(output), "size": output_stat.st_size, "mtimeNs": output_stat.st_mtime_ns}
+    }, stats
+
+# Merges all the logs matching `pattern`, `jobs` logs at a time.  A manifest of each log's
+# size, modification time and content hash, along with the merging options, is kept so that
+# logs whose merged output is already up to date can be skipped when run again.  The statistics
+# for each log merged are appended to the list `stats`, if not `None`.  The peak memory for a log
+# is that of the worker process, which may have merged other logs before it.
+def simplify_batch(pattern, skippable, limit, jobs, manifest_path=None, format="json", compact=False, level=None, stats=None):
+    inputs = find_inputs(pattern)
+    if manifest_path is None:
+        directory = pattern if os.path.isdir(pattern) else os.path.dirname(pattern)
+        manifest_path = os.path.join(directory, MANIFEST_NAME)
+    print(f"Using manifest: {manifest_path}")
+
+    manifest = load_manifest(manifest_path)
+    options = {"skip": sorted(skippable), "limit": limit, "format": format}
+    if compact:
+        options["compact"] = True
+    if level is not None:
+        options["level"] = level
+    tasks = []
+    for input in inputs:
+        key = os.path.abspath(input)
+        previous = manifest.get(key)
+        if up_to_date(input, options, previous):
+            # The log may have been touched, so record its new modification time.
+            previous["input"]["mtimeNs"] = os.stat(input).st_mtime_ns
+        else:
+            tasks.append((input, skippable, limit, format, compact, level, previous["input"] if previous else None, stats is not None))
+    print(f"Found {len(inputs)} logs, {len(inputs) - len(tasks)} already up to date")
+
+    if tasks:
+        with multiprocessing.Pool(min(jobs, len(tasks))) as pool:
+            for n_done, (input, record, log_stats) in enumerate(pool.imap_unordered(simplify_file, tasks), 1):
+                record["options"] = options
+                if log_stats is not None:
+                    stats.append(log_stats)
+                manifest[os.path.abspath(input)] = record
+                print(f"[{n_done}/{len(tasks)}] Merged {input}")
+                if n_done % 100 == 0:
+                    save_manifest(manifest, manifest_path)
+    save_manifest(manifest, manifest_path)
+
+def simplify(input, output, skippable, limit, compact=False, level=None, stats=None):
+    with stats_phase(stats, "parse"), open_log(input) as f:
+        json_orig = json.load(f)
+
+    def progress(entries):
+        decile = max(len(entries) // 10, 1)
+        for i, entry in enumerate(entries):
+            if i % decile == 0:
+                print(f"{round(i / len(entries) * 100)}%")
+            yield entry
+
+    with stats_phase(stats, "merge"):
+        json_result = list(merge_stream(progress(json_orig), skippable, limit, stats))
+
+    with stats_phase(stats, "serialize"), open_log(output, "w", level) as f:
+        if compact:
+            writer = RecordWriter(f, compact=True)
+            for record in json_result:
+                writer.write(record)
+            writer.close()
+        else:
+            json.dump(json_result, f, indent=2)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input", "-i", help="path to original log file")
+    parser.add_argument("--input", "-i", help="path to original log file, or a directory or glob pattern for several log files")
     parser.add_argument("--output", "-o", help="path for output, merged log file")
     parser.set_defaults(skip=["meshGameObjectPath"])
     parser.add_argument("--skip", "-s", nargs="+", help="skip merging of items containing these keys")
     parser.set_defaults(limit=0)
     parser.add_argument("--limit", type=int, help="limit the output to this many items (0 means no limit)")
+    parser.set_defaults(stream=False)
+    parser.add_argument("--stream", action="store_true", help="read and write one entry at a time, using constant memory")
+    parser.add_argument("--jobs", "-j", type=int, help="merge pieces of the log (or several logs) in this many parallel processes")
+    parser.add_argument("--manifest", help="path for the manifest of logs already merged (default: in the input directory)")
+    parser.set_defaults(format="json")
+    parser.add_argument("--format", "-f", choices=["json", "columns"], help="write JSON, or a directory of typed columns as NumPy .npy files")
+    parser.set_defaults(follow=False)
+    parser.add_argument("--follow", action="store_true", help="merge a log while it is still being written, like `tail -f`, resuming where a previous run stopped")
+    parser.set_defaults(poll_ms=5)
+    parser.add_argument("--poll-ms", type=float, help="with --follow, how often to check the log for more entries (msec)")
+    parser.set_defaults(follow_timeout=0)
+    parser.add_argument("--follow-timeout", type=float, help="with --follow, stop when nothing has been appended to the log for this long (sec, 0 means wait for the log's end)")
+    parser.set_defaults(compact=False)
+    parser.add_argument("--compact", action="store_true", help="write each merged record on one line, without indentation")
+    parser.add_argument("--level", type=int, help="compression level for output ending in .gz, .zst or .lz4 (default: the usual level for the format)")
+    parser.add_argument("--stats", help="path for a JSON file of statistics on the merging: phase times, throughput, peak memory, and counts of records and entries")
+    parser.add_argument("--profile", help="path for cProfile output for the main process, to load with the pstats module")
     args = parser.parse_args()
 
-    print(f"Using input: {args.input}")
-    output = args.output
-    if output == None:
-        root, ext = os.path.splitext(args.input)
-        output = root + "-merged" + ext
-    print(f"Using output: {output}")
-    print(f"Skipping merging of records containing: {args.skip}")
-
-    with open(args.input, "r") as f:
-        json_orig = json.load(f)
-        json_result = []
-        n = len(json_orig)
-        i1 = 0
-        
-        decile = n // 10
-        while i1 < n:
-            if len(json_result) % decile == 0:
-                print(f"{round(i1 / n * 100)}%")
-
-            json1 = json_orig[i1]
-            json1_merged = json1.copy()
-            i2 = i1 + 1
-
-            if skip(json1, args.skip):
-                i1 = i2
-            else:
-                while i2 < len(json_orig):
-                    json2 = json_orig[i2]
-                    if not headers_match(json1_merged, json2):
-                        break
-                    if skip(json2, args.skip):
-                        break
-                    if mergeable(json1_merged, json2):
-                        merge_into(json1_merged, json2)
-                    i2 += 1
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # A path that is neither a file nor a directory may be a glob pattern, but otherwise is a
+    # mistake, which should not run in batch mode and write an empty manifest.
+    is_pattern = glob.escape(args.input) != args.input
+    if not os.path.exists(args.input) and not (is_pattern and find_inputs(args.input)):
+        parser.error(f"No such file or directory{', or no logs matching the pattern' if is_pattern else ''}: {args.input}")
 
-                i1 = i2
+    print(f"Using input: {args.input}")
+    if not os.path.isfile(args.input):
+        print(f"Skipping merging of records containing: {args.skip}")
+        stats = [] if args.stats else None
+        simplify_batch(args.input, args.skip, args.limit, args.jobs or os.cpu_count(), args.manifest, args.format, args.compact, args.level,
+            stats)
+        if stats is not None:
+            # The slowest logs first.
+            stats.sort(key=lambda log_stats: log_stats["wallSecs"], reverse=True)
+            save_manifest({"logs": stats}, args.stats)
+    else:
+        output = args.output
+        if output == None:
+            output = merged_path(args.input, args.format)
+        print(f"Using output: {output}")
+        print(f"Skipping merging of records containing: {args.skip}")
 
-            json_result.append(json1_merged)
+        if args.follow and (compression_of(args.input) or compression_of(output)):
+            parser.error("--follow is not supported with compressed logs")
+        stats = Stats(args.skip) if args.stats and not args.follow else None
+        if args.follow:
+            if args.jobs or args.limit > 0 or args.format != "json" or args.stats:
+                print("Ignoring --jobs, --limit, --format and --stats, which are not supported with --follow")
+            try:
+                simplify_follow(args.input, output, args.skip, args.poll_ms / 1000, args.follow_timeout, args.compact)
+            except KeyboardInterrupt:
+                print("Stopped following; run again with --follow to resume")
+        else:
+            jobs = args.jobs or 1
+            if jobs > 1 and (args.limit > 0 or args.format != "json" or compression_of(args.input)):
+                print("Ignoring --jobs, which is supported only for JSON output without --limit, from an uncompressed log")
+                jobs = 1
+            if jobs > 1:
+                simplify_parallel(args.input, output, args.skip, jobs, compact=args.compact, level=args.level, stats=stats)
+            elif args.stream or args.format != "json":
+                simplify_stream(args.input, output, args.skip, args.limit, format=args.format, compact=args.compact, level=args.level,
+                    stats=stats)
+            else:
+                simplify(args.input, output, args.skip, args.limit, args.compact, args.level, stats)
+        if stats is not None:
+            save_manifest(stats.finish().to_dict(args.input, output), args.stats)
 
-            if args.limit > 0 and i1 > args.limit:
-                break
-    
-    with open(output, "w") as f:
-        json.dump(json_result, f, indent=2)
+    if args.profile:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Wrote profile: {args.profile}; the functions taking the most time (including the functions they call):")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
@@ -0,0 +1,92 @@
+# Tests the statistics from `simplify.py --stats`, checking that merging a log in pieces with
+# `--jobs` gives the same counts as merging it in one stream, including for frames that straddle
+# the boundaries between pieces.
+# python -m unittest test_stats.py
+
+import os
+import random
+import tempfile
+import unittest
+
+import benchmark
+import simplify
+
+SKIPPABLE = ["meshGameObjectPath"]
+
+# The statistics that do not depend on timing.
+COUNTS = ["entries", "records", "frames", "mergedRecords", "mergedEntries", "skippedRecords", "entriesPerFrame"]
+
+# Returns entries for `n_frames` frames, with a few entries per frame.  Some entries in a frame
+# have a different `timeSecs`, or lack a header key, so `headers_match` fails within the frame
+# and the pieces for `--jobs` may start in the middle of it.
+def straddling_entries(rng, n_frames):
+    entries = []
+    for frame in range(1, n_frames + 1):
+        for j in range(rng.randrange(1, 6)):
+            entry = {"timeSecs": frame / 100, "frame": float(frame), "timeSecsAfterSplash": frame / 100, "frameAfterSplash": float(frame)}
+            if rng.random() < 0.2:
+                entry["timeSecs"] += 0.001 * j
+            if rng.random() < 0.1:
+                del entry["timeSecsAfterSplash"]
+            key = rng.choice(["a", "b", "c", "meshGameObjectPath"])
+            entry[key if key == "meshGameObjectPath" else f"{key}{j}"] = j
+            entries.append(entry)
+    return entries
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.directory = self._directory.name
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def merge(self, merge_function, input, output):
+        stats = simplify.Stats(SKIPPABLE)
+        merge_function(input, output, stats)
+        d = stats.finish().to_dict(input, output)
+        return {key: d[key] for key in COUNTS}
+
+    def test_jobs_match_stream(self):
+        for seed in range(5):
+            rng = random.Random(seed)
+            entries = straddling_entries(rng, 300)
+            input = os.path.join(self.directory, f"log{seed}.json")
+            benchmark.write_log(input, entries)
+            stream_output = os.path.join(self.directory, f"stream{seed}.json")
+            stream = self.merge(lambda input, output, stats: simplify.simplify_stream(input, output, SKIPPABLE, 0, verbose=False, stats=stats),
+                input, stream_output)
+            self.assertEqual(stream["entries"], len(entries))
+            self.assertEqual(stream["frames"], 300)
+            for chunk_size in (500, 2000):
+                jobs_output = os.path.join(self.directory, f"jobs{seed}-{chunk_size}.json")
+                jobs = self.merge(lambda input, output, stats: simplify.simplify_parallel(input, output, SKIPPABLE, 2, chunk_size, stats=stats),
+                    input, jobs_output)
+                self.assertEqual(jobs, stream, f"seed {seed}, chunk size {chunk_size}")
+                with open(stream_output) as f1, open(jobs_output) as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+    # A frame starting in one piece and continuing through the next two, as `simplify_parallel`
+    # adds the statistics: the records at a seam, then those of the following piece.
+    def test_frame_spanning_pieces(self):
+        def record(frame):
+            return {"frame": frame, "a": 1}
+
+        pieces = []
+        for frames in ([1, 2, 3], [3], [3, 4]):
+            piece = simplify.Stats(piece=True)
+            for frame in frames:
+                piece.add_record(record(frame), 2)
+            pieces.append(piece.finish())
+        stats = simplify.Stats()
+        stats.add_record(record(1), 1)
+        for piece in pieces:
+            stats.add(piece)
+        stats.add_record(record(4), 1)
+        stats.finish()
+        # Frame 1 has 1 + 2 entries, frame 2 has 2, frame 3 has 2 + 2 + 2, and frame 4 has 2 + 1.
+        self.assertEqual(stats.entries_per_frame, {3: 2, 2: 1, 6: 1})
+        self.assertEqual(stats.entries, 14)
+
+if __name__ == "__main__":
+    unittest.main()
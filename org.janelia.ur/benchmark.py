@@ -0,0 +1,173 @@
+# Benchmarks for fake-rtde-controller.py.
+
+# The "pack" benchmark compares the packing of data packages with the precompiled
+# `OutputRecipe.pack_into` to the reference way, with the `pack` function for each data item and
+# concatenation, as the script's data loop originally did.  It checks that both give the same
+# bytes, for output recipes with various numbers of variables, and reports the data packages per
+# second and the time per package (the budget per package at the controller's 500 Hz is 2000 usec,
+# shared by all the arms and recipes a script simulates).
+# python benchmark.py pack --packages 20000 --vars 1 4 8 16 31
+
+# The "trajectory" benchmark measures the realistic values of the `--trajectory` argument (which
+# needs NumPy): the time to compute each chunk of a trajectory (the worst of which delays an update
+# of the controller), and the time per data package including the computing and encoding, for
+# output recipes with various numbers of variables.  It checks that two trajectories with the same
+# seed give the same bytes, and that the joint velocities agree with the joint angles.
+# python benchmark.py trajectory --packages 20000 --vars 1 4 8 16 31
+
+import argparse
+import importlib
+import json
+import struct
+import sys
+import time
+
+controller = importlib.import_module('fake-rtde-controller')
+
+# The data loop as the script originally did it, including `send_reply` (without the sending).
+def pack_reference(recipe_id, vars, x, sine, af):
+    payload = struct.pack('>B', recipe_id)
+    for var in vars:
+        type = controller.types[var]
+        payload += controller.pack(type, x, sine and var == 'actual_q', af)
+    size = struct.calcsize(controller.FMT_HEADER) + len(payload)
+    return struct.pack(controller.FMT_HEADER, size, controller.Command.RTDE_DATA_PACKAGE) + payload
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def benchmark_trajectory(args):
+    import numpy as np
+    import trajectory
+
+    all_vars = list(controller.types.keys())
+    report = []
+    failed = False
+    for name, make in trajectory.trajectories.items():
+        arm = make(controller.CONTROLLER_FREQUENCY, args.model, args.seed)
+        # The first chunk is not timed, as it includes some setup of NumPy
+        arm.chunk(0)
+        chunk_secs = []
+        for index in range(1, max(args.packages // arm.chunk_ticks, 2)):
+            start = time.perf_counter()
+            arm.chunk(index)
+            chunk_secs.append(time.perf_counter() - start)
+        print(f'{name}: {arm.chunk_ticks} updates per chunk, mean {np.mean(chunk_secs) * 1e3:.2f} ms, '
+              f'max {np.max(chunk_secs) * 1e3:.2f} ms per chunk')
+
+        # Data packages for every update, with the velocities from the angles by central differences
+        values = [arm.chunk(index) for index in range(3)]
+        q = np.concatenate([v['actual_q'] for v in values])
+        qd = np.concatenate([v['actual_qd'] for v in values])
+        error = np.abs((q[2:] - q[:-2]) * controller.CONTROLLER_FREQUENCY / 2 - qd[1:-1]).max()
+        if error > 1e-9:
+            print(f'{name}: joint velocities differ from the joint angles by {error}')
+            failed = True
+
+        for n in args.vars:
+            vars = all_vars[:n]
+            def packed():
+                recipe = controller.TrajectoryRecipe(1, controller.CONTROLLER_FREQUENCY, vars,
+                                                     make(controller.CONTROLLER_FREQUENCY, args.model, args.seed))
+                buffer = bytearray(recipe.size)
+                view = memoryview(buffer)
+                result = []
+                for tick in range(args.packages):
+                    recipe.pack_into(buffer, 0, tick)
+                    result.append(bytes(view))
+                return result
+            t, result = best_time(packed, args.repeat)
+            if result != packed():
+                print(f'{name}: results differ for the same seed, for {n} variables')
+                failed = True
+            size = len(result[0])
+            print(f'{name}: {n:>3} vars ({size:>4} bytes): {t / args.packages * 1e6:6.2f} usec, '
+                  f'{args.packages / t:>9,.0f} packages/s')
+            report.append({'trajectory': name, 'vars': n, 'bytes': size, 'packages': args.packages, 'secs': t,
+                           'chunkTicks': arm.chunk_ticks, 'meanChunkSecs': float(np.mean(chunk_secs)),
+                           'maxChunkSecs': float(np.max(chunk_secs))})
+    return report, failed
+
+def benchmark_pack(args):
+    all_vars = list(controller.types.keys())
+    # Put `actual_q` first, so every recipe has joint angles.
+    all_vars.remove('actual_q')
+    all_vars.insert(0, 'actual_q')
+    report = []
+    failed = False
+    for n in args.vars:
+        vars = all_vars[:n]
+        def reference():
+            return [pack_reference(1, vars, x, args.sine, 0.01) for x in range(args.packages)]
+        def compiled():
+            recipe = controller.OutputRecipe(1, 500, vars, args.sine, 0.01)
+            buffer = bytearray(recipe.size)
+            view = memoryview(buffer)
+            result = []
+            for _ in range(args.packages):
+                recipe.pack_into(buffer, 0)
+                result.append(bytes(view))
+            return result
+        t_ref, result_ref = best_time(reference, args.repeat)
+        t_new, result_new = best_time(compiled, args.repeat)
+        if result_ref != result_new:
+            print(f'Results differ for {n} variables')
+            failed = True
+        size = len(result_new[0])
+        speedup = t_ref / t_new
+        print(f'{n:>3} vars ({size:>4} bytes): reference {t_ref / args.packages * 1e6:6.2f} usec, '
+              f'compiled {t_new / args.packages * 1e6:6.2f} usec, {args.packages / t_new:>9,.0f} packages/s, '
+              f'speedup {speedup:.2f}x')
+        report.append({'vars': n, 'bytes': size, 'packages': args.packages, 'referenceSecs': t_ref,
+                       'compiledSecs': t_new, 'speedup': speedup})
+        if args.min_speedup and speedup < args.min_speedup:
+            print(f'Speedup is below the minimum of {args.min_speedup}x')
+            failed = True
+    return report, failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--report', help='path for a JSON report of the results')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    pack_parser = subparsers.add_parser('pack', help='precompiled recipe packing versus the reference packing')
+    pack_parser.set_defaults(packages=20000)
+    pack_parser.add_argument('--packages', '-n', type=int, help='number of data packages to pack')
+    pack_parser.set_defaults(vars=[1, 4, 8, 16, 31])
+    pack_parser.add_argument('--vars', '-v', type=int, nargs='+', help='numbers of variables per recipe to try')
+    pack_parser.set_defaults(sine=True)
+    pack_parser.add_argument('--no-sine', dest='sine', action='store_false', help='do not make the joint angles sinusoidal')
+    pack_parser.set_defaults(repeat=3)
+    pack_parser.add_argument('--repeat', '-r', type=int, help='report the best of this many runs')
+    pack_parser.set_defaults(min_speedup=0)
+    pack_parser.add_argument('--min-speedup', type=float, help='exit with an error if the speedup is less than this')
+
+    trajectory_parser = subparsers.add_parser('trajectory', help='realistic values from the trajectories')
+    trajectory_parser.set_defaults(packages=20000)
+    trajectory_parser.add_argument('--packages', '-n', type=int, help='number of data packages to pack')
+    trajectory_parser.set_defaults(vars=[1, 4, 8, 16, 31])
+    trajectory_parser.add_argument('--vars', '-v', type=int, nargs='+', help='numbers of variables per recipe to try')
+    trajectory_parser.set_defaults(model='UR5e')
+    trajectory_parser.add_argument('--model', '-m', help='model of the arm')
+    trajectory_parser.set_defaults(seed=0)
+    trajectory_parser.add_argument('--seed', type=int, help='seed for the trajectories')
+    trajectory_parser.set_defaults(repeat=3)
+    trajectory_parser.add_argument('--repeat', '-r', type=int, help='report the best of this many runs')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'pack':
+        report, failed = benchmark_pack(args)
+    elif args.benchmark == 'trajectory':
+        report, failed = benchmark_trajectory(args)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'benchmark': args.benchmark, 'results': report}, f, indent=2)
+    sys.exit(1 if failed else 0)
@@ -2,16 +2,30 @@
 # via the Real Time Data Exchange (RTDE) interface:
 # https://www.universal-robots.com/articles/ur/interface-communication/real-time-data-exchange-rtde-guide/
 # In particular, handles the communication expected by the `record.py` example client from
-# `rtde-2.6.0-release.zip` in the "Attached Files" at the bottom of the guide.
+# `rtde-2.6.0-release.zip` in the "Attached Files" at the bottom of the guide, and by
+# `Janelia.RtdeClient`.  Serves any number of clients at once, on one or more ports (one per
+# simulated arm), with each connection handling the RTDE commands in any order.  With the
+# `--trajectory` argument, the arms move realistically (see trajectory.py, which needs NumPy).
+# Can also record the sessions of clients with a real controller, acting as a proxy, and replay
+# the recorded data packages to other clients.
 
 import argparse
+import asyncio
 import datetime
 import math
+import mmap
+import os
+import re
 import socket
 import struct
 import sys
 import time
 
+# The serving and pacing of the data packages is shared with other scripts that simulate devices,
+# in the org.janelia.io package.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'org.janelia.io'))
+import devicesim
+
 # RTDE command identifiers
 class Command:
     RTDE_REQUEST_PROTOCOL_VERSION = 86        # ascii V
@@ -26,6 +40,20 @@ class Command:
 # Supported version of the RTDE protocol
 RTDE_PROTOCOL_VERSION_2 = 2
 
+# The port where a real controller serves RTDE
+RTDE_PORT = 30004
+
+# The rate at which an e-Series controller updates its outputs; an output recipe with a lower
+# frequency gets every nth update
+CONTROLLER_FREQUENCY = 500
+
+# The version reported for RTDE_GET_URCONTROL_VERSION: major, minor, bugfix, build
+URCONTROL_VERSION = (3, 2, 19171, 0)
+
+# The most recipes of each kind (output or input) a client can set up, since a recipe id is one
+# byte and 0 indicates failure
+MAX_RECIPES = 255
+
 # Format (for `struct.pack` and `struct.unpack_from`) of the header of a socket message
 FMT_HEADER = '>HB'
 
@@ -65,14 +93,60 @@ types = {
    'runtime_state' : 'UINT32'
 }
 
-def receive_cmd(conn, cmd_expected, cmd_expected_name):
-    buf = conn.recv(4096)
-    (size, cmd) = struct.unpack_from(FMT_HEADER, buf)
-    if cmd != cmd_expected:
-        print('[{}] Server received unexpected command: {}'.format(datetime.datetime.now(), cmd))
-    print('[{}] Server received {}'.format(datetime.datetime.now(), cmd_expected_name))
-    return (buf, size)
+# Each data item that a client can send per a `Command.RTDE_CONTROL_PACKAGE_SETUP_INPUTS` request
+# has an associated type, as do the registers matched by `input_register_types`
+input_types = {
+   'speed_slider_mask' : 'UINT32',
+   'speed_slider_fraction' : 'DOUBLE',
+   'standard_digital_output_mask' : 'UINT8',
+   'standard_digital_output' : 'UINT8',
+   'configurable_digital_output_mask' : 'UINT8',
+   'configurable_digital_output' : 'UINT8',
+   'tool_digital_output_mask' : 'UINT8',
+   'tool_digital_output' : 'UINT8',
+   'standard_analog_output_mask' : 'UINT8',
+   'standard_analog_output_type' : 'UINT8',
+   'standard_analog_output_0' : 'DOUBLE',
+   'standard_analog_output_1' : 'DOUBLE',
+   'input_bit_registers0_to_31' : 'UINT32',
+   'input_bit_registers32_to_63' : 'UINT32'
+}
+
+input_register_types = [
+   (re.compile(r'input_bit_register_\d+$'), 'BOOL'),
+   (re.compile(r'input_int_register_\d+$'), 'INT32'),
+   (re.compile(r'input_double_register_\d+$'), 'DOUBLE')
+]
+
+def input_type(var):
+    if var in input_types:
+        return input_types[var]
+    for pattern, type in input_register_types:
+        if pattern.match(var):
+            return type
+    return 'NOT_FOUND'
+
+# Format (for `struct`) of each type of data item in a data package
+type_formats = {
+   'BOOL' : '?',
+   'UINT8' : 'B',
+   'UINT32' : 'I',
+   'UINT64' : 'Q',
+   'INT32' : 'i',
+   'DOUBLE' : 'd',
+   'VECTOR3D' : '3d',
+   'VECTOR6D' : '6d',
+   'VECTOR6INT32' : '6i',
+   'VECTOR6UINT32' : '6I'
+}
+
+# The joint angles produced by the `--sine` argument, for data package `x`, all at once
+def sine_joint_angles(x, af, s = 30, sin = math.sin):
+    return (s * sin(1 * af * x), s * sin(2 * af * x), s * sin(3 * af * x),
+            s * sin(4 * af * x), s * sin(5 * af * x), s * sin(6 * af * x))
 
+# Packs one data item.  The output recipes are packed all at once by `OutputRecipe.pack_into`
+# instead, but this function shows the values more clearly, and is the reference for `benchmark.py`.
 def pack(type, x, sine, af):
     if type == 'DOUBLE':
         return struct.pack('>d', float(x))
@@ -99,94 +173,774 @@ def pack(type, x, sine, af):
     elif type == 'VECTOR3D':
         return struct.pack('>ddd', float(x), float(x), float(x))
 
-def send_reply(conn, cmd, payload, verbose = True):
+def send_reply(transport, cmd, payload, verbose = True):
     size = struct.calcsize(FMT_HEADER) + len(payload)
     buf = struct.pack(FMT_HEADER, size, cmd) + payload
     if verbose:
         print('[{}] Server sending reply, payload len {}'.format(datetime.datetime.now(), len(payload)))
-    conn.sendall(buf)
+    transport.write(buf)
 
-if __name__ == '__main__':
-    print('[{}] Server starting'.format(datetime.datetime.now()))
+# Reads a TCP stream of RTDE packets, each starting with a `FMT_HEADER` giving its size and
+# command, and calls `packet_received(cmd, payload)` for each complete packet, however the packets
+# were split or combined by TCP.  The socket reads directly into a reusable buffer (as an
+# `asyncio.BufferedProtocol`), and each payload is a `memoryview` slice of the buffer, so there is
+# no copying per packet.  The payload is valid only until `packet_received` returns.  The buffer
+# is used as a ring, except that a packet must not wrap around the end, so when the free space at
+# the end gets too small for a whole packet, the start of a partial packet (the only data not yet
+# handled) is moved to the beginning.  Since the size in the header is a 16-bit value, a buffer
+# of twice the maximum size means this move is needed at most once per 64 KB read.
+class FramedProtocol(asyncio.BufferedProtocol):
+    HEADER_SIZE = struct.calcsize(FMT_HEADER)
+    MAX_PACKET_SIZE = 0xffff
+    BUFFER_SIZE = 2 * (MAX_PACKET_SIZE + 1)
 
-    argv = sys.argv
-    if '--' not in argv:
-        argv = []
-    else:
-        argv = argv[argv.index('--') + 1:]
+    def __init__(self):
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        # The data not yet handled is from `start` up to `end`
+        self.start = 0
+        self.end = 0
+        self.transport = None
+        # Statistics, for checking the efficiency
+        self.reads = 0
+        self.packets = 0
+        self.moves = 0
+        self.bytes_moved = 0
 
-    parser = argparse.ArgumentParser(argv)
-    parser.set_defaults(host='127.0.0.1')
-    parser.add_argument('--addr', '-a', dest='host', help='socket host')
-    parser.set_defaults(port=2000)
-    parser.add_argument('--port', '-p', type=int, dest='port', help='socket port')
-    parser.set_defaults(timeout=30)
-    parser.add_argument("--timeout", "-t", type=int, dest="timeout", help="server listening timeout (sec)")
-    parser.set_defaults(count=2000)
-    parser.add_argument('--count', '-c', type=int, dest='count', help='total message count')
-    parser.set_defaults(useSine=False)
-    parser.add_argument("--sine", "-s", dest="useSine", action="store_true", help="produce sinusoidal joint angles")
-    parser.set_defaults(angleFactor=0.01)
-    parser.add_argument("--afactor", "-af", type=float, dest="angleFactor", help="base rotate rate")
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-    args = parser.parse_args()
+    def get_buffer(self, sizehint):
+        if self.BUFFER_SIZE - self.end <= self.MAX_PACKET_SIZE:
+            n = self.end - self.start
+            self.view[:n] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = n
+            self.moves += 1
+            self.bytes_moved += n
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.reads += 1
+        self.end += nbytes
+        start = self.start
+        end = self.end
+        while end - start >= self.HEADER_SIZE:
+            (size, cmd) = struct.unpack_from(FMT_HEADER, self.buffer, start)
+            if size < self.HEADER_SIZE:
+                self.protocol_error('packet size {} is too small'.format(size))
+                return
+            if end - start < size:
+                break
+            self.packets += 1
+            self.packet_received(cmd, self.view[start + self.HEADER_SIZE:start + size])
+            start += size
+            if self.transport.is_closing():
+                break
+        if start == end:
+            # Nothing is left, so the next read can go at the beginning
+            start = end = 0
+        self.start = start
+        self.end = end
+
+    def protocol_error(self, text):
+        self.transport.close()
+
+    def packet_received(self, cmd, payload):
+        pass
+
+# An output recipe, from a `Command.RTDE_CONTROL_PACKAGE_SETUP_OUTPUTS` request
+# The data package for the recipe is compiled into one `struct.Struct`, header included, so a whole
+# package is packed with one call, with no lookups of the variable types.
+class OutputRecipe:
+    def __init__(self, id, freq, vars, sine=False, af=0.01, var_types=None):
+        self.id = id
+        self.freq = freq
+        self.vars = vars
+        self.types = var_types or [types[v] for v in vars]
+        # Sent on every `divider`th update of the controller
+        self.divider = max(round(CONTROLLER_FREQUENCY / freq), 1)
+        self.sent = 0
+        self.struct = struct.Struct(FMT_HEADER + 'B' + ''.join(type_formats[t] for t in self.types))
+        self.size = self.struct.size
+        self.header = (self.size, Command.RTDE_DATA_PACKAGE, id)
+        self.af = af
+        # Each data item gets the package number as its value (`struct` converts it for the
+        # floating-point items), except the joint angles with `--sine`, at these positions.
+        self.value_count = 0
+        self.sine_positions = []
+        for var, type in zip(vars, self.types):
+            n = int(type_formats[type][:-1] or 1)
+            if sine and var == 'actual_q':
+                self.sine_positions.append(self.value_count)
+            self.value_count += n
+
+    # Whether a data package can be packed (which is always, except for `ReplayRecipe`)
+    def ready(self):
+        return True
+
+    # Packs the next data package, for controller update `tick`, into `buffer` at `offset`
+    def pack_into(self, buffer, offset, tick=None):
+        x = self.sent
+        self.sent = x + 1
+        if not self.sine_positions:
+            self.struct.pack_into(buffer, offset, *self.header, *((x, ) * self.value_count))
+            return
+        values = [x] * self.value_count
+        angles = sine_joint_angles(x, self.af)
+        for i in self.sine_positions:
+            values[i:i + 6] = angles
+        self.struct.pack_into(buffer, offset, *self.header, *values)
+
+# An output recipe whose values come from an arm's `trajectory.ArmTrajectory`, for the controller
+# update of each data package.  When a package is due in a chunk of the trajectory not yet used,
+# all the recipe's packages in that chunk are encoded at once, and after that packing a package
+# just copies its bytes.
+class TrajectoryRecipe(OutputRecipe):
+    def __init__(self, id, freq, vars, trajectory):
+        super().__init__(id, freq, vars)
+        self.trajectory = trajectory
+        self.encoder = trajectory.encoder(self.header, vars, self.types)
+        self.chunk_index = None
+        self.first_tick = None
+        self.encoded = None
+
+    def pack_into(self, buffer, offset, tick=None):
+        chunk_ticks = self.trajectory.chunk_ticks
+        chunk_index = tick // chunk_ticks
+        if chunk_index != self.chunk_index:
+            tick0 = chunk_index * chunk_ticks
+            # The first update in the chunk that is a multiple of `divider`
+            self.first_tick = -(-tick0 // self.divider) * self.divider
+            values = self.trajectory.chunk(chunk_index)
+            self.encoded = memoryview(self.encoder.encode(values, self.first_tick - tick0, self.divider))
+            self.chunk_index = chunk_index
+        i = (tick - self.first_tick) // self.divider * self.size
+        buffer[offset:offset + self.size] = self.encoded[i:i + self.size]
+        self.sent += 1
+
+# An output recipe whose values come from a recorded session, through a session's `ReplayCursor`.
+# Each variable's bytes are copied from the most recent recorded data package having it.
+class ReplayRecipe(OutputRecipe):
+    def __init__(self, id, freq, vars, cursor):
+        replay = cursor.replay
+        super().__init__(id, freq, vars, var_types=[replay.types[v] for v in vars])
+        self.cursor = cursor
+        self.header_struct = struct.Struct(FMT_HEADER + 'B')
+        # The recorded recipe and range of payload bytes for each variable, with consecutive
+        # variables from the same recipe combined into one range
+        self.ranges = []
+        for var in vars:
+            recorded_id, start, end = replay.sources[var]
+            if self.ranges and self.ranges[-1][0] == recorded_id and self.ranges[-1][2] == start:
+                self.ranges[-1][2] = end
+            else:
+                self.ranges.append([recorded_id, start, end])
+        self.recorded_ids = set(r[0] for r in self.ranges)
+
+    def ready(self):
+        return all(i in self.cursor.latest for i in self.recorded_ids)
+
+    def pack_into(self, buffer, offset, tick=None):
+        self.header_struct.pack_into(buffer, offset, *self.header)
+        offset += self.header_struct.size
+        latest = self.cursor.latest
+        for recorded_id, start, end in self.ranges:
+            buffer[offset:offset + end - start] = latest[recorded_id][start:end]
+            offset += end - start
+        self.sent += 1
+
+# An input recipe, from a `Command.RTDE_CONTROL_PACKAGE_SETUP_INPUTS` request
+class InputRecipe:
+    def __init__(self, id, vars):
+        self.id = id
+        self.vars = vars
+        self.types = [input_type(v) for v in vars]
+        self.fmt = '>' + ''.join(type_formats[t] for t in self.types)
+
+# The state of the RTDE communication with one client.  Commands are handled in whatever order
+# they arrive, as a controller would: recipes can be set up only while output is paused, and a
+# client can pause and restart output, and send data packages for its input recipes at any time.
+class Session(FramedProtocol):
+    # Maximum data waiting to be sent to a client that is not keeping up, before disconnecting it
+    MAX_BACKLOG = 1 << 20
+
+    def __init__(self, arm, controllers):
+        super().__init__()
+        self.arm = arm
+        self.controllers = controllers
+        self.args = controllers.args
+        self.trajectory = controllers.trajectories[arm] if controllers.trajectories else None
+        self.cursor = ReplayCursor(controllers.replay) if controllers.replay else None
+        self.address = None
+        self.protocol_version = None
+        self.outputs = {}
+        self.output_buffer = bytearray()
+        self.inputs = {}
+        # The most recent values received in data packages, by variable name
+        self.input_values = {}
+        self.running = False
+        self.handlers = {
+            Command.RTDE_REQUEST_PROTOCOL_VERSION: self.on_request_protocol_version,
+            Command.RTDE_GET_URCONTROL_VERSION: self.on_get_urcontrol_version,
+            Command.RTDE_TEXT_MESSAGE: self.on_text_message,
+            Command.RTDE_DATA_PACKAGE: self.on_data_package,
+            Command.RTDE_CONTROL_PACKAGE_SETUP_OUTPUTS: self.on_setup_outputs,
+            Command.RTDE_CONTROL_PACKAGE_SETUP_INPUTS: self.on_setup_inputs,
+            Command.RTDE_CONTROL_PACKAGE_START: self.on_start,
+            Command.RTDE_CONTROL_PACKAGE_PAUSE: self.on_pause
+        }
+
+    def log(self, text):
+        print('[{}] Server, arm {}, client {}: {}'.format(datetime.datetime.now(), self.arm, self.address, text))
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.address = transport.get_extra_info('peername')
+        self.log('connected')
+        self.controllers.sessions.add(self)
+
+    def connection_lost(self, exc):
+        self.running = False
+        self.controllers.sessions.discard(self)
+        self.log('disconnected, after sending {} data packages ({} packets received in {} reads)'.format(
+            sum(r.sent for r in self.outputs.values()), self.packets, self.reads))
+
+    def protocol_error(self, text):
+        self.log('closing the connection: {}'.format(text))
+        super().protocol_error(text)
+
+    # Handles commands in whatever order they arrive
+    def packet_received(self, cmd, payload):
+        handler = self.handlers.get(cmd)
+        if handler:
+            handler(payload)
+        else:
+            self.log('received unexpected command: {}'.format(cmd))
+
+    def on_request_protocol_version(self, payload):
+        (version, ) = struct.unpack_from('>H', payload)
+        self.log('received request for protocol version {}'.format(version))
+        accepted = (version == RTDE_PROTOCOL_VERSION_2)
+        if accepted:
+            self.protocol_version = version
+        send_reply(self.transport, Command.RTDE_REQUEST_PROTOCOL_VERSION, struct.pack('>B', accepted), self.args.verbose)
+
+    def on_get_urcontrol_version(self, payload):
+        self.log('received RTDE_GET_URCONTROL_VERSION')
+        send_reply(self.transport, Command.RTDE_GET_URCONTROL_VERSION, struct.pack('>LLLL', *URCONTROL_VERSION), self.args.verbose)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        sock.bind((args.host, args.port))
-        sock.settimeout(args.timeout)
-        print('[{}] Server listening, port {}'.format(datetime.datetime.now(), args.port))
-        sock.listen()
-        conn, addr = sock.accept()
-        with conn:
-            print('[{}] Server connected, address {}'.format(datetime.datetime.now(), addr))
+    def on_text_message(self, payload):
+        # Message length and message, source length and source, warning level
+        (n, ) = struct.unpack_from('>B', payload)
+        self.log('received text message "{}"'.format(str(payload[1:1 + n], 'utf-8', 'replace')))
 
-            (buf, size) = receive_cmd(conn, Command.RTDE_REQUEST_PROTOCOL_VERSION, 'RTDE_REQUEST_PROTOCOL_VERSION')
+    def on_setup_outputs(self, payload):
+        (freq, ) = struct.unpack_from('>d', payload)
+        vars = str(payload[struct.calcsize('>d'):], 'utf-8').split(',')
+        self.log('received request for output of {} at frequency {} Hz'.format(','.join(vars), freq))
+        # With a replay, only the recorded variables are available
+        known_types = self.cursor.replay.types if self.cursor else types
+        if len(self.outputs) >= MAX_RECIPES:
+            self.log('refusing output recipe: already {} recipes'.format(MAX_RECIPES))
+        if self.running or not 0 < freq <= CONTROLLER_FREQUENCY or any(v not in known_types for v in vars) or \
+                len(self.outputs) >= MAX_RECIPES:
+            # A recipe id of 0 indicates failure
+            recipe_id = 0
+            vars_types = ','.join([known_types.get(v, 'NOT_FOUND') for v in vars])
+        else:
+            recipe_id = len(self.outputs) + 1
+            if self.cursor:
+                recipe = ReplayRecipe(recipe_id, freq, vars, self.cursor)
+            elif self.trajectory:
+                recipe = TrajectoryRecipe(recipe_id, freq, vars, self.trajectory)
+            else:
+                recipe = OutputRecipe(recipe_id, freq, vars, self.args.useSine, self.args.angleFactor)
+            self.outputs[recipe_id] = recipe
+            # Room for a data package from every recipe, for an update when all are due
+            self.output_buffer = bytearray(sum(r.size for r in self.outputs.values()))
+            vars_types = ','.join(recipe.types)
+        vars_types_bytes = vars_types.encode('utf-8')
+        payload = struct.pack('>B{}s'.format(len(vars_types_bytes)), recipe_id, vars_types_bytes)
+        send_reply(self.transport, Command.RTDE_CONTROL_PACKAGE_SETUP_OUTPUTS, payload, self.args.verbose)
+
+    def on_setup_inputs(self, payload):
+        vars = str(payload, 'utf-8').split(',')
+        self.log('received request for input of {}'.format(','.join(vars)))
+        vars_types = [input_type(v) for v in vars]
+        if len(self.inputs) >= MAX_RECIPES:
+            self.log('refusing input recipe: already {} recipes'.format(MAX_RECIPES))
+        if self.running or 'NOT_FOUND' in vars_types or len(self.inputs) >= MAX_RECIPES:
+            recipe_id = 0
+        else:
+            recipe_id = len(self.inputs) + 1
+            self.inputs[recipe_id] = InputRecipe(recipe_id, vars)
+        vars_types_bytes = ','.join(vars_types).encode('utf-8')
+        payload = struct.pack('>B{}s'.format(len(vars_types_bytes)), recipe_id, vars_types_bytes)
+        send_reply(self.transport, Command.RTDE_CONTROL_PACKAGE_SETUP_INPUTS, payload, self.args.verbose)
+
+    def on_data_package(self, payload):
+        (recipe_id, ) = struct.unpack_from('>B', payload)
+        recipe = self.inputs.get(recipe_id)
+        if not recipe:
+            self.log('received data package for unknown input recipe {}'.format(recipe_id))
+            return
+        try:
+            values = struct.unpack_from(recipe.fmt, payload, 1)
+        except struct.error:
+            self.log('received data package too short for input recipe {}'.format(recipe_id))
+            return
+        i = 0
+        for var, type in zip(recipe.vars, recipe.types):
+            n = int(type_formats[type][:-1] or 1)
+            self.input_values[var] = values[i] if n == 1 else values[i:i + n]
+            i += n
+
+    def on_start(self, payload):
+        self.log('received RTDE_CONTROL_PACKAGE_START')
+        self.running = len(self.outputs) > 0
+        send_reply(self.transport, Command.RTDE_CONTROL_PACKAGE_START, struct.pack('>B', self.running), self.args.verbose)
+
+    def on_pause(self, payload):
+        self.log('received RTDE_CONTROL_PACKAGE_PAUSE')
+        self.running = False
+        send_reply(self.transport, Command.RTDE_CONTROL_PACKAGE_PAUSE, struct.pack('>B', True), self.args.verbose)
+
+    # Called on each update of the controller, the `tick`th, to send the data packages that are due
+    def update(self, tick):
+        if not self.running:
+            return
+        if self.transport.get_write_buffer_size() > self.MAX_BACKLOG:
+            self.log('disconnecting, because the client is not keeping up')
+            self.running = False
+            self.transport.close()
+            return
+        if self.cursor:
+            self.cursor.advance(tick)
+            if self.cursor.finished:
+                self.log('disconnecting, at the end of the recording')
+                self.running = False
+                self.transport.close()
+                return
+        # The data packages that are due are packed together into the preallocated buffer, and
+        # written with one call.  What is written is a copy, because a transport may keep a
+        # reference to data it cannot send immediately.
+        n = 0
+        done = None
+        for recipe in self.outputs.values():
+            if tick % recipe.divider != 0 or not recipe.ready():
+                continue
+            recipe.pack_into(self.output_buffer, n, tick)
+            n += recipe.size
+            if recipe.sent == self.args.count:
+                done = recipe
+                break
+        if n > 0:
+            self.transport.write(bytes(memoryview(self.output_buffer)[:n]))
+        if done:
+            self.log('done with {} data packages for recipe {}'.format(done.sent, done.id))
+            self.running = False
+            self.transport.close()
+
+# Simulates the controllers of one or more arms, each listening on its own port, with any number of
+# clients per arm, as one device for `devicesim`.  All the sessions are updated at
+# `CONTROLLER_FREQUENCY`.  Stops after there have been no clients for the timeout.
+class Controllers(devicesim.Device):
+    def __init__(self, args):
+        super().__init__('RTDE controllers', CONTROLLER_FREQUENCY, spinNs=args.spinUs * 1000)
+        self.args = args
+        self.sessions = set()
+        self.servers = []
+        self.idle_since = None
+        # One trajectory per arm, shared by all the arm's clients, or none for the simple values
+        self.trajectories = None
+        if args.trajectory:
+            import trajectory
+            make = trajectory.trajectories[args.trajectory]
+            self.trajectories = [make(CONTROLLER_FREQUENCY, args.model, args.seed, arm) for arm in range(args.arms)]
+            for arm_trajectory in self.trajectories:
+                arm_trajectory.chunk(0)
+        # The recorded session to replay to every client, or none
+        self.replay = Replay(CaptureReader(args.replay), args.seekSecs, args.speed) if args.replay else None
+
+    # Computes the next chunk of each trajectory ahead of time, whether or not the arm has clients,
+    # at a different update for each arm, so no update has to compute more than one chunk, and
+    # clients connecting at the same time do not make an update compute a chunk for each.
+    def prefetch(self, tick):
+        for arm, trajectory in enumerate(self.trajectories):
+            chunk_ticks = trajectory.chunk_ticks
+            if tick % chunk_ticks == arm * chunk_ticks // len(self.trajectories):
+                trajectory.chunk(tick // chunk_ticks + 1)
+
+    async def start(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        for arm in range(self.args.arms):
+            port = self.args.port + arm
+            self.servers.append(await loop.create_server(lambda arm=arm: Session(arm, self), self.args.host, port))
+            print('[{}] Server listening, arm {}, port {}'.format(datetime.datetime.now(), arm, port))
+        self.idle_since = time.monotonic()
+
+    # Updates all the sessions for each of the controller's updates in `ticks`
+    def send(self, ticks):
+        for tick in ticks:
+            for session in list(self.sessions):
+                session.update(tick)
+            if self.trajectories:
+                self.prefetch(tick)
+
+    def finished(self):
+        if self.sessions:
+            self.idle_since = None
+        elif self.idle_since is None:
+            self.idle_since = time.monotonic()
+        return self.idle_since is not None and time.monotonic() - self.idle_since > self.args.timeout
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+
+    def report(self):
+        self.scheduler.report()
+
+# A capture of RTDE sessions, from `--record`, is a log of the packets sent in either direction
+# between clients and a controller: a `CAPTURE_HEADER` (the magic value, and the wall-clock start
+# time, in nanoseconds since the epoch), and then for each packet a `CAPTURE_RECORD` (nanoseconds
+# since the start, the number of the client's connection, and the direction) followed by the
+# packet, header included.  The log is only appended to, so it is usable even if the recording
+# stops abruptly.  An index, in a file with '.idx' appended to the log's path, has a
+# `CAPTURE_INDEX` (nanoseconds since the start, and position in the log) for each record, so
+# seeking to a time does not involve reading the log.
+CAPTURE_MAGIC = b'RTDECAP1'
+CAPTURE_HEADER = struct.Struct('<8sq')
+CAPTURE_RECORD = struct.Struct('<qHB')
+CAPTURE_INDEX = struct.Struct('<qq')
+FROM_CLIENT = 0
+FROM_CONTROLLER = 1
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.index = open(path + '.idx', 'wb')
+        self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time_ns()))
+        self.position = CAPTURE_HEADER.size
+        self.start_ns = time.perf_counter_ns()
+        self.count = 0
+
+    # Adds the packet with command `cmd` and `payload`, sent now in `direction` on `connection`
+    def write(self, connection, direction, cmd, payload):
+        offset_ns = time.perf_counter_ns() - self.start_ns
+        size = FramedProtocol.HEADER_SIZE + len(payload)
+        self.index.write(CAPTURE_INDEX.pack(offset_ns, self.position))
+        self.file.write(CAPTURE_RECORD.pack(offset_ns, connection, direction))
+        self.file.write(struct.pack(FMT_HEADER, size, cmd))
+        self.file.write(payload)
+        self.position += CAPTURE_RECORD.size + size
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+# Reads a capture through a memory map, so a long capture is not loaded into memory
+class CaptureReader:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.size = len(self.map)
+        magic, self.start_time_ns = CAPTURE_HEADER.unpack_from(self.map)
+        if magic != CAPTURE_MAGIC:
+            raise ValueError("'{}' is not a RTDE capture".format(path))
+        self.index = None
+        self.index_count = 0
+        if os.path.exists(path + '.idx') and os.path.getsize(path + '.idx') >= CAPTURE_INDEX.size:
+            with open(path + '.idx', 'rb') as f:
+                self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.index_count = len(self.index) // CAPTURE_INDEX.size
+
+    # Returns the record at `position` as (offset_ns, connection, direction, cmd, payload,
+    # next_position), with `payload` a `memoryview` of the map, or None at the end of the capture
+    # (including a partial record at the end of a capture that was not closed).
+    def read(self, position):
+        start = position + CAPTURE_RECORD.size + FramedProtocol.HEADER_SIZE
+        if start > self.size:
+            return None
+        offset_ns, connection, direction = CAPTURE_RECORD.unpack_from(self.map, position)
+        size, cmd = struct.unpack_from(FMT_HEADER, self.map, position + CAPTURE_RECORD.size)
+        next_position = position + CAPTURE_RECORD.size + size
+        if size < FramedProtocol.HEADER_SIZE or next_position > self.size:
+            return None
+        return offset_ns, connection, direction, cmd, self.view[start:next_position], next_position
+
+    def records(self, position=CAPTURE_HEADER.size):
+        while True:
+            record = self.read(position)
+            if record is None:
+                return
+            yield record
+            position = record[-1]
+
+    # Returns the position of the first record at or after `offset_ns`, found with a binary search
+    # of the index, or by reading the log if there is no index
+    def seek(self, offset_ns):
+        if self.index is None:
+            for record in self.records():
+                if record[0] >= offset_ns:
+                    return record[-1] - CAPTURE_RECORD.size - FramedProtocol.HEADER_SIZE - len(record[4])
+            return self.size
+        lo = 0
+        hi = self.index_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if CAPTURE_INDEX.unpack_from(self.index, mid * CAPTURE_INDEX.size)[0] < offset_ns:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.index_count:
+            return self.size
+        return CAPTURE_INDEX.unpack_from(self.index, lo * CAPTURE_INDEX.size)[1]
+
+# The data packages of a recorded session, to be replayed to clients.  The session replayed is that
+# of the first connection in the capture to receive data packages, and its output recipes are those
+# set up before its first data package (a recipe set up after a pause is not replayed).  Replay
+# starts with the first data package at or after `seek_secs` into the capture, with the recorded
+# timing scaled by `speed`, so a client gets the values of the most recent recorded data package
+# at each update, at whatever frequency it requests.
+class Replay:
+    def __init__(self, reader, seek_secs=0, speed=1):
+        self.reader = reader
+        self.ns_per_tick = 1e9 / CONTROLLER_FREQUENCY * speed
+        self.connection = None
+        requests = {}
+        recipes = {}
+        for offset_ns, connection, direction, cmd, payload, _ in reader.records():
+            if cmd == Command.RTDE_CONTROL_PACKAGE_SETUP_OUTPUTS:
+                # The replies come in the order of the requests, which a client may send together
+                if direction == FROM_CLIENT:
+                    requests.setdefault(connection, []).append(str(payload[struct.calcsize('>d'):], 'utf-8').split(','))
+                elif requests.get(connection):
+                    vars = requests[connection].pop(0)
+                    if payload[0] != 0:
+                        vars_types = str(payload[1:], 'utf-8').split(',')
+                        recipes.setdefault(connection, []).append((payload[0], vars, vars_types))
+            elif cmd == Command.RTDE_DATA_PACKAGE and direction == FROM_CONTROLLER:
+                self.connection = connection
+                break
+        if self.connection is None:
+            raise ValueError('the capture has no data packages')
 
-            fmt_req_payload = '>H'
-            (version, ) = struct.unpack_from(fmt_req_payload, buf, struct.calcsize(FMT_HEADER))
+        # The type of each recorded variable, and the recorded recipe and range of bytes in the
+        # payload of its data packages (after the recipe id), from the first recipe having it
+        self.types = {}
+        self.sources = {}
+        for recorded_id, vars, vars_types in recipes.get(self.connection, []):
+            start = 1
+            for var, type in zip(vars, vars_types):
+                if type not in type_formats:
+                    # The positions of the variables after one of an unknown type are unknown too
+                    break
+                end = start + struct.calcsize('>' + type_formats[type])
+                if var not in self.types:
+                    self.types[var] = type
+                    self.sources[var] = (recorded_id, start, end)
+                start = end
 
-            print('[{}] Server received request for protocol version {}'.format(datetime.datetime.now(), version))
+        self.start_position = reader.seek(int(seek_secs * 1e9))
+        for offset_ns, connection, direction, cmd, payload, next_position in reader.records(self.start_position):
+            if connection == self.connection and direction == FROM_CONTROLLER and cmd == Command.RTDE_DATA_PACKAGE:
+                self.start_ns = offset_ns
+                break
+            self.start_position = next_position
+        else:
+            raise ValueError('the capture has no data packages after {} s'.format(seek_secs))
+
+# A session's position in a `Replay`.  The recording plays from when the client first starts output.
+class ReplayCursor:
+    def __init__(self, replay):
+        self.replay = replay
+        self.position = replay.start_position
+        # The payload of the most recent data package of each recorded recipe, by recipe id
+        self.latest = {}
+        self.start_tick = None
+        self.finished = False
+
+    # Passes the records up to the time of controller update `tick`
+    def advance(self, tick):
+        replay = self.replay
+        if self.start_tick is None:
+            self.start_tick = tick
+        until_ns = replay.start_ns + (tick - self.start_tick) * replay.ns_per_tick
+        read = replay.reader.read
+        while True:
+            record = read(self.position)
+            if record is None:
+                self.finished = True
+                return
+            offset_ns, connection, direction, cmd, payload, next_position = record
+            if offset_ns > until_ns:
+                return
+            if connection == replay.connection and direction == FROM_CONTROLLER and cmd == Command.RTDE_DATA_PACKAGE:
+                self.latest[payload[0]] = payload
+            self.position = next_position
 
-            fmt_reply_payload = '>B'
-            payload = struct.pack(fmt_reply_payload, (version == RTDE_PROTOCOL_VERSION_2))
-            send_reply(conn, Command.RTDE_REQUEST_PROTOCOL_VERSION, payload)
+# Records the sessions of clients with a real controller at `args.robot`, as a proxy: each client
+# connecting to the port gets its own connection to the controller, and every packet in either
+# direction is forwarded and written to the capture.  Stops after there have been no clients for
+# the timeout.
+class Recorder:
+    def __init__(self, args):
+        self.args = args
+        host, _, port = args.robot.partition(':')
+        self.robot_address = (host, int(port or RTDE_PORT))
+        self.writer = CaptureWriter(args.record)
+        self.proxies = set()
+        self.connections = 0
 
-            (buf, size) = receive_cmd(conn, Command.RTDE_GET_URCONTROL_VERSION, 'RTDE_GET_URCONTROL_VERSION')
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: RecordingProxy(self), self.args.host, self.args.port)
+        print('[{}] Recorder listening, port {}, for controller {}'.format(datetime.datetime.now(), self.args.port, self.robot_address))
+        idle_since = loop.time()
+        try:
+            while True:
+                await asyncio.sleep(0.1)
+                if self.proxies:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = loop.time()
+                elif loop.time() - idle_since > self.args.timeout:
+                    break
+        finally:
+            server.close()
+            self.writer.close()
+            print('[{}] Recorded {} packets from {} connections'.format(datetime.datetime.now(), self.writer.count, self.connections))
 
-            fmt_reply_payload = '>LLLL'
-            payload = struct.pack(fmt_reply_payload, 3, 2, 19171, 0)
-            send_reply(conn, Command.RTDE_GET_URCONTROL_VERSION, payload)
+# The client's side of a connection through the `Recorder`
+class RecordingProxy(FramedProtocol):
+    def __init__(self, recorder):
+        super().__init__()
+        self.recorder = recorder
+        self.connection = recorder.connections
+        recorder.connections += 1
+        self.address = None
+        self.controller = None
+        # Packets from the client before the connection to the controller is made
+        self.pending = []
+        self.connecting = None
 
-            (buf, size) = receive_cmd(conn, Command.RTDE_CONTROL_PACKAGE_SETUP_OUTPUTS, 'RTDE_CONTROL_PACKAGE_SETUP_OUTPUTS')
+    def log(self, text):
+        print('[{}] Recorder, connection {}, client {}: {}'.format(datetime.datetime.now(), self.connection, self.address, text))
 
-            vars_size = size - struct.calcsize(FMT_HEADER) - struct.calcsize('>d')
-            fmt_req_payload = '>d{}s'.format(vars_size)
-            (freq, vars_bytes) = struct.unpack_from(fmt_req_payload, buf, struct.calcsize(FMT_HEADER))
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.address = transport.get_extra_info('peername')
+        self.recorder.proxies.add(self)
+        self.log('connected')
+        self.connecting = asyncio.get_running_loop().create_task(self.connect())
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        try:
+            _, self.controller = await loop.create_connection(lambda: ControllerConnection(self), *self.recorder.robot_address)
+        except OSError as e:
+            self.log('cannot connect to the controller: {}'.format(e))
+            self.transport.close()
+            return
+        if self.transport.is_closing():
+            self.controller.transport.close()
+            return
+        for packet in self.pending:
+            self.controller.transport.write(packet)
+        self.pending = None
+
+    def packet_received(self, cmd, payload):
+        self.recorder.writer.write(self.connection, FROM_CLIENT, cmd, payload)
+        packet = struct.pack(FMT_HEADER, self.HEADER_SIZE + len(payload), cmd) + payload
+        if self.pending is None:
+            self.controller.transport.write(packet)
+        else:
+            self.pending.append(packet)
 
-            print('[{}] Server received request for output at frequency {} Hz'.format(datetime.datetime.now(), freq))
+    def connection_lost(self, exc):
+        self.recorder.proxies.discard(self)
+        if self.controller:
+            self.controller.transport.close()
+        self.log('disconnected, after {} packets from the client'.format(self.packets))
 
-            vars = vars_bytes.decode('utf-8').split(',')
-            vars_types = ','.join([types[v] for v in vars])
-            vars_types_bytes = vars_types.encode('utf-8')
+# The controller's side of a connection through the `Recorder`
+class ControllerConnection(FramedProtocol):
+    def __init__(self, proxy):
+        super().__init__()
+        self.proxy = proxy
 
-            recipe_id = 1
-            fmt_reply_payload = '>b{}s'.format(len(vars_types_bytes))
-            payload = struct.pack(fmt_reply_payload, recipe_id, vars_types_bytes)
-            send_reply(conn, Command.RTDE_CONTROL_PACKAGE_SETUP_OUTPUTS, payload)
+    def packet_received(self, cmd, payload):
+        self.proxy.recorder.writer.write(self.proxy.connection, FROM_CONTROLLER, cmd, payload)
+        self.proxy.transport.write(struct.pack(FMT_HEADER, self.HEADER_SIZE + len(payload), cmd) + payload)
 
-            (buf, size) = receive_cmd(conn, Command.RTDE_CONTROL_PACKAGE_START, 'RTDE_CONTROL_PACKAGE_START')
+    def connection_lost(self, exc):
+        self.proxy.transport.close()
 
-            fmt_reply_payload = '>B'
-            payload = struct.pack(fmt_reply_payload, True)
-            send_reply(conn, Command.RTDE_CONTROL_PACKAGE_START, payload)
+# Returns the parser for the command-line arguments, which `devicesim` also uses for a rig.
+def argumentParser(prog=None):
+    parser = argparse.ArgumentParser(prog)
+    devicesim.addArguments(parser, streams=False)
+    parser.set_defaults(arms=1)
+    parser.add_argument('--arms', '-n', type=int, dest='arms', help='number of arms to simulate, on consecutive ports starting at --port')
+    parser.set_defaults(count=2000)
+    parser.add_argument('--count', '-c', type=int, dest='count', help='data packages per output recipe before disconnecting a client (0 for no limit)')
+    parser.set_defaults(useSine=False)
+    parser.add_argument("--sine", "-s", dest="useSine", action="store_true", help="produce sinusoidal joint angles")
+    parser.set_defaults(angleFactor=0.01)
+    parser.add_argument("--afactor", "-af", type=float, dest="angleFactor", help="base rotate rate")
+    parser.set_defaults(trajectory=None)
+    parser.add_argument("--trajectory", "-tr", dest="trajectory", choices=["moves", "sweep"], help="move the arms realistically, with point-to-point moves or a continuous sweep (needs NumPy; overrides --sine)")
+    parser.set_defaults(model="UR5e")
+    parser.add_argument("--model", "-m", dest="model", choices=["UR3", "UR5", "UR10", "UR3e", "UR5e", "UR10e", "UR16e"], help="model of the arms, for --trajectory")
+    parser.set_defaults(seed=0)
+    parser.add_argument("--seed", type=int, dest="seed", help="seed for the random parts of --trajectory (each arm moves differently)")
+    parser.set_defaults(record=None)
+    parser.add_argument("--record", dest="record", help="record the sessions of clients with the --robot controller to this file, as a proxy")
+    parser.set_defaults(robot=None)
+    parser.add_argument("--robot", dest="robot", help="host[:port] of the real controller, for --record (default port: {})".format(RTDE_PORT))
+    parser.set_defaults(replay=None)
+    parser.add_argument("--replay", dest="replay", help="send the data packages recorded in this file instead of generated values")
+    parser.set_defaults(speed=1.0)
+    parser.add_argument("--speed", type=float, dest="speed", help="speed of --replay relative to the recording (e.g., 0.5 for half speed)")
+    parser.set_defaults(seekSecs=0)
+    parser.add_argument("--seek", type=float, dest="seekSecs", help="start --replay this long into the recording (sec)")
+    parser.set_defaults(verbose=True)
+    parser.add_argument("--quiet", "-q", dest="verbose", action="store_false", help="do not print each reply")
+    return parser
 
-            for i in range(args.count):
-                payload = struct.pack('>B', recipe_id)
-                for var in vars:
-                    type = types[var]
-                    sine = (var == 'actual_q' and args.useSine)
-                    payload += pack(type, i, sine, args.angleFactor)
-                send_reply(conn, Command.RTDE_DATA_PACKAGE, payload, False)
-                time.sleep(1 / freq)
+# Returns the device for the arguments, for `devicesim`.
+def makeDevice(args):
+    return Controllers(args)
 
-            print('[{}] Server done'.format(datetime.datetime.now(), args.count))
+if __name__ == '__main__':
+    print('[{}] Server starting'.format(datetime.datetime.now()))
+
+    argv = sys.argv
+    if '--' not in argv:
+        argv = []
+    else:
+        argv = argv[argv.index('--') + 1:]
+
+    parser = argumentParser(argv)
+    args = parser.parse_args()
+    if args.record and not args.robot:
+        parser.error('--record requires --robot')
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+
+    if args.record:
+        recorder = Recorder(args)
+        try:
+            asyncio.run(recorder.serve())
+        except KeyboardInterrupt:
+            pass
+    else:
+        devicesim.run([makeDevice(args)])
+    print('[{}] Server done'.format(datetime.datetime.now()))
@@ -0,0 +1,147 @@
+# Tests the framing of RTDE packets by `FramedProtocol` in fake-rtde-controller.py, by feeding
+# it byte streams split in various ways, as TCP may deliver them, and checking that each packet
+# is dispatched once, as a view of the protocol's buffer, with one read per piece of the stream
+# and data moved only when the buffer is nearly full.
+# python -m unittest test_framing.py
+
+import importlib.util
+import os
+import random
+import struct
+import unittest
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake-rtde-controller.py')
+spec = importlib.util.spec_from_file_location('fake_rtde_controller', path)
+controller = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(controller)
+
+FramedProtocol = controller.FramedProtocol
+
+class FakeTransport:
+    def __init__(self):
+        self.closed = False
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return None
+
+# Records the packets dispatched, checking that each payload is a view of the protocol's buffer
+# rather than a copy.
+class RecordingProtocol(FramedProtocol):
+    def __init__(self, test):
+        super().__init__()
+        self.test = test
+        self.received = []
+        self.connection_made(FakeTransport())
+
+    def packet_received(self, cmd, payload):
+        self.test.assertIsInstance(payload, memoryview)
+        self.test.assertIs(payload.obj, self.buffer)
+        self.received.append((cmd, bytes(payload)))
+
+def packet(cmd, payload):
+    return struct.pack(controller.FMT_HEADER, FramedProtocol.HEADER_SIZE + len(payload), cmd) + payload
+
+# Returns `n` packets with payloads of random sizes up to `max_payload`, and the stream of them.
+def random_packets(rng, n, max_payload):
+    packets = []
+    for i in range(n):
+        payload = rng.randbytes(rng.randrange(max_payload + 1))
+        packets.append((controller.Command.RTDE_DATA_PACKAGE if i % 2 else controller.Command.RTDE_TEXT_MESSAGE, payload))
+    return packets, b''.join(packet(cmd, payload) for cmd, payload in packets)
+
+# Feeds `data` to `protocol` in pieces of the sizes `sizes`, as the event loop does, and
+# returns the number of pieces.
+def feed(protocol, data, sizes):
+    pos = 0
+    pieces = 0
+    for size in sizes:
+        piece = data[pos:pos + size]
+        if not piece:
+            break
+        buf = protocol.get_buffer(-1)
+        assert len(buf) >= len(piece)
+        buf[:len(piece)] = piece
+        protocol.buffer_updated(len(piece))
+        pos += len(piece)
+        pieces += 1
+    assert pos == len(data)
+    return pieces
+
+def random_sizes(rng, max_size):
+    while True:
+        yield rng.randrange(1, max_size + 1)
+
+class TestFraming(unittest.TestCase):
+    def test_pipelined(self):
+        rng = random.Random(1)
+        packets, data = random_packets(rng, 20000, 40)
+        protocol = RecordingProtocol(self)
+        # Fifty whole packets in each read, in a stream that would fill the buffer several times.
+        sizes = [len(b''.join(packet(cmd, payload) for cmd, payload in packets[i:i + 50])) for i in range(0, len(packets), 50)]
+        pieces = feed(protocol, data, sizes)
+        self.assertEqual(protocol.received, packets)
+        self.assertEqual(protocol.reads, pieces)
+        self.assertEqual(protocol.packets, len(packets))
+        # Each read leaves the buffer empty, so the next read goes at the beginning.
+        self.assertEqual(protocol.moves, 0)
+        self.assertEqual(protocol.bytes_moved, 0)
+
+    def test_byte_at_a_time(self):
+        rng = random.Random(2)
+        packets, data = random_packets(rng, 200, 40)
+        protocol = RecordingProtocol(self)
+        feed(protocol, data, iter(lambda: 1, None))
+        self.assertEqual(protocol.received, packets)
+        self.assertEqual(protocol.reads, len(data))
+        # Each packet is dispatched when its last byte arrives, and then the buffer is empty, so
+        # nothing is ever moved.
+        self.assertEqual(protocol.moves, 0)
+        self.assertEqual(protocol.bytes_moved, 0)
+
+    def test_random_splits(self):
+        moves = 0
+        for seed in range(20):
+            rng = random.Random(seed)
+            max_payload = rng.choice([10, 1000, FramedProtocol.MAX_PACKET_SIZE - FramedProtocol.HEADER_SIZE])
+            # Fewer of the large packets, which still fill the buffer several times.
+            packets, data = random_packets(rng, 300 if max_payload <= 1000 else 30, max_payload)
+            protocol = RecordingProtocol(self)
+            pieces = feed(protocol, data, random_sizes(rng, rng.choice([7, 500, FramedProtocol.MAX_PACKET_SIZE])))
+            self.assertEqual(protocol.received, packets)
+            self.assertEqual(protocol.reads, pieces)
+            self.assertEqual(protocol.packets, len(packets))
+            # A move copies only the start of one packet, and happens only after the space
+            # behind the last move has been used.
+            max_packet = FramedProtocol.HEADER_SIZE + max(len(payload) for _, payload in packets)
+            self.assertLess(protocol.bytes_moved, max(protocol.moves, 1) * max_packet)
+            self.assertLessEqual(protocol.moves, len(data) // (FramedProtocol.MAX_PACKET_SIZE + 1 - max_packet + 1))
+            moves += protocol.moves
+        # The streams are long enough to fill the buffer, so the moving is tested too.
+        self.assertGreater(moves, 0)
+
+    def test_maximum_size_packets(self):
+        payload = bytes(FramedProtocol.MAX_PACKET_SIZE - FramedProtocol.HEADER_SIZE)
+        packets = [(controller.Command.RTDE_DATA_PACKAGE, payload)] * 10
+        data = b''.join(packet(cmd, payload) for cmd, payload in packets)
+        protocol = RecordingProtocol(self)
+        # Each packet straddles two reads.
+        feed(protocol, data, iter(lambda: FramedProtocol.MAX_PACKET_SIZE - 1000, None))
+        self.assertEqual(protocol.received, packets)
+
+    def test_undersized_length_closes(self):
+        protocol = RecordingProtocol(self)
+        good = packet(controller.Command.RTDE_TEXT_MESSAGE, b'ok')
+        bad = struct.pack(controller.FMT_HEADER, FramedProtocol.HEADER_SIZE - 1, controller.Command.RTDE_TEXT_MESSAGE)
+        feed(protocol, good + bad + good, [len(good + bad + good)])
+        self.assertTrue(protocol.transport.closed)
+        # The packet before the bad one is dispatched, but nothing after it.
+        self.assertEqual(protocol.received, [(controller.Command.RTDE_TEXT_MESSAGE, b'ok')])
+
+if __name__ == '__main__':
+    unittest.main()
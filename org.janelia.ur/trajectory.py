@@ -0,0 +1,301 @@
+# Realistic motion of a Universal Robots arm for fake-rtde-controller.py, with every output
+# variable consistent with the others.  A trajectory gives the target joint angles as a function
+# of time, repeatably for a seed, and everything else is derived from the joint angles: the
+# velocities and accelerations by finite differences, the TCP pose by forward kinematics with the
+# arm's Denavit-Hartenberg parameters, the TCP speed and the tool accelerometer from the pose, and
+# the joint moments and currents from a simple model of gravity and friction.  The actual values
+# follow the target values a few updates behind, as with a real controller.
+
+# The values are computed with NumPy for a "chunk" of controller updates at a time (a fifth of a
+# second's worth, by default), and the most recent chunks are kept, so the sessions of all the
+# clients of an arm share them.  A chunk takes about a millisecond to compute, most of it fixed
+# overhead, so bigger chunks would use less time overall but could delay an update.  Each output
+# recipe is then encoded for a whole chunk at once, into the bytes of its data packages, so
+# sending a package involves no per-package math.
+
+import math
+
+import numpy as np
+
+# Denavit-Hartenberg parameters (d and a, in meters) and link masses (kg) of each model, from
+# https://www.universal-robots.com/articles/ur/application-installation/dh-parameters-for-calculations-of-kinematics-and-dynamics/
+models = {
+   'UR3' : ([0.1519, 0, 0, 0.11235, 0.08535, 0.0819], [0, -0.24365, -0.21325, 0, 0, 0], [2, 3.42, 1.26, 0.8, 0.8, 0.35]),
+   'UR5' : ([0.089159, 0, 0, 0.10915, 0.09465, 0.0823], [0, -0.425, -0.39225, 0, 0, 0], [3.7, 8.393, 2.33, 1.219, 1.219, 0.1879]),
+   'UR10' : ([0.1273, 0, 0, 0.163941, 0.1157, 0.0922], [0, -0.612, -0.5723, 0, 0, 0], [7.1, 12.7, 4.27, 2, 2, 0.365]),
+   'UR3e' : ([0.15185, 0, 0, 0.13105, 0.08535, 0.0921], [0, -0.24355, -0.2132, 0, 0, 0], [1.98, 3.4445, 1.437, 0.871, 0.805, 0.261]),
+   'UR5e' : ([0.1625, 0, 0, 0.1333, 0.0997, 0.0996], [0, -0.425, -0.3922, 0, 0, 0], [3.761, 8.058, 2.846, 1.37, 1.3, 0.365]),
+   'UR10e' : ([0.1807, 0, 0, 0.17415, 0.11985, 0.11655], [0, -0.6127, -0.57155, 0, 0, 0], [7.369, 13.051, 3.989, 2.1, 1.98, 0.615]),
+   'UR16e' : ([0.1807, 0, 0, 0.17415, 0.11985, 0.11655], [0, -0.4784, -0.36, 0, 0, 0], [7.369, 10.45, 4.321, 2.18, 2.033, 0.907])
+}
+
+# The alpha Denavit-Hartenberg parameters (radians) are the same for all the models
+DH_ALPHA = [math.pi / 2, 0, 0, math.pi / 2, -math.pi / 2, 0]
+
+GRAVITY = np.array([0, 0, -9.82])
+
+# The joint angles (radians) of the pose where a trajectory starts, with the tool pointing down,
+# and how far from it (plus or minus) the trajectories go for each joint
+HOME = np.array([0, -math.pi / 2, math.pi / 2, -math.pi / 2, -math.pi / 2, 0])
+SPAN = np.array([1.5, 0.5, 0.8, 0.8, 0.8, 1.5])
+
+# A rough model of the drive of each joint: the reflected inertia of the motor (kg m^2), the
+# viscous friction (N m s/rad), and the torque per unit of current (N m/A)
+MOTOR_INERTIA = np.array([2.0, 2.0, 1.0, 0.2, 0.2, 0.2])
+FRICTION = np.array([3.0, 3.0, 2.0, 0.5, 0.5, 0.5])
+TORQUE_CONSTANT = np.array([13.5, 13.5, 13.5, 9.0, 9.0, 9.0])
+
+# The modes reported while a program is running
+ROBOT_MODE_RUNNING = 7
+JOINT_MODE_RUNNING = 253
+SAFETY_MODE_NORMAL = 1
+RUNTIME_STATE_PLAYING = 2
+
+# The NumPy type of each type of data item in a data package
+type_dtypes = {
+   'BOOL' : '?',
+   'UINT8' : 'u1',
+   'UINT32' : '>u4',
+   'UINT64' : '>u8',
+   'INT32' : '>i4',
+   'DOUBLE' : '>f8',
+   'VECTOR3D' : ('>f8', 3),
+   'VECTOR6D' : ('>f8', 6),
+   'VECTOR6INT32' : ('>i4', 6),
+   'VECTOR6UINT32' : ('>u4', 6)
+}
+
+# Returns the frames of the base and each joint of an arm with the Denavit-Hartenberg parameters
+# `d` and `a`, for each row of joint angles `q`, as an array of 4x4 transforms of shape (n, 7, 4, 4).
+def forward_kinematics(q, d, a):
+    n = len(q)
+    ct = np.cos(q)
+    st = np.sin(q)
+    ca = np.cos(DH_ALPHA)
+    sa = np.sin(DH_ALPHA)
+    # The transform from the frame of each joint to the next, all at once, of shape (n, 6, 4, 4)
+    t = np.zeros((n, 6, 4, 4))
+    t[:, :, 0, 0] = ct
+    t[:, :, 0, 1] = -st * ca
+    t[:, :, 0, 2] = st * sa
+    t[:, :, 0, 3] = a * ct
+    t[:, :, 1, 0] = st
+    t[:, :, 1, 1] = ct * ca
+    t[:, :, 1, 2] = -ct * sa
+    t[:, :, 1, 3] = a * st
+    t[:, :, 2, 1] = sa
+    t[:, :, 2, 2] = ca
+    t[:, :, 2, 3] = d
+    t[:, :, 3, 3] = 1
+    frames = np.empty((n, 7, 4, 4))
+    frames[:, 0] = np.eye(4)
+    for i in range(6):
+        frames[:, i + 1] = frames[:, i] @ t[:, i]
+    return frames
+
+# Returns the rotation vectors (axis times angle, as in a UR pose) of the rotation matrices `r`,
+# of shape (n, 3, 3).
+def rotation_vector(r):
+    cos = np.clip((np.trace(r, axis1=1, axis2=2) - 1) / 2, -1, 1)
+    angle = np.arccos(cos)
+    v = np.stack([r[:, 2, 1] - r[:, 1, 2], r[:, 0, 2] - r[:, 2, 0], r[:, 1, 0] - r[:, 0, 1]], axis=1)
+    sin = np.sin(angle)
+    # The length of `v` is 2 sin(angle), which is accurate enough except near 0 (where the rotation
+    # vector tends to v / 2) and near pi.
+    scale = np.where(sin > 1e-6, angle / np.maximum(2 * sin, 1e-12), 0.5)
+    result = v * scale[:, None]
+    near_pi = (sin <= 1e-6) & (cos < 0)
+    if near_pi.any():
+        # The axis is the column of (r + I) / 2 with the largest diagonal element, normalized.
+        b = (r[near_pi] + np.eye(3)) / 2
+        j = np.argmax(np.diagonal(b, axis1=1, axis2=2), axis=1)
+        k = np.arange(len(b))
+        axis = b[k, :, j] / np.sqrt(b[k, j, j])[:, None]
+        result[near_pi] = axis * angle[near_pi, None]
+    return result
+
+# The base class for trajectories, which computes all the output variables from the target joint
+# angles given by the `positions` function of a subclass.  The values for controller update `tick`
+# are those at time `tick / frequency`.
+class ArmTrajectory:
+    # The actual values are those of the target values this many updates earlier
+    TRACKING_LAG = 2
+    # How many chunks to keep
+    RING_SIZE = 3
+
+    def __init__(self, frequency, model='UR5e', seed=0, arm=0, chunk_ticks=None):
+        self.frequency = frequency
+        self.dt = 1 / frequency
+        self.d, self.a, masses = [np.array(x, dtype=float) for x in models[model]]
+        self.masses = masses
+        self.seed = seed
+        self.arm = arm
+        self.chunk_ticks = chunk_ticks or frequency // 5
+        self.ring = {}
+        self.chunks_computed = 0
+
+    # Returns the target joint angles at the times `t` (seconds), as an array of shape (n, 6)
+    def positions(self, t):
+        raise NotImplementedError
+
+    # Returns a `PackageEncoder` for data packages with values from this trajectory
+    def encoder(self, header, vars, types):
+        return PackageEncoder(header, vars, types)
+
+    # Returns the values of all the output variables for chunk `index`, which holds the updates from
+    # `index * chunk_ticks` up to (but not including) `(index + 1) * chunk_ticks`, as a dictionary
+    # with an array having a row per update, or a scalar for a constant, for each variable.
+    def chunk(self, index):
+        values = self.ring.get(index)
+        if values is None:
+            values = self._compute(index)
+            self.ring[index] = values
+            self.chunks_computed += 1
+            while len(self.ring) > self.RING_SIZE:
+                del self.ring[min(self.ring)]
+        return values
+
+    def _compute(self, index):
+        n = self.chunk_ticks
+        lag = self.TRACKING_LAG
+        # Two extra updates at each end, so the second differences are central for every update
+        # returned, and enough extra at the start for the actual values.
+        pad = 2
+        tick0 = index * n
+        ticks = np.arange(tick0 - lag - pad, tick0 + n + pad)
+        t = ticks * self.dt
+        target = slice(lag + pad, lag + pad + n)
+        actual = slice(pad, pad + n)
+
+        q = self.positions(t)
+        qd = np.gradient(q, self.dt, axis=0)
+        qdd = np.gradient(qd, self.dt, axis=0)
+
+        frames = forward_kinematics(q, self.d, self.a)
+        origins = frames[:, :, :3, 3]
+        z_axes = frames[:, :, :3, 2]
+        tool = frames[:, 6, :3, :3]
+        pose = np.concatenate([origins[:, 6], rotation_vector(tool)], axis=1)
+        velocity = np.gradient(origins[:, 6], self.dt, axis=0)
+        acceleration = np.gradient(velocity, self.dt, axis=0)
+        # The angular velocity is the axial vector of the skew-symmetric (dR/dt) R^T.
+        w = np.gradient(tool, self.dt, axis=0) @ np.transpose(tool, (0, 2, 1))
+        angular = np.stack([w[:, 2, 1], w[:, 0, 2], w[:, 1, 0]], axis=1)
+        speed = np.concatenate([velocity, angular], axis=1)
+        # The accelerometer measures the acceleration minus gravity, in the tool frame.
+        accelerometer = np.einsum('nji,nj->ni', tool, acceleration - GRAVITY)
+
+        # The moment each joint needs to hold up the links beyond it (each link's mass taken to be
+        # halfway between its joints), plus to accelerate its motor and overcome friction.
+        centers = (origins[:, :-1] + origins[:, 1:]) / 2
+        # The torque of the weights of links i and beyond about the origin of joint i is the sum of
+        # (center - origin) x weight, so it follows from suffix sums over the links.
+        weights = self.masses[:, None] * GRAVITY
+        beyond = np.cumsum(np.cross(centers, weights)[:, ::-1], axis=1)[:, ::-1]
+        torque = beyond - np.cross(origins[:, :6], np.cumsum(weights[::-1], axis=0)[::-1])
+        moment = -(z_axes[:, :6] * torque).sum(axis=2)
+        moment += MOTOR_INERTIA * qdd + FRICTION * qd
+        current = moment / TORQUE_CONSTANT
+        momentum = np.linalg.norm((self.masses[:, None] * np.gradient(centers, self.dt, axis=0)).sum(axis=1), axis=1)
+
+        rng = np.random.default_rng([self.seed, self.arm, index])
+        actual_current = current[actual] + rng.normal(0, 0.02, (n, 6))
+        power = np.maximum((moment[actual] * qd[actual]).sum(axis=1), 0)
+        secs = ticks[target] * self.dt
+        return {
+           'timestamp' : secs,
+           'target_q' : q[target],
+           'target_qd' : qd[target],
+           'target_qdd' : qdd[target],
+           'target_current' : current[target],
+           'target_moment' : moment[target],
+           'actual_q' : q[actual],
+           'actual_qd' : qd[actual],
+           'actual_current' : actual_current,
+           'joint_control_output' : current[target],
+           'actual_TCP_pose' : pose[actual],
+           'actual_TCP_speed' : speed[actual],
+           'actual_TCP_force' : rng.normal(0, [0.5, 0.5, 0.5, 0.02, 0.02, 0.02], (n, 6)),
+           'target_TCP_pose' : pose[target],
+           'target_TCP_speed' : speed[target],
+           'actual_digital_input_bits' : 0,
+           'joint_temperatures' : 25 + np.outer(1 - np.exp(-secs / 1800), [10, 12, 10, 6, 6, 5]),
+           'actual_execution_time' : 0.3 + np.abs(rng.normal(0, 0.05, n)),
+           'robot_mode' : ROBOT_MODE_RUNNING,
+           'joint_mode' : JOINT_MODE_RUNNING,
+           'safety_mode' : SAFETY_MODE_NORMAL,
+           'actual_tool_accelerometer' : accelerometer[actual],
+           'speed_scaling' : 1.0,
+           'target_speed_fraction' : 1.0,
+           'actual_momentum' : momentum[actual],
+           'actual_main_voltage' : 48.0,
+           'actual_robot_voltage' : 48.0,
+           'actual_robot_current' : 0.6 + power / 48.0,
+           'actual_joint_voltage' : 48.0,
+           'actual_digital_output_bits' : 0,
+           'runtime_state' : RUNTIME_STATE_PLAYING
+        }
+
+# Point-to-point moves, like those of a typical robot program: every `period` seconds the arm
+# moves to a new random pose, with the smooth (minimum jerk) profile of position over time, taking
+# a random part of the period and then waiting for the rest.  The first pose is `HOME`.
+class Moves(ArmTrajectory):
+    PERIOD = 3.0
+
+    def _waypoint(self, k):
+        if k <= 0:
+            return HOME, self.PERIOD
+        rng = np.random.default_rng([self.seed, self.arm, k])
+        return HOME + rng.uniform(-1, 1, 6) * SPAN, rng.uniform(0.5, 0.9) * self.PERIOD
+
+    def positions(self, t):
+        k = np.floor(t / self.PERIOD).astype(int)
+        k0 = k.min()
+        waypoints, durations = zip(*[self._waypoint(j) for j in range(k0, k.max() + 2)])
+        waypoints = np.array(waypoints)
+        start = waypoints[k - k0]
+        end = waypoints[k - k0 + 1]
+        tau = np.clip((t - k * self.PERIOD) / np.array(durations)[k - k0], 0, 1)
+        s = tau ** 3 * (10 - 15 * tau + 6 * tau ** 2)
+        return start + (end - start) * s[:, None]
+
+# Continuous motion, with each joint following the sum of two sinusoids of random frequencies
+# (about 0.05 to 0.25 Hz), amplitudes and phases, starting at `HOME`.
+class Sweep(ArmTrajectory):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        rng = np.random.default_rng([self.seed, self.arm])
+        self.amplitudes = rng.uniform(0.1, 0.25, (2, 6)) * SPAN
+        self.frequencies = rng.uniform(0.05, 0.25, (2, 6))
+        self.phases = rng.uniform(0, 2 * math.pi, (2, 6))
+
+    def positions(self, t):
+        angles = 2 * math.pi * self.frequencies * t[:, None, None] + self.phases
+        return HOME + (self.amplitudes * (np.sin(angles) - np.sin(self.phases))).sum(axis=1)
+
+# The trajectories that can be chosen with the `--trajectory` argument of fake-rtde-controller.py
+trajectories = {
+   'moves' : Moves,
+   'sweep' : Sweep
+}
+
+# Encodes the data packages of an output recipe, with the `header` values (size, command, recipe id)
+# followed by the variables `vars` of types `types`, for many controller updates at once.
+class PackageEncoder:
+    def __init__(self, header, vars, types):
+        self.header = header
+        self.vars = vars
+        fields = [('size', '>u2'), ('command', 'u1'), ('recipe', 'u1')]
+        fields += [('v{}'.format(i), type_dtypes[type]) for i, type in enumerate(types)]
+        self.dtype = np.dtype(fields)
+
+    # Returns the bytes of the data packages for every `step`th row of the values `values` from
+    # `ArmTrajectory.chunk`, starting with row `first`, one after the other.
+    def encode(self, values, first, step):
+        rows = slice(first, None, step)
+        records = np.empty(len(values['timestamp'][rows]), dtype=self.dtype)
+        records['size'], records['command'], records['recipe'] = self.header
+        for i, var in enumerate(self.vars):
+            value = values[var]
+            records['v{}'.format(i)] = value if np.isscalar(value) else value[rows]
+        return records.tobytes()